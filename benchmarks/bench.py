@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for snote notebook operations against synthetic notebooks
+
+    python benchmarks/bench.py --notes 100000 --output results.json
+
+Results are written as JSON so runs can be compared between versions.
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import platform
+import contextlib
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snote  # noqa: E402
+from snote.snotebook import Snotebook  # noqa: E402
+
+VOCABULARY = (
+    'video tapes return blockbuster meeting notes idea draft plan review '
+    'journal todo standup release bug fix design sketch recipe travel book '
+    'list log weekly monthly project research reading summary question'
+).split()
+
+
+def generate_notebook(location, notes=1000, mean_size=2048, size_sigma=1.0,
+                      days=3650, vocabulary=50, title_words=(1, 5), ext='md',
+                      seed=0):
+    '''
+    Fill location with synthetic notes named like Snotebook.new_note does
+
+    :param notes: number of notes to create
+    :param mean_size: median note size in bytes; sizes are log-normal
+    :param size_sigma: spread of the log-normal size distribution
+    :param days: notes are dated uniformly over this many days up to today
+    :param vocabulary: number of distinct words titles are drawn from
+    :param title_words: (min, max) words per title
+    :returns: list of generated note names
+    '''
+    rng = random.Random(seed)
+    words = list(VOCABULARY)
+    while len(words) < vocabulary:
+        words.append('word{}'.format(len(words)))
+    words = words[:vocabulary]
+    today = datetime.date.today()
+
+    os.makedirs(location, exist_ok=True)
+    names = set()
+    while len(names) < notes:
+        date = today - datetime.timedelta(days=rng.randrange(days))
+        title = '-'.join(rng.choice(words) for _ in
+                         range(rng.randint(*title_words)))
+        name = '{}-{}-{}.{}'.format(date.isoformat(), title, len(names), ext)
+        names.add(name)
+
+    for name in names:
+        size = max(1, int(rng.lognormvariate(0, size_sigma) * mean_size))
+        line = ' '.join(rng.choice(words) for _ in range(12)) + '\n'
+        content = (line * (size // len(line) + 1))[:size]
+        with open(os.path.join(location, name), 'w') as note:
+            note.write(content)
+
+    return sorted(names)
+
+
+def time_call(func, repeat):
+    '''
+    :returns: dict of timings in seconds over repeat calls of func
+    '''
+    timings = list()
+    with open(os.devnull, 'w') as sink, contextlib.redirect_stdout(sink):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'repeat': repeat
+    }
+
+
+def noop_writer(load_content, timestamp):
+    '''
+    Stand-in for Snotebook.call_writer that edits without an editor
+    '''
+    return load_content + b'\nedited'
+
+
+def make_editor(directory):
+    '''
+    Write a stand-in editor for Snotebook.edit_note that appends a line
+
+    :returns: path to the editor script
+    '''
+    editor = os.path.join(directory, 'editor')
+    with open(editor, 'w') as script:
+        script.write('#!/bin/sh\necho edited >> "$1"\n')
+    os.chmod(editor, 0o755)
+    return editor
+
+
+def run_benchmarks(location, names, index=True, repeat=5, limit=10):
+    editor_dir = tempfile.mkdtemp(prefix='snote-bench-editor-')
+    sb = Snotebook('bench', location, editor=make_editor(editor_dir),
+                   index=index)
+    sb.call_writer = noop_writer
+
+    start = time.perf_counter()
+    sb._list_notes()  # opens or builds the index when enabled
+    setup = time.perf_counter() - start
+
+    unique = names[len(names) // 2]
+    term = snote.lib.parse_note_name(unique)[1].split()[0]
+    stdin = sys.stdin
+
+    def get_note_path():
+        sys.stdin = io.StringIO('1\n')  # answer the selection prompt
+        try:
+            sb.get_note_path(term)
+        finally:
+            sys.stdin = stdin
+
+    operations = [
+        ('list', lambda: sb.list_notes()),
+        ('list_n', lambda: sb.list_notes(limit)),
+        ('search', lambda: sb._search_notes(term)),
+        ('ranked_search', lambda: sb._rank_notes(term, limit)),
+        ('last_note', lambda: sb._last_note()),
+        ('get_note_path', get_note_path),
+        ('update_note', lambda: sb.update_note(filename=unique)),
+        ('new_note', lambda: sb.new_note(filename='benchmark note')),
+    ]
+
+    results = {'setup': setup}
+    try:
+        for name, func in operations:
+            results[name] = time_call(func, repeat)
+    finally:
+        shutil.rmtree(editor_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--notes', type=int, default=10000,
+                        help='number of notes to generate (up to 1M)')
+    parser.add_argument('--mean-size', type=int, default=2048,
+                        help='median note size in bytes')
+    parser.add_argument('--size-sigma', type=float, default=1.0,
+                        help='spread of the log-normal note size distribution')
+    parser.add_argument('--days', type=int, default=3650,
+                        help='spread note dates over this many days')
+    parser.add_argument('--vocabulary', type=int, default=50,
+                        help='number of distinct title words')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed calls per operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--location', default=None,
+                        help='reuse or create the notebook here instead of '
+                             'a temporary directory')
+    parser.add_argument('--no-index', action='store_true',
+                        help='benchmark without the note index')
+    parser.add_argument('--output', default=None,
+                        help='write JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    location = args.location or tempfile.mkdtemp(prefix='snote-bench-')
+    try:
+        if os.path.isdir(location) and os.listdir(location):
+            names = sorted(n for n in os.listdir(location)
+                           if not n.startswith('.'))
+        else:
+            names = generate_notebook(location, args.notes, args.mean_size,
+                                      args.size_sigma, args.days,
+                                      args.vocabulary, seed=args.seed)
+
+        results = {
+            'snote_version': snote.VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': dict(vars(args), notes=len(names)),
+            'results': run_benchmarks(location, names, not args.no_index,
+                                      args.repeat)
+        }
+    finally:
+        if not args.location:
+            shutil.rmtree(location)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -25,10 +25,17 @@ setup(
     classifiers=[
         "Development Status :: 3 - Alpha",
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
+    python_requires='>=3.7',
     extras_require={
         'test': ['pytest'],
+        'zstd': ['zstandard'],
     },
     entry_points={
         'console_scripts': [
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Asyncio front end to Snotebook, for services embedding snote.
+
+Every call runs the blocking Snotebook method on an executor, so many
+concurrent requests can share one notebook without blocking the event
+loop:
+
+    notebook = AsyncSnotebook(Snotebook.get_snotebook('nb1'))
+    notes = await notebook.search_notes('video', content=True)
+    content = await notebook.read_note(notes[0].path)
+
+Results are NoteRecords and bytes rather than printed listings, and
+failures are raised as the exceptions in snote.exceptions, e.g.
+NoteNotFoundError when nothing matches.
+'''
+
+import asyncio
+import functools
+from .snotebook import RANKED_LIMIT
+
+
+class AsyncSnotebook(object):
+    """
+    Awaitable versions of the structured Snotebook methods
+
+    :param sb: Snotebook to share between tasks
+    :param executor: concurrent.futures executor to run calls on, the event
+    loop's default thread pool if None
+    """
+
+    def __init__(self, sb, executor=None):
+        self._sb = sb
+        self._executor = executor
+
+    @property
+    def snotebook(self):
+        return self._sb
+
+    def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self._executor, functools.partial(method, *args, **kwargs))
+
+    async def list_notes(self, sort='name', reverse=False, limit=0,
+                         since=None, until=None, tags=None):
+        '''
+        :returns: list of NoteRecords, see Snotebook.get_notes
+        '''
+        return await self._run(self._sb.get_notes, sort, reverse, limit,
+                               since, until, tags)
+
+    async def search_notes(self, search_term, content=False, since=None,
+                           until=None):
+        '''
+        :returns: list of NoteRecords, see Snotebook.get_matching_notes
+        '''
+        return await self._run(self._sb.get_matching_notes, search_term,
+                               content, since, until)
+
+    async def rank_notes(self, query, limit=RANKED_LIMIT, since=None,
+                         until=None):
+        '''
+        :returns: list of NoteRecords, see Snotebook.get_ranked_notes
+        '''
+        return await self._run(self._sb.get_ranked_notes, query, limit,
+                               since, until)
+
+    async def get_note_path(self, filename=None):
+        '''
+        :returns: path of the last note, or the only note matching
+        filename, see Snotebook.get_note_path with select=False
+        '''
+        return await self._run(self._sb.get_note_path, filename,
+                               select=False)
+
+    async def read_note(self, full_notepath):
+        '''
+        :returns: content of the note as bytes
+        '''
+        return await self._run(self._sb.read_note, full_notepath)
+
+    async def write_note(self, full_notepath, content, previous=None):
+        await self._run(self._sb.write_note, full_notepath, content, previous)
+
+    async def create_note(self, content, title=None, day=None):
+        '''
+        :returns: path of the new note
+        '''
+        return await self._run(self._sb.create_note, content, title, day)
+
+    async def append_note(self, content, filename=None, timestamp=False):
+        '''
+        :returns: path of the note appended to
+        '''
+        return await self._run(self._sb.append_note, content, filename,
+                               timestamp)
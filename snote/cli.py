@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Command line interface, only imported when snote runs as a command'''
+
+import sys
+import logging
+import argparse
+from .snotebook import Snotebook
+from .records import date_bound
+from .timing import Timings
+from .exceptions import (ConfigError, NotebookError, NoteNotFoundError)
+
+log = logging.getLogger(__name__)
+
+# actions whose note lookups a running snote daemon can answer
+DAEMON_ACTIONS = frozenset(['update', 'u', 'append', 'a', 'list', 'l', 'ls',
+                            'search', 's', 'history', 'show'])
+
+
+class EditSnoteParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(EditSnoteParser, self).__init__(add_help=False)
+        self.add_argument(
+            '-t',
+            '--timestamp',
+            action='store_true',
+            help='add a timestamp to the note'
+        )
+        self.add_argument(
+            '-f',
+            '--filename',
+            type=str,
+            default=None,
+            help='name a new note, or search for a note to update'
+        )
+
+
+def add_date_range(parser):
+    parser.add_argument(
+        '--since',
+        type=date_bound,
+        metavar='DATE',
+        default=None,
+        help='only notes dated on or after DATE: YYYY-MM-DD, today, '
+             'yesterday, or days/weeks ago such as 3d or 2w'
+    )
+    parser.add_argument(
+        '--until',
+        type=date_bound,
+        metavar='DATE',
+        default=None,
+        help='only notes dated on or before DATE'
+    )
+
+
+def uses_all(argv):
+    '''
+    :returns: True if --all is given before the first positional argument
+    '''
+    for arg in argv:
+        if arg in ['-a', '--all']:
+            return True
+        if not arg.startswith('-'):
+            return False
+    return False
+
+
+def main_all(argv):
+    parser = argparse.ArgumentParser(
+        prog='snote --all',
+        description='list or search every configured notebook concurrently'
+    )
+    parser.add_argument('-a', '--all', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='number of worker processes; defaults to the number of CPUs'
+    )
+    subparsers = parser.add_subparsers(title='actions', dest='note_action')
+    subparsers.required = True
+
+    parser_list = subparsers.add_parser(
+        'list',
+        aliases=['l', 'ls'],
+        help='list note titles in every notebook, newest first'
+    )
+    parser_list.add_argument(
+        '-n',
+        '--number',
+        type=int,
+        default=0,
+        help='limit number of notes to list; 0 for all'
+    )
+
+    parser_search = subparsers.add_parser(
+        'search',
+        aliases=['s'],
+        help='list note titles containing the search term in every notebook'
+    )
+    parser_search.add_argument(
+        'search_term',
+        type=str,
+        help='search term'
+    )
+    parser_search.add_argument(
+        '-c',
+        '--content',
+        action='store_true',
+        help='search note contents instead of titles; quote phrases'
+    )
+    parser_search.add_argument(
+        '-n',
+        '--number',
+        type=int,
+        default=0,
+        help='limit number of notes to list; 0 for all'
+    )
+
+    args = parser.parse_args(argv)
+
+    from .multi import show_all_notes
+    if args.note_action in ['list', 'l', 'ls']:
+        show_all_notes(limit=args.number, workers=args.jobs)
+    else:
+        show_all_notes(args.search_term, args.content, args.number, args.jobs)
+
+
+def main_daemon(argv):
+    parser = argparse.ArgumentParser(
+        prog='snote daemon',
+        description='keep notebooks loaded and answer list, search and '
+                    'last note lookups for snote over a Unix socket'
+    )
+    parser.add_argument(
+        '--socket',
+        default=None,
+        help='socket path; defaults to $XDG_RUNTIME_DIR/snote-daemon.sock'
+    )
+    add_watch_options(parser)
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='also watch every notebook for changes made outside snote'
+    )
+    args = parser.parse_args(argv)
+
+    from .daemon import serve
+    serve(args.socket, args.watch, args.poll)
+
+
+def add_watch_options(parser):
+    parser.add_argument(
+        '--poll',
+        action='store_true',
+        help='poll for changes instead of using inotify'
+    )
+
+
+def main_watch(argv):
+    parser = argparse.ArgumentParser(
+        prog='snote watch',
+        description='keep note indexes up to date as notes are created, '
+                    'edited, renamed or deleted outside snote'
+    )
+    parser.add_argument(
+        'notebooks',
+        nargs='*',
+        help='notebooks to watch; defaults to every configured notebook'
+    )
+    add_watch_options(parser)
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=2.0,
+        help='seconds between polls when polling'
+    )
+    args = parser.parse_args(argv)
+
+    from .watch import watch_notebooks
+    watch_notebooks(args.notebooks, args.poll, args.interval)
+
+
+def main():
+    argv = sys.argv[1:]
+    if uses_all(argv):
+        return main_all(argv)
+    if argv[:1] == ['daemon']:
+        return main_daemon(argv[1:])
+    if argv[:1] == ['watch']:
+        return main_watch(argv[1:])
+
+    edit_args = EditSnoteParser()
+    parser = argparse.ArgumentParser(parents=[edit_args])
+    parser.add_argument('notebook', help='name of notebook to access')
+    parser.add_argument(
+        '-a',
+        '--all',
+        action='store_true',
+        help='instead of a notebook, list or search every configured '
+             'notebook: snote --all {list,search} ...'
+    )
+    parser.add_argument(
+        '--no-daemon',
+        action='store_true',
+        help='do not use a running snote daemon'
+    )
+    parser.add_argument(
+        '--timings',
+        action='store_true',
+        help='print time spent in each phase to stderr'
+    )
+    parser.add_argument(
+        '--timings-json',
+        metavar='FILE',
+        default=None,
+        help='write time spent in each phase to FILE as JSON'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        default=None,
+        help='write a cProfile dump of the run to FILE'
+    )
+
+    subparsers = parser.add_subparsers(title='actions',
+                                       dest='note_action',
+                                       help='notebook action, defaults to update')
+
+    parser_update = subparsers.add_parser(
+        'update',
+        aliases=['u'],
+        parents=[edit_args],
+        help='edit note; default action'
+    )
+
+    parser_new = subparsers.add_parser(
+        'new',
+        aliases=['n'],
+        parents=[edit_args],
+        help='create new note'
+    )
+
+    parser_append = subparsers.add_parser(
+        'append',
+        aliases=['a'],
+        parents=[edit_args],
+        help='append text to a note without opening the editor'
+    )
+    parser_append.add_argument(
+        'text',
+        nargs='*',
+        help='text to append; read from stdin if not given'
+    )
+
+    subparsers.add_parser(
+        'history',
+        parents=[edit_args],
+        help='list the recorded revisions of a note; needs history = yes'
+    )
+
+    parser_show = subparsers.add_parser(
+        'show',
+        parents=[edit_args],
+        help='print a note, or one of its revisions'
+    )
+    parser_show.add_argument(
+        '-r',
+        '--rev',
+        type=int,
+        default=None,
+        help='revision number as listed by history; negative counts back '
+             'from the last'
+    )
+
+    parser_list = subparsers.add_parser(
+        'list',
+        aliases=['l', 'ls'],
+        help='list note titles in notebook'
+    )
+    parser_list.add_argument(
+        '-n',
+        '--number',
+        type=int,
+        default=0,
+        help='limit number of notes to list; 0 for all'
+    )
+    parser_list.add_argument(
+        '--tag',
+        action='append',
+        dest='tags',
+        metavar='TAG',
+        help='only notes tagged TAG, in their frontmatter or as #TAG; repeat '
+             'for notes with every tag, use TAG1,TAG2 for either and '
+             '--tag=-TAG to exclude a tag'
+    )
+    parser_list.add_argument(
+        '--sort',
+        choices=['name', 'last', 'mtime', 'size', 'date'],
+        default='name',
+        help='order notes by name, creation time, modification time, size or '
+             'date in the filename; largest first'
+    )
+
+    parser_search = subparsers.add_parser(
+        'search',
+        aliases=['s'],
+        help='list note titles containing the search term'
+    )
+    parser_search.add_argument(
+        'search_term',
+        type=str,
+        help='search term'
+    )
+    parser_search.add_argument(
+        '-c',
+        '--content',
+        action='store_true',
+        help='search note contents instead of titles; quote phrases'
+    )
+    parser_search.add_argument(
+        '-r',
+        '--rank',
+        action='store_true',
+        help='list the notes most relevant to the search term first, by '
+             'title and content; quote phrases, end words with * to match '
+             'prefixes'
+    )
+    parser_search.add_argument(
+        '-n',
+        '--number',
+        type=int,
+        default=0,
+        help='limit number of notes to list; ranked searches list 10 by '
+             'default'
+    )
+
+    parser_grep = subparsers.add_parser(
+        'grep',
+        aliases=['g'],
+        help='print lines of notes matching a regular expression'
+    )
+    parser_grep.add_argument(
+        'pattern',
+        type=str,
+        help='regular expression, matched case-insensitively'
+    )
+    parser_grep.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='number of worker processes; defaults to the number of CPUs'
+    )
+
+    subparsers.add_parser(
+        'reshard',
+        help='move notes into YYYY/MM subdirectories; needs layout = sharded'
+    )
+
+    parser_import = subparsers.add_parser(
+        'import',
+        help='create notes from a directory, a tar archive or JSON Lines'
+    )
+    parser_import.add_argument(
+        'source',
+        type=str,
+        help='directory, tar archive or JSON Lines file of {"title", '
+             '"content", "date"} objects; - reads JSON Lines from stdin'
+    )
+    parser_import.add_argument(
+        '--format',
+        choices=['auto', 'dir', 'tar', 'jsonl'],
+        default='auto',
+        help='format of source; guessed by default'
+    )
+    parser_import.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='number of writer threads'
+    )
+
+    parser_export = subparsers.add_parser(
+        'export',
+        help='write notes to a tar or zip archive or JSON Lines'
+    )
+    parser_export.add_argument(
+        'search_term',
+        nargs='?',
+        default=None,
+        help='only export notes whose names match, as for search'
+    )
+    parser_export.add_argument(
+        '-o',
+        '--output',
+        default=None,
+        help='file to write; stdout by default'
+    )
+    parser_export.add_argument(
+        '--format',
+        choices=['tar', 'zip', 'jsonl'],
+        default=None,
+        help='guessed from the output filename; jsonl for stdout'
+    )
+    parser_export.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=None,
+        help='number of reader threads'
+    )
+
+    subparsers.add_parser(
+        'compress',
+        help='compress every note; needs compress = gzip or zstd'
+    )
+
+    for date_parser in [parser_list, parser_search, parser_export]:
+        add_date_range(date_parser)
+
+    parser.set_defaults(note_action='update')
+
+    args = parser.parse_args(argv)
+    timings = Timings(enabled=bool(args.timings or args.timings_json))
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        run(args, timings)
+    except NoteNotFoundError as e:
+        log.info('%s', e.value)
+        sys.exit(1)
+    except (NotebookError, ConfigError) as e:
+        log.error('%s', e.value)
+        sys.exit(1)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.timings:
+            timings.write(sys.stderr)
+        if args.timings_json:
+            timings.dump(args.timings_json)
+
+
+def run(args, timings):
+    sb = Snotebook.get_snotebook(args.notebook, timings)
+    if not args.no_daemon and args.note_action in DAEMON_ACTIONS:
+        from .daemon import DaemonClient
+        sb.remote = DaemonClient.connect()
+
+    if args.note_action in ['update', 'u']:
+        sb.update_note(filename=args.filename, timestamp=args.timestamp)
+    elif args.note_action in ['new', 'n']:
+        sb.new_note(filename=args.filename, timestamp=args.timestamp)
+    elif args.note_action in ['append', 'a']:
+        if args.text:
+            content = ' '.join(args.text).encode('utf-8')
+        else:
+            content = sys.stdin.buffer.read()
+        sb.append_note(content, filename=args.filename,
+                       timestamp=args.timestamp)
+    elif args.note_action == 'history':
+        sb.show_history(args.filename)
+    elif args.note_action == 'show':
+        sb.show_note(args.filename, args.rev)
+    elif args.note_action in ['list', 'l', 'ls']:
+        sb.list_notes(args.number, args.sort, args.since, args.until,
+                      args.tags)
+    elif args.note_action in ['search', 's']:
+        sb.search_notes(args.search_term, args.content, args.since,
+                        args.until, args.rank, args.number)
+    elif args.note_action in ['grep', 'g']:
+        sb.grep_notes(args.pattern, args.jobs)
+    elif args.note_action == 'reshard':
+        sb.reshard()
+    elif args.note_action == 'compress':
+        sb.compress_notes()
+    elif args.note_action == 'export':
+        sb.export_notes(args.output, args.format, args.search_term,
+                        args.since, args.until, args.jobs)
+    elif args.note_action == 'import':
+        sb.import_notes(args.source, args.format, args.jobs)
+
+    if sb.remote is not None:
+        sb.remote.close()
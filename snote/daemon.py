@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Long-running daemon keeping notebooks warm, and the client snote uses to
+talk to it over a Unix socket.
+
+Requests and responses are single lines of JSON. A request names a
+notebook, the directory the client has it at, an action and its parameters:
+
+    {"notebook": "nb1", "location": "/home/me/notes", "action": "list",
+     "params": {"limit": 10}}
+
+The daemon refuses requests for notebooks it has at another location, as
+when the client and the daemon were started with different configurations.
+
+and is answered with the matching notes as rows of NoteRecord fields,
+{"rows": [[location, name, size, ctime, mtime_ns, digest], ...]}, or with
+{"error": message}.
+'''
+
+import os
+import json
+import socket
+import logging
+from . import lib
+from .exceptions import (ConfigError, NotebookError, NoteNotFoundError)
+
+log = logging.getLogger(__name__)
+
+SOCKET_NAME = 'snote-daemon.sock'
+ACTIONS = ('list', 'search', 'fuzzy', 'content', 'ranked', 'last')
+
+
+def socket_path():
+    '''
+    :returns: path of the daemon socket, in XDG_RUNTIME_DIR if set or else
+    a private directory in the system temporary directory
+    '''
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, SOCKET_NAME)
+    directory = os.path.join(lib.get_scratch_dir(),
+                             'snote-{}'.format(os.getuid()))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return os.path.join(directory, SOCKET_NAME)
+
+
+def same_location(location, other):
+    '''
+    :returns: True if both paths name the same directory
+    '''
+    return os.path.realpath(location) == os.path.realpath(other)
+
+
+def record_row(record):
+    return [record.location, record.name, record.size, record.ctime,
+            record.mtime_ns, record.digest]
+
+
+class DaemonClient(object):
+    '''
+    Blocking client for one connection to a running daemon
+    '''
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._stream = sock.makefile('rwb')
+
+    @staticmethod
+    def connect(path=None, timeout=5):
+        '''
+        :returns: DaemonClient, or None if no daemon is listening at path
+        '''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path or socket_path())
+        except OSError as e:
+            log.debug('No snote daemon: %s', e)
+            sock.close()
+            return None
+        return DaemonClient(sock)
+
+    def close(self):
+        self._stream.close()
+        self._sock.close()
+
+    def request(self, notebook, location, action, **params):
+        '''
+        :param location: directory of the notebook in the client's
+        configuration
+        :returns: list of rows of NoteRecord fields, or None if the daemon
+        could not answer, in which case the caller does the work itself
+        '''
+        message = {'notebook': notebook, 'location': location,
+                   'action': action, 'params': params}
+        try:
+            self._stream.write(json.dumps(message).encode('utf-8') + b'\n')
+            self._stream.flush()
+            response = json.loads(self._stream.readline().decode('utf-8'))
+        except (OSError, ValueError) as e:
+            log.debug('snote daemon request failed: %s', e)
+            return None
+        if 'error' in response:
+            log.debug('snote daemon error: %s', response['error'])
+            return None
+        return response['rows']
+
+
+class NotebookServer(object):
+    '''
+    Answers requests from Snotebooks kept open between requests, so their
+    configuration, note index and compiled patterns are only loaded once.
+    Notebooks configured with index = no get an index kept in memory.
+    '''
+
+    def __init__(self):
+        self._notebooks = dict()
+        self._in_memory = set()  # names of notebooks indexed in memory
+        self._config_stamp = None
+        self._watcher = None
+        self._pending = dict()
+
+    def _config_changed(self):
+        config_path = os.getenv('SNOTE', '')
+        try:
+            stat = os.stat(config_path)
+        except OSError:
+            return True
+        stamp = (config_path, stat.st_mtime_ns, stat.st_size)
+        changed = stamp != self._config_stamp
+        self._config_stamp = stamp
+        return changed
+
+    def notebook(self, name):
+        '''
+        :returns: warm Snotebook for the notebook called name
+        '''
+        from .snotebook import Snotebook
+
+        if self._config_changed():
+            log.info('Configuration changed, reloading notebooks')
+            self.close()
+        sb = self._notebooks.get(name)
+        if sb is None:
+            sb = Snotebook.get_snotebook(name)
+            if sb.index is None:
+                sb.use_memory_index()
+                self._in_memory.add(name)
+            self._notebooks[name] = sb
+        elif sb.index:
+            # notes rewritten or appended to in place leave their directory
+            # mtime alone; snote updates an index in the notebook directory
+            # as it writes, but only a watcher or comparing every note's
+            # stat catches up with an index kept in memory
+            sb.index.refresh(force=name in self._in_memory and
+                             self._watcher is None)
+        return sb
+
+    def watch(self, loop, poll=False, interval=2.0, delay=0.2):
+        '''
+        Load every configured notebook and apply changes made to them
+        outside snote to their indexes as they happen, see snote.watch
+        '''
+        from . import watch
+
+        self._watcher = watcher = watch.get_watcher(poll, interval)
+        for name in lib.get_config().sections():
+            try:
+                sb = self.notebook(name)
+            except (NotebookError, ConfigError) as e:
+                log.warning('Not watching notebook %s: %s', name, e)
+                continue
+            watcher.add(sb.location, sb.sharded)
+            sb.index.refresh()
+
+        def apply_pending():
+            batch, self._pending = self._pending, dict()
+            for sb in self._notebooks.values():
+                if sb.location in batch and sb.index:
+                    watch.apply_changes(sb.index, batch[sb.location])
+
+        def on_events():
+            if not self._pending:
+                loop.call_later(delay, apply_pending)
+            watch.merge(self._pending, watcher.changes(0))
+
+        def poll_changes():
+            watch.merge(self._pending, watcher.changes(0))
+            apply_pending()
+            loop.call_later(interval, poll_changes)
+
+        if watcher.fileno() is not None:
+            loop.add_reader(watcher.fileno(), on_events)
+        else:
+            loop.call_later(interval, poll_changes)
+
+    def close(self):
+        for sb in self._notebooks.values():
+            if sb.index:
+                sb.index.close()
+        self._notebooks.clear()
+        self._in_memory.clear()
+
+    def handle(self, message):
+        '''
+        :param message: decoded request
+        :returns: response to encode
+        '''
+        from .records import NoteRecord
+
+        action = message.get('action')
+        params = message.get('params') or dict()
+        if action not in ACTIONS:
+            return {'error': 'unknown action {!r}'.format(action)}
+        try:
+            sb = self.notebook(message.get('notebook'))
+            location = message.get('location')
+            if not location or not same_location(sb.location, location):
+                return {'error': 'notebook {} is at {}, not {}'.format(
+                    sb.name, sb.location, location)}
+            if action == 'list':
+                notes = sb._list_notes(**params)
+            elif action == 'search':
+                notes = sb._match_names(**params)
+            elif action == 'fuzzy':
+                notes = sb._similar_names(**params)
+            elif action == 'content':
+                notes = sb._search_content(**params)
+            elif action == 'ranked':
+                notes = sb._rank_notes(**params)
+            else:
+                path = sb._last_note()
+                notes = [NoteRecord(os.path.dirname(path),
+                                    os.path.basename(path))]
+        except NoteNotFoundError:
+            notes = []
+        except NotebookError as e:
+            return {'error': str(e)}
+        except (OSError, TypeError, ValueError) as e:
+            log.exception('Failed to answer %s', message)
+            return {'error': str(e)}
+        return {'rows': [record_row(note) for note in notes]}
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.handle(json.loads(line.decode('utf-8')))
+                except ValueError as e:
+                    response = {'error': 'bad request: {}'.format(e)}
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def serve(path=None, watch=False, poll=False):
+    '''
+    Run the daemon in the foreground until interrupted
+
+    :param watch: bool - True to watch notebooks for changes made outside
+    snote, see NotebookServer.watch
+    :param poll: bool - True to watch by polling instead of inotify
+    '''
+    import asyncio
+
+    path = path or socket_path()
+    client = DaemonClient.connect(path)
+    if client is not None:
+        client.close()
+        log.error('snote daemon already listening on %s', path)
+        return
+    if os.path.exists(path):  # left behind by a daemon that died
+        os.unlink(path)
+
+    server = NotebookServer()
+
+    async def main():
+        if watch:
+            server.watch(asyncio.get_running_loop(), poll)
+        listener = await asyncio.start_unix_server(server.serve_client, path)
+        os.chmod(path, 0o600)
+        log.info('snote daemon listening on %s', path)
+        async with listener:
+            await listener.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 
-class ConfigError(BaseException):
+class ConfigError(Exception):
 
     def __init__(self, value=None):
         if value:
@@ -14,7 +14,7 @@ class ConfigError(BaseException):
         return repr(self.value)
 
 
-class NotebookError(BaseException):
+class NotebookError(Exception):
 
     def __init__(self, value):
         self.value = value
@@ -33,3 +33,7 @@ class InvalidNotebookPathError(NotebookError):
 
     def __init__(self, value):
         self.value = 'Notebook path \'{}\' unknown'.format(value)
+
+
+class NoteNotFoundError(NotebookError):
+    pass
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Streaming export of a notebook to a tar or zip archive or JSON Lines'''
+
+import io
+import os
+import sys
+import json
+import logging
+from collections import deque
+from . import lib
+from .records import date_prefix
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('tar', 'zip', 'jsonl')
+
+
+def guess_format(output):
+    '''
+    :returns: export format for the output filename, JSON Lines for stdout
+    '''
+    if output in (None, '-'):
+        return 'jsonl'
+    name = output.lower()
+    if name.endswith('.zip'):
+        return 'zip'
+    if name.endswith(('.jsonl', '.json')):
+        return 'jsonl'
+    return 'tar'
+
+
+def read_note(note):
+    '''
+    :returns: tuple of (note, stat result, content as bytes)
+    '''
+    return (note, os.stat(note.path), lib.get_file_content(note.path))
+
+
+def iter_contents(notes, workers=None, read_ahead=32):
+    '''
+    Read notes on a thread pool, at most read_ahead of them ahead of the
+    consumer so that memory stays bounded, and yield them in order
+
+    :returns: generator of (note, stat result, content) tuples
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    notes = iter(notes)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for note in notes:
+            pending.append(pool.submit(read_note, note))
+            if len(pending) >= read_ahead:
+                break
+        while pending:
+            yield pending.popleft().result()
+            note = next(notes, None)
+            if note is not None:
+                pending.append(pool.submit(read_note, note))
+
+
+def write_tar(stream, entries, compression=''):
+    import tarfile
+
+    with tarfile.open(fileobj=stream, mode='w|' + compression,
+                      format=tarfile.PAX_FORMAT) as archive:
+        for name, metadata, stat, content in entries:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = stat.st_mtime
+            info.mode = stat.st_mode & 0o777
+            info.pax_headers = dict(('SNOTE.' + key, str(value))
+                                    for key, value in metadata.items()
+                                    if value is not None)
+            archive.addfile(info, io.BytesIO(content))
+
+
+def write_zip(stream, entries):
+    import time
+    import zipfile
+
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, metadata, stat, content in entries:
+            info = zipfile.ZipInfo(name, time.localtime(stat.st_mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.comment = json.dumps(metadata).encode('utf-8')
+            archive.writestr(info, content)
+
+
+def write_jsonl(stream, entries):
+    for name, metadata, stat, content in entries:
+        record = dict(metadata, name=name,
+                      content=content.decode('utf-8', 'replace'))
+        stream.write(json.dumps(record).encode('utf-8') + b'\n')
+
+
+def export_notes(sb, output=None, fmt=None, search_term=None, since=None,
+                 until=None, workers=None):
+    '''
+    Stream the notes of Snotebook sb, optionally only those whose names
+    match search_term and dated within since and until as for search and
+    list, into one archive or JSON Lines stream. Every note is stored under
+    its path in the notebook, decompressed, along with the date and title
+    shown by display_note_info. JSON Lines exports can be imported again,
+    see importer.read_jsonl.
+
+    :param output: file to write, stdout if None or '-'
+    :param fmt: one of FORMATS, guessed from output by default; tar
+    archives named .tar.gz, .tgz, .tar.bz2 or .tar.xz are compressed
+    :returns: number of notes exported
+    '''
+    fmt = fmt or guess_format(output)
+    if search_term is None:
+        notes = sb._list_notes(since=since, until=until)
+    else:
+        notes = sb._match_names(search_term, since, until)
+
+    exported = [0]
+
+    def entries():
+        for note, stat, content in iter_contents(notes, workers):
+            exported[0] += 1
+            relpath = os.path.relpath(note.path, sb.location)
+            display_date, title = sb.display_note_info(note)
+            metadata = {'notebook': sb.name, 'display_date': display_date,
+                        'title': title,
+                        'date': date_prefix(note.ordinal) if note.ordinal
+                        else None}
+            yield (lib.strip_compression(relpath), metadata, stat, content)
+
+    to_stdout = output in (None, '-')
+    stream = sys.stdout.buffer if to_stdout else open(output, 'wb')
+    try:
+        if fmt == 'zip':
+            write_zip(stream, entries())
+        elif fmt == 'jsonl':
+            write_jsonl(stream, entries())
+        else:
+            compression = ''
+            for suffix, mode in [('gz', 'gz'), ('tgz', 'gz'), ('bz2', 'bz2'),
+                                 ('xz', 'xz')]:
+                if output and output.lower().endswith('.' + suffix):
+                    compression = mode
+            write_tar(stream, entries(), compression)
+    finally:
+        if to_stdout:
+            stream.flush()
+        else:
+            stream.close()
+
+    log.info('Exported %d notes from %s', exported[0], sb.name)
+    return exported[0]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Frontmatter and #tag extraction from note content, and tag queries'''
+
+import re
+
+FENCE = re.compile(r'\A---[ \t]*\r?\n(.*?)^(?:---|\.\.\.)[ \t]*$', re.M | re.S)
+FIELD = re.compile(r'^([A-Za-z_][\w-]*)[ \t]*:[ \t]*(.*?)[ \t]*$')
+ITEM = re.compile(r'^[ \t]+-[ \t]+(.*?)[ \t]*$')
+HASHTAG = re.compile(r'(?<![\w#&/])#(\w[\w/-]*)')
+TAG_FIELDS = ('tags', 'tag')
+
+
+def _scalar(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def parse_frontmatter(text):
+    '''
+    Read the YAML-like block between --- lines at the start of a note:
+    `key: value` lines, `key: [a, b]` inline lists and `- item` lines below
+    a key with no value. Anything else in the block is ignored.
+
+    :param text: note content as str
+    :returns: tuple of (dict of lowercase key to str or list of str, offset
+    of the body in text)
+    '''
+    match = FENCE.match(text)
+    if not match:
+        return (dict(), 0)
+    fields = dict()
+    key = None
+    for line in match.group(1).splitlines():
+        item = ITEM.match(line)
+        if item and key is not None:
+            if not isinstance(fields[key], list):
+                fields[key] = [fields[key]] if fields[key] else []
+            fields[key].append(_scalar(item.group(1)))
+            continue
+        field = FIELD.match(line)
+        if not field:
+            continue
+        key, value = field.group(1).lower(), field.group(2)
+        if value.startswith('[') and value.endswith(']'):
+            fields[key] = [_scalar(v.strip()) for v in value[1:-1].split(',')
+                           if v.strip()]
+        else:
+            fields[key] = _scalar(value)
+    return (fields, match.end())
+
+
+def normalize_tag(tag):
+    '''
+    :returns: tag in lowercase without a leading # or trailing punctuation,
+    or '' if that leaves nothing that is not a number
+    '''
+    tag = tag.strip().lstrip('#').rstrip('/-').lower()
+    return '' if tag.isdigit() else tag
+
+
+def field_tags(fields):
+    '''
+    :param fields: dict as returned by parse_frontmatter
+    :returns: set of the tags listed under tags or tag
+    '''
+    tags = set()
+    for name in TAG_FIELDS:
+        value = fields.get(name) or []
+        if not isinstance(value, list):
+            value = re.split(r'[,\s]+', value)
+        tags.update(normalize_tag(tag) for tag in value)
+    tags.discard('')
+    return tags
+
+
+def hashtags(text, pos=0):
+    '''
+    :returns: set of the #tags in text from offset pos on
+    '''
+    if '#' not in text:
+        return set()
+    tags = set(normalize_tag(tag) for tag in HASHTAG.findall(text, pos))
+    tags.discard('')
+    return tags
+
+
+def parse_tags(content):
+    '''
+    :param content: note content as bytes
+    :returns: set of the note's tags: those listed under tags or tag in its
+    frontmatter, and every #tag in its body
+    '''
+    text = content.decode('utf-8', 'replace')
+    fields, body = parse_frontmatter(text)
+    return field_tags(fields) | hashtags(text, body)
+
+
+def parse_tag_query(terms):
+    '''
+    Every term is a clause notes must satisfy: 'a,b' for notes tagged a or
+    b, and a leading - for notes tagged none of them
+
+    :param terms: list of str, e.g. ['work', 'home,errands', '-draft']
+    :returns: list of (negated, set of tags) clauses
+    '''
+    clauses = list()
+    for term in terms:
+        term = term.strip()
+        negated = term.startswith('-')
+        tags = set(normalize_tag(tag) for tag in term.lstrip('-').split(','))
+        tags.discard('')
+        if tags:
+            clauses.append((negated, tags))
+    return clauses
+
+
+def matches(tags, clauses):
+    '''
+    :param tags: set of a note's tags
+    :param clauses: as returned by parse_tag_query
+    :returns: True if the note satisfies every clause
+    '''
+    return all(bool(tags & wanted) != negated for negated, wanted in clauses)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Trigram matching of search terms against note names and titles'''
+
+import re
+
+WORD = re.compile(r'[^\W_]+')
+REGEX_SYNTAX = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+# smallest share of the search term's trigrams a fuzzy match must contain
+THRESHOLD = 0.5
+
+
+def words(text):
+    '''
+    :returns: list of lowercase words in text, split on anything that is
+    not a letter or digit (so hyphens and spaces are equivalent)
+    '''
+    return WORD.findall(text.lower())
+
+
+def trigrams(text):
+    '''
+    :returns: set of the trigrams of every word in text, each word padded
+    with two spaces in front and one behind so that word starts weigh more
+    '''
+    grams = set()
+    for word in words(text):
+        padded = '  {} '.format(word)
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def substring_grams(text):
+    '''
+    :returns: set of the unpadded trigrams of every word in text, all of
+    which occur in any name containing text
+    '''
+    grams = set()
+    for word in words(text):
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def is_literal(term):
+    '''
+    :returns: True if term has no regular expression syntax, so names it
+    matches must contain its substring_grams
+    '''
+    return REGEX_SYNTAX.search(term) is None
+
+
+def similarity(term, title):
+    '''
+    :returns: tuple sorting better matches of term in title last: whether
+    title contains term, the share of term's trigrams found in title, and
+    the share of all their trigrams they have in common
+    '''
+    wanted = trigrams(term)
+    found = trigrams(title)
+    if not wanted:
+        return (False, 0.0, 0.0)
+    shared = len(wanted & found)
+    contains = ' '.join(words(term)) in ' '.join(words(title))
+    return (contains, shared / len(wanted),
+            shared / len(wanted | found))
+
+
+def rank(term, notes, threshold=THRESHOLD):
+    '''
+    :param notes: iterable of NoteRecords
+    :param threshold: smallest share of term's trigrams a title must have
+    :returns: list of notes matching term, most similar title first
+    '''
+    scored = list()
+    for note in notes:
+        score = similarity(term, note.title)
+        if score[0] or score[1] >= threshold:
+            scored.append((score, note))
+    scored.sort(key=lambda pair: pair[0], reverse=True)
+    return [note for _, note in scored]
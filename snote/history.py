@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Revision history of the notes in a notebook, kept in one append-only pack
+file inside the notebook directory.
+
+Every record in the pack holds one revision of one note, zlib compressed:
+either a snapshot of its whole content, or a delta against the note's
+previous revision made of copy (offset, length) and insert operations. At
+most SNAPSHOT_INTERVAL revisions of a note follow its last snapshot, which
+bounds the work of reconstructing any revision.
+
+Notes are keyed by their filename without the compression suffix, which
+does not change when a notebook is resharded or compressed.
+'''
+
+import os
+import zlib
+import time
+import struct
+import logging
+import difflib
+import threading
+from . import lib
+from .exceptions import NoteNotFoundError
+
+log = logging.getLogger(__name__)
+
+HISTORY_NAME = '.snote-history.pack'
+
+# most revisions of a note recorded as deltas after its last snapshot
+SNAPSHOT_INTERVAL = 32
+
+SNAPSHOT, DELTA = 0, 1
+
+# magic, kind, key length, payload length, time, size, and the size and
+# mtime_ns of the note file the revision was recorded from
+HEADER = struct.Struct('>4sBHIdQQq')
+MAGIC = b'SNRV'
+
+COPY = struct.Struct('>cQQ')
+INSERT = struct.Struct('>cQ')
+
+
+def make_delta(old, new):
+    '''
+    :returns: bytes of operations turning old into new, see apply_delta
+    '''
+    ops = list()
+    if new.startswith(old):  # the common case of notes written to the end
+        if old:
+            ops.append(COPY.pack(b'C', 0, len(old)))
+        if len(new) > len(old):
+            ops.append(INSERT.pack(b'I', len(new) - len(old)))
+            ops.append(new[len(old):])
+        return b''.join(ops)
+
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(COPY.pack(b'C', offsets[i1], offsets[i2] - offsets[i1]))
+        elif j2 > j1:
+            inserted = b''.join(new_lines[j1:j2])
+            ops.append(INSERT.pack(b'I', len(inserted)))
+            ops.append(inserted)
+    return b''.join(ops)
+
+
+def apply_delta(old, delta):
+    '''
+    :returns: bytes of old with the operations of delta applied
+    '''
+    parts = list()
+    pos = 0
+    while pos < len(delta):
+        if delta[pos:pos + 1] == b'C':
+            _, start, length = COPY.unpack_from(delta, pos)
+            parts.append(old[start:start + length])
+            pos += COPY.size
+        else:
+            _, length = INSERT.unpack_from(delta, pos)
+            pos += INSERT.size
+            parts.append(delta[pos:pos + length])
+            pos += length
+    return b''.join(parts)
+
+
+class Revision(object):
+    """
+    One recorded revision of a note, numbered from 1 in the order they were
+    recorded
+    """
+
+    __slots__ = ('number', 'kind', 'time', 'size', 'stat', 'offset',
+                 'length')
+
+    def __init__(self, number, kind, time, size, stat, offset, length):
+        self.number = number
+        self.kind = kind
+        self.time = time
+        self.size = size
+        self.stat = stat  # (size, mtime_ns) of the note file, or zeros
+        self.offset = offset  # of the compressed payload in the pack
+        self.length = length
+
+    def __repr__(self):
+        return '<Revision {:d} of {:d} bytes>'.format(self.number, self.size)
+
+
+def note_key(filepath):
+    '''
+    :returns: key of the note at filepath in the history
+    '''
+    return lib.strip_compression(os.path.basename(filepath))
+
+
+class NoteHistory(object):
+    """
+    Revisions of the notes in the notebook at location. Only the record
+    headers are read to find revisions, once per instance and then only the
+    records other processes appended since. Appends to the pack are made
+    under an exclusive lock.
+    """
+
+    def __init__(self, location, path=None):
+        self._location = location
+        self._path = path or os.path.join(location, HISTORY_NAME)
+        self._lock = threading.RLock()
+        self._revisions = dict()  # note key to list of Revisions
+        self._scanned = 0  # offset in the pack read up to
+
+    @property
+    def path(self):
+        return self._path
+
+    def _scan(self, pack):
+        '''
+        Read the headers of the records appended since the last scan
+
+        :param pack: binary file object of the pack
+        :returns: offset of the end of the last complete record
+        '''
+        end = pack.seek(0, os.SEEK_END)
+        pos = self._scanned
+        while pos + HEADER.size <= end:
+            pack.seek(pos)
+            (magic, kind, key_length, length, when, size, file_size,
+             mtime_ns) = HEADER.unpack(pack.read(HEADER.size))
+            payload = pos + HEADER.size + key_length
+            if magic != MAGIC or payload + length > end:
+                break  # a record torn by a crash, overwritten by the next
+            key = pack.read(key_length).decode('utf-8')
+            revisions = self._revisions.setdefault(key, list())
+            revisions.append(Revision(len(revisions) + 1, kind, when, size,
+                                      (file_size, mtime_ns), payload, length))
+            pos = payload + length
+        if pos < end:
+            log.debug('Ignoring %d bytes at the end of %s', end - pos,
+                      self._path)
+        self._scanned = pos
+        return pos
+
+    def revisions(self, key):
+        '''
+        :param key: see note_key
+        :returns: list of Revisions of the note, oldest first
+        '''
+        with self._lock:
+            try:
+                with open(self._path, 'rb') as pack:
+                    self._scan(pack)
+            except FileNotFoundError:
+                return list()
+            return list(self._revisions.get(key, ()))
+
+    def read(self, key, number=None):
+        '''
+        :param number: revision number, negative to count from the last;
+        the last revision by default
+        :returns: content of the revision as bytes
+        :raises NoteNotFoundError: if the note has no such revision
+        '''
+        revisions = self.revisions(key)
+        if number is None:
+            number = -1
+        try:
+            if number == 0:
+                raise IndexError(number)
+            revision = revisions[number - 1 if number > 0 else number]
+        except IndexError:
+            raise NoteNotFoundError('No revision {} of {}'.format(number, key))
+        return self._content(revisions, revision.number)
+
+    def _content(self, revisions, number):
+        base = number
+        while revisions[base - 1].kind != SNAPSHOT:
+            base -= 1
+        content = b''
+        with open(self._path, 'rb') as pack:
+            for revision in revisions[base - 1:number]:
+                pack.seek(revision.offset)
+                payload = zlib.decompress(pack.read(revision.length))
+                if revision.kind == SNAPSHOT:
+                    content = payload
+                else:
+                    content = apply_delta(content, payload)
+        return content
+
+    def record(self, key, content, stat=None):
+        '''
+        Record content as the newest revision of the note, unless it already
+        is
+
+        :param stat: os.stat_result of the note holding content, to tell
+        later whether the note still has it, see is_recorded
+        :returns: the new Revision, or None if nothing was recorded
+        '''
+        file_size, mtime_ns = (stat.st_size, stat.st_mtime_ns) if stat \
+            else (0, 0)
+        with self._lock:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                with lib.locked(fd), os.fdopen(os.dup(fd), 'rb') as pack:
+                    end = self._scan(pack)
+                    revisions = self._revisions.get(key, ())
+                    kind, payload = SNAPSHOT, content
+                    if revisions:
+                        previous = self._content(revisions, len(revisions))
+                        if previous == content:
+                            return None
+                        since_snapshot = 0
+                        for revision in reversed(revisions):
+                            if revision.kind == SNAPSHOT:
+                                break
+                            since_snapshot += 1
+                        if since_snapshot < SNAPSHOT_INTERVAL:
+                            delta = make_delta(previous, content)
+                            if len(delta) < len(content):
+                                kind, payload = DELTA, delta
+                    os.ftruncate(fd, end)  # drop a torn record, if any
+                    os.lseek(fd, end, os.SEEK_SET)
+                    encoded = key.encode('utf-8')
+                    payload = zlib.compress(payload)
+                    lib._write_all(fd, HEADER.pack(
+                        MAGIC, kind, len(encoded), len(payload), time.time(),
+                        len(content), file_size, mtime_ns) + encoded + payload)
+                    self._scan(pack)
+            finally:
+                os.close(fd)
+            return self._revisions[key][-1]
+
+    def is_recorded(self, key, stat):
+        '''
+        :param stat: os.stat_result of the note
+        :returns: True if the last revision was recorded from the note as it
+        is now, judged by its size and mtime
+        '''
+        revisions = self.revisions(key)
+        return bool(revisions) and revisions[-1].stat == (stat.st_size,
+                                                          stat.st_mtime_ns)
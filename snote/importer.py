@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Bulk import of notes from a directory, a tar archive or JSON Lines'''
+
+import os
+import sys
+import json
+import logging
+import datetime
+from . import lib
+from .records import (date_ordinal, date_bound)
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('auto', 'dir', 'tar', 'jsonl')
+
+
+def split_name(filename, fallback_day):
+    '''
+    Title and date of an imported file: the extension is dropped, and a
+    leading %Y-%m-%d date such as in snote's own filenames is used as the
+    note date, otherwise fallback_day
+
+    :returns: tuple of (title, datetime.date)
+    '''
+    stem = os.path.splitext(filename)[0]
+    ordinal = date_ordinal(stem)
+    if ordinal:
+        parts = stem.split('-', 3)
+        return (parts[3] if len(parts) > 3 else '',
+                datetime.date.fromordinal(ordinal))
+    return (stem, fallback_day)
+
+
+def read_directory(source):
+    '''
+    Yield (title, date, content) for every file below source, skipping
+    hidden files and directories. Content is a callable reading the file,
+    so that the reads happen in the writer threads.
+    '''
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if filename.startswith('.') or not os.path.isfile(path):
+                continue
+            day = datetime.date.fromtimestamp(os.stat(path).st_mtime)
+            title, day = split_name(filename, day)
+            yield (title, day, lambda path=path: lib.get_file_content(path))
+
+
+def read_tar(source):
+    '''
+    Yield (title, date, content) for every regular file in the tar archive
+    at source, which may be compressed, reading it as a stream
+    '''
+    import tarfile
+
+    with tarfile.open(source, 'r|*') as archive:
+        for member in archive:
+            filename = os.path.basename(member.name)
+            if not member.isfile() or filename.startswith('.'):
+                continue
+            day = datetime.date.fromtimestamp(member.mtime)
+            title, day = split_name(filename, day)
+            yield (title, day, archive.extractfile(member).read())
+
+
+def read_jsonl(stream, name='<stdin>'):
+    '''
+    Yield (title, date, content) for every line of stream holding a JSON
+    object like {"title": ..., "content": ..., "date": "2016-04-22"}. The
+    date may be anything --since accepts and defaults to today. Lines that
+    cannot be read are skipped with a warning.
+    '''
+    today = datetime.date.today()
+    for lineno, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            title = record.get('title') or ''
+            content = record.get('content') or ''
+            date = record.get('date')
+            day = datetime.date.fromordinal(date_bound(date)) if date else today
+        except (ValueError, AttributeError) as e:
+            log.warning('Skipping line %d of %s: %s', lineno, name, e)
+            continue
+        yield (title, day, content.encode('utf-8'))
+
+
+def read_source(source, fmt='auto'):
+    '''
+    :param source: directory, tar archive or JSON Lines file; '-' reads
+    JSON Lines from stdin
+    :param fmt: one of FORMATS; 'auto' tells them apart by looking at source
+    :returns: generator of (title, datetime.date, content) tuples
+    '''
+    if fmt == 'auto':
+        import tarfile
+        if source == '-':
+            fmt = 'jsonl'
+        elif os.path.isdir(source):
+            fmt = 'dir'
+        elif tarfile.is_tarfile(source):
+            fmt = 'tar'
+        else:
+            fmt = 'jsonl'
+
+    if fmt == 'dir':
+        return read_directory(source)
+    if fmt == 'tar':
+        return read_tar(source)
+    if source == '-':
+        return read_jsonl(sys.stdin)
+    return _read_jsonl_file(source)
+
+
+def _read_jsonl_file(source):
+    with open(source, 'r', encoding='utf-8') as stream:
+        yield from read_jsonl(stream, source)
+
+
+def import_notes(sb, source, fmt='auto', workers=None, batch_size=256):
+    '''
+    Create a note in Snotebook sb for every note in source. Notes are named
+    the way new_note names them, dated by the date in their filename, their
+    JSON date or their modification time, and start with the notebook
+    template. Names already taken get a number appended to the title.
+
+    Notes are written in batches by a pool of threads, and the note index is
+    refreshed once at the end rather than after every note.
+
+    :param source: see read_source
+    :param workers: number of writer threads
+    :returns: number of notes imported
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    template = sb.compiled_template
+    # with fsync = full, directories are flushed once at the end
+    fsync = 'file' if sb._fsync == 'full' else sb._fsync
+    taken = set()
+    directories = set()
+
+    def note_path(title, day):
+        directory = sb._new_note_dir(day)
+        directories.add(directory)
+        path = os.path.join(directory, sb._note_name(title, day))
+        number = 1
+        while path in taken or os.path.exists(path):
+            number += 1
+            path = os.path.join(directory, sb._note_name(
+                '{} {}'.format(title, number), day))
+        taken.add(path)
+        return path
+
+    def write(item):
+        path, header, content = item
+        if callable(content):
+            content = content()
+        lib.write_note(path, header + content, fsync=fsync)
+        return 1
+
+    imported = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = list()
+        for title, day, content in read_source(source, fmt):
+            title = title or sb.default_title
+            header = sb.render_template(title, day, template)
+            batch.append((note_path(title, day), header.encode('utf-8'),
+                          content))
+            if len(batch) >= batch_size:
+                imported += sum(pool.map(write, batch))
+                batch = list()
+        imported += sum(pool.map(write, batch))
+
+    if sb._fsync == 'full':
+        for directory in directories:
+            lib.fsync_dir(directory)
+    if sb.index:
+        sb.index.refresh()
+    log.info('Imported %d notes into %s', imported, sb.name)
+    return imported
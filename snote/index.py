@@ -0,0 +1,1002 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Persistent per-notebook metadata index'''
+
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+import math
+import heapq
+import functools
+import threading
+from collections import Counter
+from array import array
+from stat import S_ISREG
+from . import lib, fuzzy, frontmatter
+from .records import (NoteRecord, creation_time, date_ordinal)
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = '.snote-index.sqlite'
+SCHEMA_VERSION = 9
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    date TEXT,
+    title TEXT,
+    ordinal INTEGER,
+    size INTEGER,
+    ctime REAL,
+    mtime_ns INTEGER,
+    digest TEXT,
+    length INTEGER DEFAULT 0,
+    title_length INTEGER DEFAULT 0,
+    has_postings INTEGER DEFAULT 1,
+    UNIQUE (dir, name)
+);
+CREATE INDEX IF NOT EXISTS notes_unposted ON notes (has_postings)
+    WHERE has_postings = 0;
+CREATE INDEX IF NOT EXISTS notes_name_nocase ON notes (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS notes_ctime ON notes (ctime);
+CREATE INDEX IF NOT EXISTS notes_mtime ON notes (mtime_ns);
+CREATE INDEX IF NOT EXISTS notes_ordinal ON notes (ordinal);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT,
+    note_id INTEGER,
+    positions BLOB,
+    PRIMARY KEY (term, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_note ON postings (note_id);
+CREATE TABLE IF NOT EXISTS trigrams (
+    gram TEXT,
+    note_id INTEGER,
+    PRIMARY KEY (gram, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trigrams_note ON trigrams (note_id);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT,
+    note_id INTEGER,
+    PRIMARY KEY (tag, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_note ON tags (note_id);
+CREATE TABLE IF NOT EXISTS title_terms (
+    term TEXT,
+    note_id INTEGER,
+    tf INTEGER,
+    PRIMARY KEY (term, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS title_terms_note ON title_terms (note_id);
+CREATE TABLE IF NOT EXISTS corpus (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    notes INTEGER,
+    length INTEGER,
+    title_length INTEGER
+);
+INSERT OR IGNORE INTO corpus VALUES (0, 0, 0, 0);
+CREATE TABLE IF NOT EXISTS stale (
+    dir TEXT,
+    name TEXT,
+    PRIMARY KEY (dir, name)
+) WITHOUT ROWID;
+'''
+
+COLUMNS = 'dir, name, date, title, ordinal, size, ctime, mtime_ns, digest'
+
+TOKEN = re.compile(r'\w+')
+PHRASE = re.compile(r'"([^"]*)"|(\S+)')
+
+# BM25 term frequency saturation and document length normalization, and
+# how much more a match in the title counts than one in the body
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 2.0
+
+# bytes per position in the postings blobs
+POSITION_SIZE = array('I').itemsize
+
+# notes longer than this are tokenized for their length but get no
+# postings, so that indexing a note takes memory bounded by this rather than
+# by the note; content searches read them instead
+MAX_POSTINGS_SIZE = 8 << 20
+
+# most characters read looking for the end of a note's frontmatter
+FRONTMATTER_SIZE = 1 << 16
+
+# characters besides word characters that may join text across chunks
+RUN_CHARS = frozenset('_#&/-')
+# bytes that may join a word or #tag to the text before them
+JOINING = re.compile(rb'[\w#&/\x80-\xff-]')
+FENCE_LINE = re.compile(rb'^(?:---|\.\.\.)[ \t]*\r?$', re.M)
+
+ORDER_BY = {
+    'name': 'name COLLATE NOCASE',
+    'last': 'ctime',
+    'mtime': 'mtime_ns',
+    'size': 'size',
+    'date': 'ordinal',
+}
+
+
+def is_note(entry):
+    '''
+    :param entry: os.DirEntry from a notebook directory
+    :returns: True if entry is a note rather than snote bookkeeping
+    '''
+    return not entry.name.startswith('.') and entry.is_file()
+
+
+def tokenize(text):
+    '''
+    :param text: str to split into search terms
+    :returns: list of lowercase word tokens in order of appearance
+    '''
+    return TOKEN.findall(text.lower())
+
+
+def parse_query(query):
+    '''
+    Split a content query into phrases. Double-quoted parts are kept
+    together as one phrase, every other word is a phrase of its own.
+
+    :returns: list of phrases, each a list of tokens
+    '''
+    phrases = list()
+    for quoted, word in PHRASE.findall(query):
+        tokens = tokenize(quoted or word)
+        if tokens:
+            phrases.append(tokens)
+    return phrases
+
+
+def scan_content(chunks, limit=None):
+    '''
+    Digest, tokenize and tag note content arriving as an iterable of bytes
+    chunks (see lib.iter_note), holding no more than a chunk of it at once.
+    Frontmatter is only recognised within the first FRONTMATTER_SIZE
+    characters.
+
+    :param limit: bytes of content past which no positions are kept,
+    MAX_POSTINGS_SIZE by default
+    :returns: tuple of (sha1 hex digest, number of tokens, dict of term to
+    array of token positions or None if content is longer than limit, set of
+    tags)
+    '''
+    import codecs
+
+    if limit is None:
+        limit = MAX_POSTINGS_SIZE
+    digest = hashlib.sha1()
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    positions = dict()
+    tags = set()
+    count = size = 0
+    partial = ''  # text possibly cut off at the end of the previous chunk
+    body = None
+    chunks = iter(chunks)
+    while True:
+        chunk = next(chunks, None)
+        if chunk is not None:
+            digest.update(chunk)
+            size += len(chunk)
+        text = partial + decoder.decode(chunk or b'', final=chunk is None)
+        if body is None:
+            if (chunk is not None and len(text) < FRONTMATTER_SIZE and
+                    ('---'.startswith(text) or text.startswith('---')) and
+                    not frontmatter.FENCE.match(text)):
+                partial = text  # wait for the end of the frontmatter
+                continue
+            fields, body = frontmatter.parse_frontmatter(text)
+            tags.update(frontmatter.field_tags(fields))
+        partial = ''
+        if chunk is not None:  # keep a word or tag that may go on
+            cut = len(text)
+            while cut and (text[cut - 1].isalnum() or
+                           text[cut - 1] in RUN_CHARS):
+                cut -= 1
+            partial = text[cut:]
+            text = text[:cut]
+        tags.update(frontmatter.hashtags(text, body))
+        body = 0
+        words = tokenize(text)
+        if positions is not None and size > limit:
+            positions = None
+        if positions is not None:
+            for idx, term in enumerate(words, count):
+                positions.setdefault(term, array('I')).append(idx)
+        count += len(words)
+        if chunk is None:
+            return (digest.hexdigest(), count, positions, tags)
+
+
+def runs_on(path, size, data):
+    '''
+    :returns: True if data, appended to the first size bytes of the note at
+    path, may join the word or #tag they end with or close frontmatter they
+    start, so that the note cannot be indexed from data alone
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if size and JOINING.match(data[:1]) and JOINING.match(
+                os.pread(fd, 1, size - 1)):
+            return True
+        return bool(os.pread(fd, 3, 0) == b'---' and FENCE_LINE.search(data))
+    finally:
+        os.close(fd)
+
+
+def date_clause(since=None, until=None):
+    '''
+    :returns: tuple of (SQL condition, parameters) restricting notes to the
+    date ordinals since and until, inclusive; either may be None
+    '''
+    conditions = list()
+    params = list()
+    if since is not None:
+        conditions.append('ordinal >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('ordinal <= ?')
+        params.append(until)
+    if conditions and since is None:
+        conditions.append('ordinal > 0')  # skip undated notes
+    return (' AND '.join(conditions), params)
+
+
+def tag_clause(clauses):
+    '''
+    :param clauses: list of (negated, set of tags) as returned by
+    frontmatter.parse_tag_query
+    :returns: tuple of (SQL condition, parameters) restricting notes to
+    those satisfying every clause, answered from the tags table alone
+    '''
+    conditions = list()
+    params = list()
+    for negated, tags in clauses:
+        conditions.append('id {}IN (SELECT note_id FROM tags WHERE tag IN '
+                          '({}))'.format('NOT ' if negated else '',
+                                         ', '.join('?' * len(tags))))
+        params.extend(sorted(tags))
+    return (' AND '.join(conditions), params)
+
+
+def parse_ranked_query(query):
+    '''
+    Split a ranked search query into parts: double-quoted phrases, words
+    ending in * that match every term they start, and single words. Words
+    made of several tokens, such as video-tapes, are phrases.
+
+    :returns: list of (kind, tokens) tuples, kind being one of 'term',
+    'prefix' and 'phrase'
+    '''
+    parts = list()
+    for quoted, word in PHRASE.findall(query):
+        tokens = tokenize(quoted or word)
+        if not tokens:
+            continue
+        if quoted or len(tokens) > 1:
+            parts.append(('phrase', tokens))
+        elif word.endswith('*'):
+            parts.append(('prefix', tokens))
+        else:
+            parts.append(('term', tokens))
+    return parts
+
+
+def bm25_idf(notes, matching):
+    '''
+    :returns: inverse document frequency of a term found in matching out of
+    notes notes
+    '''
+    return math.log(1 + (notes - matching + 0.5) / (matching + 0.5))
+
+
+def bm25_tf(frequency, length, average_length):
+    '''
+    :returns: saturated term frequency in a field of length tokens, where
+    the field averages average_length tokens
+    '''
+    norm = 1 - BM25_B + BM25_B * length / (average_length or 1)
+    return frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+
+
+def in_range(ordinal, since=None, until=None):
+    if since is None and until is None:
+        return True
+    return (ordinal > 0 and (since is None or ordinal >= since) and
+            (until is None or ordinal <= until))
+
+
+def content_matches(content, phrases):
+    '''
+    Linear fallback for notebooks without an index
+
+    :param content: note content as bytes
+    :param phrases: list of token lists as returned by parse_query
+    :returns: True if content contains every phrase
+    '''
+    return stream_matches([content], phrases)
+
+
+def stream_matches(chunks, phrases):
+    '''
+    Like content_matches, for content arriving as an iterable of bytes
+    chunks (see lib.iter_note), so that notes are never held in memory
+    whole. Stops reading as soon as every phrase was found.
+    '''
+    import codecs
+
+    wanted = [' {} '.format(' '.join(phrase)) for phrase in phrases]
+    overlap = max([len(phrase) for phrase in phrases] or [1]) - 1
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    carried = list()  # last tokens of the previous chunk
+    partial = ''  # word possibly cut off at the end of the previous chunk
+    chunks = iter(chunks)
+    while wanted:
+        chunk = next(chunks, None)
+        text = partial + decoder.decode(chunk or b'', final=chunk is None)
+        partial = ''
+        if chunk is not None:
+            cut = re.search(r'\w+\Z', text)
+            if cut:
+                partial = cut.group()
+                text = text[:cut.start()]
+        tokens = carried + tokenize(text)
+        window = ' {} '.format(' '.join(tokens))
+        wanted = [phrase for phrase in wanted if phrase not in window]
+        if chunk is None:
+            break
+        carried = tokens[len(tokens) - overlap:] if overlap else []
+    return not wanted
+
+
+def synchronized(method):
+    '''
+    Run a NoteIndex method holding the instance lock, so that threads can
+    share one connection
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class NoteIndex(object):
+    """
+    SQLite index of note metadata stored inside the notebook directory.
+    An instance may be shared between threads: every statement runs under
+    one lock, and queries are read in full before their rows are yielded.
+    """
+
+    @staticmethod
+    def open(location, sharded=False, path=None):
+        '''
+        Open and refresh the index for the notebook at location
+
+        :param sharded: bool - True if notes live in YYYY/MM subdirectories
+        :param path: index database, defaults to INDEX_NAME in location;
+        ':memory:' keeps the index in memory only
+        :returns: NoteIndex, or None if the index cannot be used (e.g. the
+        notebook directory is read-only)
+        '''
+        try:
+            index = NoteIndex(location, sharded, path)
+            index.refresh()
+        except (sqlite3.Error, OSError) as e:
+            log.warning('Note index unavailable for %s: %s', location, e)
+            return None
+        return index
+
+    def __init__(self, location, sharded=False, path=None):
+        self._location = location
+        self._sharded = sharded
+        self._path = path or os.path.join(location, INDEX_NAME)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self._path, timeout=5,
+                                   check_same_thread=False)
+        # keep the journal file around between transactions; deleting it
+        # would bump the directory mtime and force a rescan every time
+        self._db.execute('PRAGMA journal_mode = TRUNCATE')
+        self._refreshed = dict()  # directory mtimes seen by this instance
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            log.debug('Rebuilding note index at %s', self._path)
+            self._db.executescript('DROP TABLE IF EXISTS stale;'
+                                   'DROP TABLE IF EXISTS corpus;'
+                                   'DROP TABLE IF EXISTS title_terms;'
+                                   'DROP TABLE IF EXISTS tags;'
+                                   'DROP TABLE IF EXISTS trigrams;'
+                                   'DROP TABLE IF EXISTS postings;'
+                                   'DROP TABLE IF EXISTS notes;'
+                                   'DROP TABLE IF EXISTS dirs;'
+                                   'DROP TABLE IF EXISTS meta;')
+            self._db.execute('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    @property
+    def location(self):
+        return self._location
+
+    @synchronized
+    def close(self):
+        self._db.close()
+
+    def _store(self, relpath, stat):
+        '''
+        Insert or update the metadata and postings of the note at relpath,
+        relative to the notebook directory. The note is read in chunks, see
+        scan_content.
+        '''
+        digest, length, positions, tags = scan_content(lib.iter_note(
+            os.path.join(self.location, relpath)))
+        dirname, name = os.path.split(relpath)
+        date, title = lib.parse_note_name(name)
+        has_postings = positions is not None
+        row = self._db.execute('SELECT id, length FROM notes WHERE dir = ? '
+                               'AND name = ?', (dirname, name)).fetchone()
+        if row:  # keep the id stable so postings stay attached
+            note_id, old_length = row
+            self._db.execute('UPDATE notes SET size = ?, ctime = ?, '
+                             'mtime_ns = ?, digest = ?, length = ?, '
+                             'has_postings = ? WHERE id = ?',
+                             (stat.st_size, creation_time(stat),
+                              stat.st_mtime_ns, digest, length, has_postings,
+                              note_id))
+            self._db.execute('UPDATE corpus SET length = length + ?',
+                             (length - old_length,))
+        else:
+            title_terms = Counter(tokenize(title))
+            title_length = sum(title_terms.values())
+            note_id = self._db.execute(
+                'INSERT INTO notes ({}, length, title_length, has_postings) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(COLUMNS),
+                (dirname, name, date, title, date_ordinal(name), stat.st_size,
+                 creation_time(stat), stat.st_mtime_ns, digest, length,
+                 title_length, has_postings)).lastrowid
+            self._db.executemany(
+                'INSERT INTO trigrams (gram, note_id) VALUES (?, ?)',
+                ((gram, note_id) for gram in fuzzy.trigrams(name)))
+            self._db.executemany(
+                'INSERT INTO title_terms (term, note_id, tf) VALUES (?, ?, ?)',
+                ((term, note_id, tf) for term, tf in title_terms.items()))
+            self._db.execute('UPDATE corpus SET notes = notes + 1, length = '
+                             'length + ?, title_length = title_length + ?',
+                             (length, title_length))
+
+        self._db.execute('DELETE FROM postings WHERE note_id = ?', (note_id,))
+        self._db.executemany(
+            'INSERT INTO postings (term, note_id, positions) VALUES (?, ?, ?)',
+            ((term, note_id, term_positions.tobytes()) for term,
+             term_positions in (positions or dict()).items()))
+        self._db.execute('DELETE FROM tags WHERE note_id = ?', (note_id,))
+        self._db.executemany(
+            'INSERT INTO tags (tag, note_id) VALUES (?, ?)',
+            ((tag, note_id) for tag in tags))
+
+    def _remove(self, relpath):
+        dirname, name = os.path.split(relpath)
+        row = self._db.execute('SELECT id, length, title_length FROM notes '
+                               'WHERE dir = ? AND name = ?',
+                               (dirname, name)).fetchone()
+        if row is None:
+            return
+        note_id, length, title_length = row
+        for table in ['postings', 'trigrams', 'tags', 'title_terms']:
+            self._db.execute('DELETE FROM {} WHERE note_id = ?'.format(table),
+                             (note_id,))
+        self._db.execute('DELETE FROM notes WHERE id = ?', (note_id,))
+        self._db.execute('UPDATE corpus SET notes = notes - 1, length = '
+                         'length - ?, title_length = title_length - ?',
+                         (length, title_length))
+
+    def _directories(self):
+        '''
+        :returns: list of directories holding notes, relative to the
+        notebook directory: the notebook itself, plus its YYYY/MM shards if
+        the notebook is sharded
+        '''
+        directories = ['']
+        if self._sharded:
+            directories.extend(shard for _, _, shard in
+                               lib.list_shards(self.location))
+        return directories
+
+    def _rescan(self, dirname):
+        '''
+        Re-read the entries of one directory whose size or mtime changed
+
+        :returns: tuple of (changed, removed) counts
+        '''
+        known = dict(
+            (name, (size, mtime_ns)) for name, size, mtime_ns in
+            self._db.execute('SELECT name, size, mtime_ns FROM notes '
+                             'WHERE dir = ?', (dirname,)))
+
+        changed = list()
+        for entry in os.scandir(os.path.join(self.location, dirname)):
+            if not is_note(entry):
+                continue
+            stat = entry.stat()
+            if known.pop(entry.name, None) != (stat.st_size, stat.st_mtime_ns):
+                changed.append((os.path.join(dirname, entry.name), stat))
+
+        for name in known:
+            self._remove(os.path.join(dirname, name))
+        for relpath, stat in changed:
+            self._store(relpath, stat)
+        return (len(changed), len(known))
+
+    @synchronized
+    def refresh(self, force=False):
+        '''
+        Bring the index up to date with the notebook directory. A directory
+        is not rescanned unless its mtime changed since the last refresh,
+        and only entries whose size or mtime changed are re-read, along with
+        notes marked by invalidate.
+
+        :param force: bool - True to rescan regardless of directory mtimes
+        :returns: bool - True if any directory was rescanned
+        '''
+        known = dict(self._db.execute('SELECT path, mtime_ns FROM dirs'))
+        rescanned = False
+
+        with self._db:
+            for dirname in self._directories():
+                dir_mtime = os.stat(os.path.join(self.location,
+                                                 dirname)).st_mtime_ns
+                self._refreshed[dirname] = dir_mtime
+                if not force and known.pop(dirname, None) == dir_mtime:
+                    continue
+                known.pop(dirname, None)
+                changed, removed = self._rescan(dirname)
+                # recorded as read before the scan, so that changes made
+                # during the scan trigger another one next time
+                self._db.execute('INSERT OR REPLACE INTO dirs (path, '
+                                 'mtime_ns) VALUES (?, ?)',
+                                 (dirname, dir_mtime))
+                rescanned = True
+                log.debug('Note index refreshed %r: %d changed, %d removed',
+                          dirname, changed, removed)
+
+            for dirname in known:  # shards that no longer exist
+                for (name,) in self._db.execute(
+                        'SELECT name FROM notes WHERE dir = ?',
+                        (dirname,)).fetchall():
+                    self._remove(os.path.join(dirname, name))
+                self._db.execute('DELETE FROM dirs WHERE path = ?', (dirname,))
+                rescanned = True
+
+            for dirname, name in self._db.execute(
+                    'SELECT dir, name FROM stale').fetchall():
+                relpath = os.path.join(dirname, name)
+                try:
+                    stat = os.stat(os.path.join(self.location, relpath))
+                except FileNotFoundError:
+                    self._remove(relpath)
+                else:
+                    self._store(relpath, stat)
+                rescanned = True
+            self._db.execute('DELETE FROM stale')
+
+        return rescanned
+
+    @synchronized
+    def update(self, relpath):
+        '''
+        Re-index a single note after it has been written by snote. The
+        directory mtime is only carried forward if nothing else refreshed
+        the index since this instance did, otherwise the next refresh
+        rescans as usual.
+
+        :param relpath: path of the note relative to the notebook directory
+        '''
+        path = os.path.join(self.location, relpath)
+        dirname = os.path.dirname(relpath)
+        with self._db:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self._remove(relpath)
+                return
+            self._store(relpath, stat)
+            row = self._db.execute('SELECT mtime_ns FROM dirs WHERE path = ?',
+                                   (dirname,)).fetchone()
+            if row and row[0] == self._refreshed.get(dirname):
+                dir_mtime = os.stat(os.path.dirname(path)).st_mtime_ns
+                self._db.execute('UPDATE dirs SET mtime_ns = ? WHERE path = ?',
+                                 (dir_mtime, dirname))
+                self._refreshed[dirname] = dir_mtime
+
+    @synchronized
+    def invalidate(self, relpath):
+        '''
+        Mark the note at relpath to be re-read on the next refresh, without
+        rescanning its directory
+        '''
+        with self._db:
+            self._db.execute('INSERT OR IGNORE INTO stale (dir, name) VALUES '
+                             '(?, ?)', os.path.split(relpath))
+
+    @synchronized
+    def append(self, relpath, data, before, after):
+        '''
+        Index data appended to the note at relpath without reading the note:
+        its words are added to the postings after the note's last position,
+        its #tags to the note's tags, and the note's row gets the new stat
+        and no digest. The note is marked stale instead (see invalidate) if
+        the index did not hold it as it was before the append, if it is
+        compressed, or if data may run on from its last word, see runs_on.
+
+        :param data: bytes appended
+        :param before: os.stat_result of the note before the append
+        :param after: os.stat_result of the note after the append
+        :returns: bool - True if the index was updated from data
+        '''
+        dirname, name = os.path.split(relpath)
+        path = os.path.join(self.location, relpath)
+        row = self._db.execute('SELECT id, size, mtime_ns, length, '
+                               'has_postings FROM notes WHERE dir = ? AND '
+                               'name = ?', (dirname, name)).fetchone()
+        if (row is None or row[1:3] != (before.st_size, before.st_mtime_ns) or
+                lib.compression_of(name) or
+                runs_on(path, before.st_size, data)):
+            self.invalidate(relpath)
+            return False
+
+        note_id, _, _, length, has_postings = row
+        text = data.decode('utf-8', 'replace')
+        words = tokenize(text)
+        with self._db:
+            if has_postings and after.st_size > MAX_POSTINGS_SIZE:
+                self._db.execute('DELETE FROM postings WHERE note_id = ?',
+                                 (note_id,))
+                has_postings = False
+            if has_postings:
+                positions = dict()
+                for idx, term in enumerate(words, length):
+                    positions.setdefault(term, array('I')).append(idx)
+                for term, term_positions in positions.items():
+                    old = self._db.execute(
+                        'SELECT positions FROM postings WHERE term = ? AND '
+                        'note_id = ?', (term, note_id)).fetchone()
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO postings (term, note_id, '
+                        'positions) VALUES (?, ?, ?)',
+                        (term, note_id, (old[0] if old else b'') +
+                         term_positions.tobytes()))
+            self._db.executemany(
+                'INSERT OR IGNORE INTO tags (tag, note_id) VALUES (?, ?)',
+                ((tag, note_id) for tag in frontmatter.hashtags(text)))
+            self._db.execute('UPDATE notes SET size = ?, ctime = ?, '
+                             'mtime_ns = ?, digest = NULL, length = ?, '
+                             'has_postings = ? WHERE id = ?',
+                             (after.st_size, creation_time(after),
+                              after.st_mtime_ns, length + len(words),
+                              has_postings, note_id))
+            self._db.execute('UPDATE corpus SET length = length + ?',
+                             (len(words),))
+        return True
+
+    @synchronized
+    def apply(self, relpaths):
+        '''
+        Apply a batch of changes reported by a watcher: re-index the notes
+        at relpaths whose size or mtime changed, drop those that are gone,
+        and record the current mtimes of their directories so that the next
+        refresh does not rescan them. Only valid while every change to those
+        directories since the last refresh is being reported.
+
+        :param relpaths: paths of changed notes relative to the notebook
+        directory
+        :returns: tuple of (stored, removed) counts
+        '''
+        stored = removed = 0
+        dirnames = set()
+        with self._db:
+            for relpath in relpaths:
+                dirname, name = os.path.split(relpath)
+                dirnames.add(dirname)
+                if name.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.location, relpath))
+                except FileNotFoundError:
+                    stat = None
+                if stat is None or not S_ISREG(stat.st_mode):
+                    self._remove(relpath)
+                    removed += 1
+                    continue
+                known = self._db.execute('SELECT size, mtime_ns FROM notes '
+                                         'WHERE dir = ? AND name = ?',
+                                         (dirname, name)).fetchone()
+                if known != (stat.st_size, stat.st_mtime_ns):
+                    self._store(relpath, stat)
+                    stored += 1
+
+            for dirname in dirnames:
+                try:
+                    dir_mtime = os.stat(os.path.join(self.location,
+                                                     dirname)).st_mtime_ns
+                except FileNotFoundError:
+                    continue  # left for refresh to drop
+                self._db.execute('INSERT OR REPLACE INTO dirs (path, '
+                                 'mtime_ns) VALUES (?, ?)',
+                                 (dirname, dir_mtime))
+                self._refreshed[dirname] = dir_mtime
+        log.debug('Note index applied %d changes: %d stored, %d removed',
+                  len(relpaths), stored, removed)
+        return (stored, removed)
+
+    def _select(self, where='', params=(), order=None, reverse=False,
+                limit=None):
+        query = 'SELECT {} FROM notes'.format(COLUMNS)
+        if where:
+            query += ' WHERE ' + where
+        if order:
+            direction = ' DESC' if reverse else ''
+            query += ' ORDER BY {}{}, name{}'.format(ORDER_BY[order],
+                                                      direction, direction)
+        if limit:
+            query += ' LIMIT {:d}'.format(limit)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        for (dirname, name, date, title, ordinal, size, ctime, mtime_ns,
+             digest) in rows:
+            yield NoteRecord(os.path.join(self.location, dirname), name, size,
+                             ctime, mtime_ns, digest, date, title, ordinal)
+
+    def _by_id(self, ids, chunk_size=500):
+        '''
+        Yield notes for a collection of ids, in no particular order
+        '''
+        ids = list(ids)
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            marks = ', '.join('?' * len(chunk))
+            yield from self._select('id IN ({})'.format(marks), chunk)
+
+    def notes(self, sort='name', reverse=False, limit=0, since=None,
+              until=None, tags=None):
+        '''
+        Yield indexed notes ordered by sort (a key of ORDER_BY, or None for
+        no particular order), at most limit of them if limit is positive.
+        since and until restrict notes to a range of date ordinals
+        (inclusive), answered from the ordinal index.
+
+        :param tags: tag query clauses notes must satisfy, see tag_clause
+        '''
+        where, params = date_clause(since, until)
+        if tags:
+            tagged, tag_params = tag_clause(tags)
+            where = ' AND '.join(c for c in [where, tagged] if c)
+            params = list(params) + tag_params
+        return self._select(where, params, sort, reverse, limit)
+
+    def last(self):
+        '''
+        :returns: NoteRecord most recently created, or None if empty
+        '''
+        return next(self._select(order='last', reverse=True, limit=1), None)
+
+    def get(self, name):
+        '''
+        :returns: NoteRecord with the given filename, or None
+        '''
+        return next(self._select('name = ?', (name,)), None)
+
+    @synchronized
+    def _postings(self, term):
+        '''
+        :returns: dict of note id to array of positions of term
+        '''
+        postings = dict()
+        for note_id, blob in self._db.execute(
+                'SELECT note_id, positions FROM postings WHERE term = ?',
+                (term,)):
+            positions = array('I')
+            positions.frombytes(blob)
+            postings[note_id] = positions
+        return postings
+
+    def _phrase_ids(self, phrase):
+        '''
+        :returns: set of ids of notes containing the tokens of phrase
+        consecutively
+        '''
+        return set(self._phrase_counts(phrase))
+
+    def _phrase_counts(self, phrase):
+        '''
+        :returns: dict of id of the notes containing the tokens of phrase
+        consecutively to the number of times they do
+        '''
+        postings = [self._postings(term) for term in phrase]
+        candidates = set(postings[0])
+        for term_postings in postings[1:]:
+            candidates.intersection_update(term_postings)
+
+        if len(phrase) == 1:
+            return dict((note_id, len(postings[0][note_id]))
+                        for note_id in candidates)
+
+        matches = dict()
+        for note_id in candidates:
+            starts = set(postings[0][note_id])
+            for offset, term_postings in enumerate(postings[1:], 1):
+                starts.intersection_update(pos - offset for pos in
+                                           term_postings[note_id])
+                if not starts:
+                    break
+            if starts:
+                matches[note_id] = len(starts)
+        return matches
+
+    @synchronized
+    def _frequencies(self, kind, tokens):
+        '''
+        :param kind: kind of query part, see parse_ranked_query
+        :returns: tuple of dicts of note id to the number of times the part
+        occurs in the body and in the title of the note
+        '''
+        if kind == 'phrase':
+            body = self._phrase_counts(tokens)
+            candidates = None
+            for term in tokens:
+                ids = set(note_id for (note_id,) in self._db.execute(
+                    'SELECT note_id FROM title_terms WHERE term = ?', (term,)))
+                candidates = ids if candidates is None else candidates & ids
+            title = dict()
+            candidates = list(candidates)
+            for start in range(0, len(candidates), 500):
+                chunk = candidates[start:start + 500]
+                for note_id, note_title in self._db.execute(
+                        'SELECT id, title FROM notes WHERE id IN ({})'.format(
+                            ', '.join('?' * len(chunk))), chunk):
+                    words = tokenize(note_title)
+                    count = sum(1 for i in range(len(words) - len(tokens) + 1)
+                                if words[i:i + len(tokens)] == tokens)
+                    if count:
+                        title[note_id] = count
+            return (body, title)
+
+        if kind == 'prefix':
+            prefix = tokens[0]
+            end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            where, params = 'term >= ? AND term < ?', (prefix, end)
+        else:
+            where, params = 'term = ?', (tokens[0],)
+        body = dict(self._db.execute(
+            'SELECT note_id, sum(length(positions)) / {:d} FROM postings '
+            'WHERE {} GROUP BY note_id'.format(POSITION_SIZE, where), params))
+        title = dict(self._db.execute(
+            'SELECT note_id, sum(tf) FROM title_terms WHERE {} GROUP BY '
+            'note_id'.format(where), params))
+        return (body, title)
+
+    @synchronized
+    def ranked_search(self, query, limit=10, since=None, until=None):
+        '''
+        Score notes against query with BM25 over their titles and bodies,
+        using the note and corpus lengths stored as notes are indexed. Only
+        the postings of the terms in query are read, and the best limit
+        notes are picked with a heap. Notes too long for postings, see
+        MAX_POSTINGS_SIZE, are only matched by their titles.
+
+        :param query: str of words, "quoted phrases" and prefix* words; a
+        note matching any of them is scored
+        :param limit: number of notes to return, all matches if not positive
+        :returns: list of (score, NoteRecord), best match first
+        '''
+        parts = parse_ranked_query(query)
+        notes, length, title_length = self._db.execute(
+            'SELECT notes, length, title_length FROM corpus').fetchone()
+        if not parts or not notes:
+            return []
+
+        frequencies = [self._frequencies(kind, tokens)
+                       for kind, tokens in parts]
+        candidates = set()
+        for body, title in frequencies:
+            candidates.update(body)
+            candidates.update(title)
+
+        lengths = dict()
+        ordinals = dict()
+        candidates = list(candidates)
+        for start in range(0, len(candidates), 500):
+            chunk = candidates[start:start + 500]
+            for note_id, ordinal, note_length, note_title_length in \
+                    self._db.execute(
+                        'SELECT id, ordinal, length, title_length FROM notes '
+                        'WHERE id IN ({})'.format(', '.join('?' * len(chunk))),
+                        chunk):
+                if in_range(ordinal, since, until):
+                    lengths[note_id] = (note_length, note_title_length)
+                    ordinals[note_id] = ordinal
+
+        average = length / notes
+        average_title = title_length / notes
+        scores = dict.fromkeys(lengths, 0.0)
+        for body, title in frequencies:
+            idf = bm25_idf(notes, len(body))
+            for note_id, frequency in body.items():
+                if note_id in scores:
+                    scores[note_id] += idf * bm25_tf(
+                        frequency, lengths[note_id][0], average)
+            idf = TITLE_WEIGHT * bm25_idf(notes, len(title))
+            for note_id, frequency in title.items():
+                if note_id in scores:
+                    scores[note_id] += idf * bm25_tf(
+                        frequency, lengths[note_id][1], average_title)
+
+        def key(item):  # ties go to the later dated, then later indexed note
+            return (item[1], ordinals[item[0]], item[0])
+        if limit > 0:
+            best = heapq.nlargest(limit, scores.items(), key=key)
+        else:
+            best = sorted(scores.items(), key=key, reverse=True)
+        return [(score, next(self._select('id = ?', (note_id,))))
+                for note_id, score in best]
+
+    def content_search(self, query, since=None, until=None):
+        '''
+        Yield notes (ordered by name) whose content contains every word or
+        double-quoted phrase in query, optionally dated within since and
+        until (inclusive date ordinals). Notes too long for postings, see
+        MAX_POSTINGS_SIZE, are read.
+
+        :param query: str, e.g. 'video "return some"'; a query without any
+        words matches no notes
+        '''
+        phrases = parse_query(query)
+        if not phrases:
+            return
+        matches = None
+        for phrase in phrases:
+            ids = self._phrase_ids(phrase)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                break
+        notes = [note for note in self._by_id(matches or ())
+                 if in_range(note.ordinal, since, until)]
+        notes.extend(note for note in self._select('has_postings = 0')
+                     if in_range(note.ordinal, since, until) and
+                     stream_matches(lib.iter_note(note.path), phrases))
+        notes.sort(key=lambda n: n.name.lower())
+        yield from notes
+
+    @synchronized
+    def name_candidates(self, grams, minimum=None, since=None, until=None):
+        '''
+        Return notes (ordered by name) whose names contain at least minimum
+        of the trigrams in grams, all of them by default, optionally dated
+        within since and until (inclusive date ordinals)
+
+        :param grams: set of trigrams as returned by fuzzy.trigrams or
+        fuzzy.substring_grams
+        '''
+        grams = list(grams)
+        if minimum is None:
+            minimum = len(grams)
+        marks = ', '.join('?' * len(grams))
+        ids = [note_id for (note_id,) in self._db.execute(
+            'SELECT note_id FROM trigrams WHERE gram IN ({}) GROUP BY note_id '
+            'HAVING count(*) >= ?'.format(marks), grams + [minimum])]
+        notes = [note for note in self._by_id(ids)
+                 if in_range(note.ordinal, since, until)]
+        notes.sort(key=lambda n: n.name.lower())
+        return notes
+
+    @synchronized
+    def __len__(self):
+        return self._db.execute('SELECT count(*) FROM notes').fetchone()[0]
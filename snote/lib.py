@@ -4,8 +4,11 @@
 import os
 import re
 import sys
+import mmap
+import marshal
+import hashlib
 import logging
-import configparser
+import contextlib
 from .exceptions import ConfigError
 
 log = logging.getLogger(__name__)
@@ -18,37 +21,724 @@ DEFAULTS = {
     'timefmt': '%H:%M:%S',
     'timestamp': '\n{time}',
     'template': None,
-    'default_title': 'untitled'
+    'default_title': 'untitled',
+    'index': 'yes',
+    'fsync': 'file',
+    'edit': 'copy',
+    'layout': 'flat',
+    'compress': 'none',
+    'history': 'no'
 }
+LAYOUTS = ('flat', 'sharded')
+SHARD_YEAR = re.compile(r'^\d{4}$')
+SHARD_MONTH = re.compile(r'^\d{2}$')
+FSYNC_POLICIES = ('none', 'file', 'full')
+COMPRESSORS = ('none', 'gzip', 'zstd')
+COMPRESSED_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+BOOLEAN_STATES = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False
+}
+ENV_REFERENCE = re.compile(r'\$(\w+|\{[^}]*\})')
+CONFIG_CACHE_VERSION = 1
+_UNSET = object()
 
 
 def get_file_content(filepath):  # returns bytes
     '''
-    Load and return content of file object at filepath
+    Load and return content of file object at filepath, decompressed if the
+    note is stored compressed
 
     :param filepath: valid filepath as str
     :returns: as bytes object
     '''
     note = b''
+    if compression_of(filepath):
+        with open_note(filepath) as content:
+            return content.read()
     with open(filepath, 'r+b') as content:
         note = content.read()
     return note
 
 
-def write_note(filepath, note):  # write bytes
+def compression_of(filepath):
+    '''
+    :returns: 'gzip' or 'zstd' if filepath names a note stored compressed,
+    judging by its suffix, otherwise None
+    '''
+    for method, suffix in COMPRESSED_SUFFIXES.items():
+        if filepath.endswith(suffix):
+            return method
+    return None
+
+
+def strip_compression(name):
+    '''
+    :returns: name without a suffix of COMPRESSED_SUFFIXES
+    '''
+    method = compression_of(name)
+    if method:
+        return name[:-len(COMPRESSED_SUFFIXES[method])]
+    return name
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ConfigError('compress = zstd needs the zstandard package, '
+                          'pip install zstandard')
+    return zstandard
+
+
+def open_note(filepath):
+    '''
+    Open the note at filepath for reading, decompressing it on the fly if
+    it is stored compressed
+
+    :param filepath: valid filepath as str
+    :returns: binary file object
+    '''
+    method = compression_of(filepath)
+    if method == 'gzip':
+        import gzip
+        return gzip.open(filepath, 'rb')
+    if method == 'zstd':
+        import io
+        zstandard = _zstandard()
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(filepath, 'rb'), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    return open(filepath, 'rb')
+
+
+def iter_note(filepath, chunk_size=1 << 16):
+    '''
+    Yield the content of the note at filepath in chunks of bytes,
+    decompressed if it is stored compressed, without loading it whole
+    '''
+    with open_note(filepath) as content:
+        for chunk in iter(lambda: content.read(chunk_size), b''):
+            yield chunk
+
+
+def _write_compressed(fd, chunks, method):
+    '''
+    Compress an iterable of bytes chunks with method onto fd
+
+    :returns: number of bytes before compression
+    '''
+    if method == 'gzip':
+        import zlib
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = _zstandard().ZstdCompressor().compressobj()
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        _write_all(fd, compressor.compress(chunk))
+    _write_all(fd, compressor.flush())
+    return total
+
+
+def file_digest(filepath, limit=None, chunk_size=1 << 16):
+    '''
+    Stream the file at filepath through a hash without loading it whole;
+    compressed notes are hashed by their decompressed content
+
+    :param filepath: valid filepath as str
+    :param limit: only hash the first limit bytes if not None
+    :returns: hex digest as str
+    '''
+    digest = hashlib.sha1()
+    remaining = limit
+    with open_note(filepath) as content:
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size,
+                                                            remaining)
+            chunk = content.read(size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def get_scratch_dir():
+    '''
+    :returns: directory for editor scratch files as str, preferring the
+    (usually memory backed) XDG_RUNTIME_DIR
+    '''
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return runtime_dir
+    import tempfile
+    return tempfile.gettempdir()
+
+
+def copy_fd(src_fd, dst_fd, offset=0):
+    '''
+    Copy everything from offset in src_fd to the current position of dst_fd,
+    in the kernel where possible (copy_file_range, then sendfile) and with
+    a buffered loop otherwise
+
+    :returns: number of bytes copied
+    '''
+    count = os.fstat(src_fd).st_size - offset
+    copied = 0
+    if count <= 0:
+        return copied
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - copied,
+                                       offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError as e:  # e.g. EXDEV on older kernels, ENOSYS
+            log.debug('copy_file_range unavailable: %s', e)
+
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, offset + copied,
+                                count - copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError as e:
+            log.debug('sendfile unavailable: %s', e)
+
+    os.lseek(src_fd, offset + copied, os.SEEK_SET)
+    for chunk in iter(lambda: os.read(src_fd, 1 << 16), b''):
+        _write_all(dst_fd, chunk)
+        copied += len(chunk)
+    return copied
+
+
+def copy_file(src_path, dst_fd, offset=0):
+    '''
+    Copy the file at src_path from offset onward to dst_fd, see copy_fd
+
+    :returns: number of bytes copied
+    '''
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        return copy_fd(src_fd, dst_fd, offset)
+    finally:
+        os.close(src_fd)
+
+
+def copy_note(src_path, dst_fd):
+    '''
+    Copy the content of the note at src_path to dst_fd, decompressing it
+    if it is stored compressed, see copy_file
+
+    :returns: number of bytes copied
     '''
-    Writes to filepath with the content of note
+    if not compression_of(src_path):
+        return copy_file(src_path, dst_fd)
+    copied = 0
+    for chunk in iter_note(src_path):
+        _write_all(dst_fd, chunk)
+        copied += len(chunk)
+    return copied
+
+
+def grep_file(filepath, pattern):
+    '''
+    Search the content of filepath for pattern without reading it into
+    memory; the file is memory-mapped and only matching lines are copied.
+    Compressed notes are decompressed a line at a time instead.
 
     :param filepath: valid filepath as str
-    :param note: str representation of content to write
+    :param pattern: compiled bytes regular expression
+    :returns: list of (line number, line as bytes) tuples
+    '''
+    matches = list()
+    if compression_of(filepath):
+        with open_note(filepath) as content:
+            for lineno, line in enumerate(content, 1):
+                if pattern.search(line):
+                    matches.append((lineno, line.rstrip(b'\n')))
+        return matches
+
+    with open(filepath, 'rb') as content:
+        try:
+            mm = mmap.mmap(content.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files cannot be mapped
+            return matches
+        with mm:
+            lineno = 1
+            counted = 0
+            line_end = -1
+            for match in pattern.finditer(mm):
+                start = match.start()
+                if start <= line_end:
+                    continue  # already reported this line
+                line_start = mm.rfind(b'\n', 0, start) + 1
+                lineno += mm[counted:line_start].count(b'\n')
+                counted = line_start
+                line_end = mm.find(b'\n', start)
+                if line_end < 0:
+                    line_end = len(mm)
+                matches.append((lineno, mm[line_start:line_end]))
+    return matches
+
+
+def grep_files(filepaths, pattern, flags=re.I):
     '''
-    with open(filepath, 'w+b') as content:
-        content.write(note)
+    Worker for parallel grep, compiles pattern once per batch
+
+    :param filepaths: list of valid filepaths as str
+    :param pattern: regular expression as str
+    :returns: list of (filepath, line number, line as bytes) tuples
+    '''
+    compiled = re.compile(pattern.encode('utf-8'), flags)
+    return [(filepath, lineno, line) for filepath in filepaths
+            for lineno, line in grep_file(filepath, compiled)]
+
+
+def parse_note_name(name):
+    '''
+    Split a note filename of the form {date}-{title}.{ext} into its parts
+
+    :param name: note filename as str, possibly with a suffix of
+    COMPRESSED_SUFFIXES after the extension
+    :returns: tuple of (date, title) as str
+    '''
+    name = strip_compression(name)
+    date = '.'.join(name.split('-')[0:3])  # separate date
+    title = ' '.join(name.split('-')[3:])  # remove hyphens
+    title = title.split('.')
+    if len(title) > 1:
+        title = title[0:-1]  # remove extension if there is one
+    title = ''.join(title)
+    return (date, title)
+
+
+def shard_path(year, month):
+    '''
+    :returns: path of the YYYY/MM shard of a sharded notebook, relative to
+    the notebook directory
+    '''
+    return os.path.join('{:04d}'.format(year), '{:02d}'.format(month))
+
+
+def list_shards(location):
+    '''
+    List the YYYY/MM shard directories of a sharded notebook, newest first
+
+    :param location: notebook directory
+    :returns: list of (year, month, relative path) tuples
+    '''
+    shards = list()
+    for year in os.scandir(location):
+        if not (SHARD_YEAR.match(year.name) and year.is_dir()):
+            continue
+        for month in os.scandir(year.path):
+            if SHARD_MONTH.match(month.name) and month.is_dir():
+                shards.append((int(year.name), int(month.name),
+                               shard_path(int(year.name), int(month.name))))
+    shards.sort(reverse=True)
+    return shards
+
+
+def fsync_dir(dirpath):
+    '''
+    Flush directory metadata (new or renamed entries) of dirpath to disk
+    '''
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:  # e.g. platforms that cannot open directories
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _holds(fd, content, chunk_size=1 << 16):
+    '''
+    :returns: True if the file open at fd starts with content, read in
+    chunks of chunk_size
+    '''
+    view = memoryview(content)
+    for offset in range(0, len(content), chunk_size):
+        chunk = view[offset:offset + chunk_size]
+        if os.pread(fd, len(chunk), offset) != chunk:
+            return False
+    return True
+
+
+def write_note(filepath, note, previous=None, fsync='file'):  # write bytes
+    '''
+    Writes to filepath with the content of note.
+
+    If previous (the content the note had when it was read) is a prefix of
+    note and the file still holds exactly previous, only the appended delta
+    is written. Otherwise note is written to a temporary file next to filepath
+    and moved over it, so that a crash never leaves a truncated note.
+    Notes with a suffix of COMPRESSED_SUFFIXES are compressed, and always
+    rewritten whole.
+
+    :param filepath: valid filepath as str
+    :param note: bytes representation of content to write
+    :param previous: bytes the note had before editing, or None
+    :param fsync: 'none', 'file' to flush the note, or 'full' to also flush
+    the directory entry
+    :returns: number of bytes written
+    '''
+    _check_fsync(fsync)
+    method = compression_of(filepath)
+    if method:
+        _replace_file(filepath,
+                      lambda fd: _write_compressed(fd, [note], method), fsync)
+        log.info('Note saved')
+        return len(note)
+
+    if (previous is not None and len(note) > len(previous) and
+            note.startswith(previous)):
+        try:
+            fd = os.open(filepath, os.O_RDWR | os.O_APPEND)
+        except FileNotFoundError:
+            fd = None
+        if fd is not None:
+            try:
+                with locked(fd):
+                    # a rewrite to the same length must not get the delta
+                    if (os.fstat(fd).st_size == len(previous) and
+                            _holds(fd, previous)):
+                        _write_all(fd, note[len(previous):])
+                        if fsync != 'none':
+                            os.fsync(fd)
+                        log.info('Note saved')
+                        return len(note) - len(previous)
+            finally:
+                os.close(fd)
+        log.debug('Note changed on disk, rewriting it')
+
+    _replace_file(filepath, lambda fd: _write_all(fd, note), fsync)
+    log.info('Note saved')
+    return len(note)
+
+
+def install_edit(filepath, edited_path, fsync='file', size=None):
+    '''
+    Save an edited copy of the note at filepath back over it without loading
+    either into memory. Both files are compared by streaming hashes: if the
+    edit only appended to the note, the appended bytes are copied onto its
+    end, under the lock append_note takes and after anything appended to
+    the note since the copy was made; otherwise the note is atomically
+    replaced with a copy of the edit. Compressed notes are compared by their
+    decompressed content and are replaced with a compressed copy of the
+    edit.
+
+    :param filepath: valid filepath of the note as str
+    :param edited_path: valid filepath of the edited copy as str
+    :param fsync: see write_note
+    :param size: size of the note when the copy was made, its current size
+    if None
+    :returns: number of bytes written, 0 if the content is unchanged
+    '''
+    _check_fsync(fsync)
+    edited_size = os.stat(edited_path).st_size
+    method = compression_of(filepath)
+    if method:
+        if file_digest(edited_path) == file_digest(filepath):
+            return 0
+        _replace_file(filepath, lambda fd: _write_compressed(
+            fd, iter_note(edited_path), method), fsync)
+        log.info('Note saved')
+        return edited_size
+
+    if size is None:
+        size = os.stat(filepath).st_size
+
+    prefix = file_digest(edited_path, limit=size)
+    if edited_size >= size and prefix == file_digest(filepath, limit=size):
+        if edited_size == size:
+            return 0
+        fd = os.open(filepath, os.O_WRONLY | os.O_APPEND)
+        try:
+            with locked(fd):
+                current = os.fstat(fd).st_size
+                if current == size or (current > size and prefix ==
+                                       file_digest(filepath, limit=size)):
+                    written = copy_file(edited_path, fd, offset=size)
+                    if fsync != 'none':
+                        os.fsync(fd)
+                    log.info('Note saved')
+                    return written
+        finally:
+            os.close(fd)
+        log.debug('Note changed on disk, rewriting it')
+
+    _replace_file(filepath, lambda fd: copy_file(edited_path, fd), fsync)
     log.info('Note saved')
+    return edited_size
+
+
+def compress_note(filepath, method, fsync='file'):
+    '''
+    Replace the uncompressed note at filepath with a copy compressed by
+    method, named with the matching suffix of COMPRESSED_SUFFIXES
+
+    :returns: path of the compressed note
+    '''
+    _check_fsync(fsync)
+    compressed_path = filepath + COMPRESSED_SUFFIXES[method]
+    if os.path.exists(compressed_path):
+        raise FileExistsError(compressed_path)
+    _replace_file(compressed_path, lambda fd: _write_compressed(
+        fd, iter_note(filepath), method), fsync)
+    os.unlink(filepath)
+    if fsync == 'full':
+        fsync_dir(os.path.dirname(filepath) or os.curdir)
+    return compressed_path
+
+
+@contextlib.contextmanager
+def locked(fd):
+    '''
+    Hold an exclusive advisory lock (flock) on fd, where the platform has
+    one, so that snote processes writing the same note take turns
+    '''
+    try:
+        import fcntl
+    except ImportError:  # e.g. Windows
+        yield
+        return
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def append_note(filepath, data, fsync='file', appended=None):
+    '''
+    Append data to the note at filepath through O_APPEND under an exclusive
+    lock, so that concurrent appends never interleave or get lost, and
+    appends racing with a writer replacing the note land in the new file.
+    Compressed notes get data appended as a compressed member or frame of
+    its own, which readers decompress as part of the note.
+
+    :param filepath: valid filepath of an existing note as str
+    :param data: bytes to append
+    :param fsync: see write_note
+    :param appended: called as appended(before, after) with the
+    os.stat_result of the note before and after the append, while the lock
+    is still held
+    :returns: number of bytes written
+    '''
+    _check_fsync(fsync)
+    method = compression_of(filepath)
+    while True:
+        fd = os.open(filepath, os.O_WRONLY | os.O_APPEND)
+        try:
+            with locked(fd):
+                # a writer that replaced the note while we waited for the
+                # lock has left us holding the old file; start over
+                before = os.fstat(fd)
+                if before.st_ino != os.stat(filepath).st_ino:
+                    continue
+                if method:
+                    _write_compressed(fd, [data], method)
+                else:
+                    _write_all(fd, data)
+                if fsync != 'none':
+                    os.fsync(fd)
+                if appended is not None:
+                    appended(before, os.fstat(fd))
+                return len(data)
+        except FileNotFoundError:
+            continue  # replaced and gone between fstat and stat; retry
+        finally:
+            os.close(fd)
+
+
+def _check_fsync(fsync):
+    if fsync not in FSYNC_POLICIES:
+        raise ConfigError('fsync must be one of {}'.format(
+            ', '.join(FSYNC_POLICIES)))
+
+
+def _replace_file(filepath, write, fsync):
+    '''
+    Atomically replace filepath with a file filled by write(fd), through a
+    hidden temporary file in the same directory
+    '''
+    dirpath, basename = os.path.split(filepath)
+    tmp_path = os.path.join(dirpath, '.{}.{}.snote-tmp'.format(
+        basename, os.urandom(4).hex()))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        old_fd = os.open(filepath, os.O_RDONLY)
+    except FileNotFoundError:
+        old_fd = None  # new note, keep the umask applied by os.open
+    try:
+        if old_fd is not None:
+            os.fchmod(fd, os.fstat(old_fd).st_mode & 0o7777)
+        write(fd)
+        if fsync != 'none':
+            os.fsync(fd)
+        os.close(fd)
+        fd = None
+        if old_fd is None:
+            os.replace(tmp_path, filepath)
+        else:  # appenders holding the lock finish before the swap
+            with locked(old_fd):
+                os.replace(tmp_path, filepath)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    finally:
+        if old_fd is not None:
+            os.close(old_fd)
+    if fsync == 'full':
+        fsync_dir(dirpath or os.curdir)
 
 
-def get_config(envvar='SNOTE'):
+class Config(object):
+    """
+    Read-only view of the parsed configuration, with global defaults already
+    applied to every section. Mirrors the subset of ConfigParser used by
+    snote, so it can be rebuilt from the config cache without configparser.
+    """
 
+    def __init__(self, sections):
+        self._sections = dict(sections)
+        self._order = [name for name, _ in sections]
+
+    def sections(self):
+        return list(self._order)
+
+    def has_section(self, section):
+        return section in self._sections
+
+    def get(self, section, option, fallback=_UNSET):
+        try:
+            return self._sections[section][option]
+        except KeyError:
+            if fallback is _UNSET:
+                raise ConfigError('No option \'{}\' in section \'{}\''.format(
+                    option, section))
+            return fallback
+
+    def getboolean(self, section, option, fallback=_UNSET):
+        value = self.get(section, option, fallback)
+        if isinstance(value, bool) or value is fallback:
+            return value
+        try:
+            return BOOLEAN_STATES[value.lower()]
+        except KeyError:
+            raise ValueError('Not a boolean: {}'.format(value))
+
+    def _dump(self):
+        return [(name, self._sections[name]) for name in self._order]
+
+
+def get_cache_dir():
+    '''
+    :returns: directory for snote caches as str, honouring XDG_CACHE_HOME
+    '''
+    cache_home = os.getenv('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'snote')
+
+
+def _config_cache_path(config_path):
+    key = hashlib.sha1(os.path.abspath(config_path).encode('utf-8'))
+    return os.path.join(get_cache_dir(),
+                        'config-{}.marshal'.format(key.hexdigest()[:16]))
+
+
+def _load_config_cache(config_path, stat):
+    '''
+    :returns: Config from the cache if it is still valid for the file at
+    config_path and the current environment, otherwise None
+    '''
+    try:
+        with open(_config_cache_path(config_path), 'rb') as cache:
+            cached = marshal.load(cache)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if (cached.get('version') != CONFIG_CACHE_VERSION or
+            cached.get('defaults') != DEFAULTS or
+            cached.get('path') != os.path.abspath(config_path) or
+            cached.get('mtime_ns') != stat.st_mtime_ns or
+            cached.get('size') != stat.st_size):
+        return None
+    for var, value in cached['env'].items():
+        if os.getenv(var) != value:
+            return None
+    return Config(cached['sections'])
+
+
+def _save_config_cache(config_path, stat, env, config):
+    cache_path = _config_cache_path(config_path)
+    cached = {
+        'version': CONFIG_CACHE_VERSION,
+        'defaults': DEFAULTS,  # options added by newer versions
+        'path': os.path.abspath(config_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'env': env,
+        'sections': config._dump()
+    }
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = '{}.{}'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as cache:
+            marshal.dump(cached, cache)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.debug('Could not write config cache: %s', e)
+
+
+def parse_config(cfg_txt):
+    '''
+    Parse configuration text, with environment variables already expanded
+
+    :returns: Config
+    '''
+    import configparser
+    config = configparser.ConfigParser(defaults=DEFAULTS,
+                                       default_section='global',
+                                       interpolation=None,
+                                       allow_no_value=True)
+    config.read_string(cfg_txt)
+    return Config([(section, dict(config.items(section)))
+                   for section in config.sections()])
+
+
+def get_config(envvar='SNOTE', cache=True):
+    '''
+    Load the configuration file named by environment variable envvar.
+
+    Parsed configurations are cached in get_cache_dir(), keyed on the path,
+    mtime and size of the file and on the values of the environment
+    variables it references, so the INI is only parsed when one changes.
+
+    :param cache: bool - False to always parse the file
+    :returns: Config
+    '''
     config_path = os.getenv(envvar, None)
 
     if config_path and os.path.exists(config_path):
@@ -56,14 +746,23 @@ def get_config(envvar='SNOTE'):
     else:
         raise FileNotFoundError(config_path)
 
-    config = configparser.ConfigParser(defaults=DEFAULTS,
-                                       default_section='global',
-                                       interpolation=None,
-                                       allow_no_value=True)
+    stat = os.stat(config_path)
+    if cache:
+        config = _load_config_cache(config_path, stat)
+        if config is not None:
+            return config
 
     with open(config_path, 'r') as cfg:
-        cfg_txt = os.path.expandvars(cfg.read())
+        raw_txt = cfg.read()
+    cfg_txt = os.path.expandvars(raw_txt)
 
-    config.read_string(cfg_txt)
+    config = parse_config(cfg_txt)
+
+    if cache:
+        env = dict()
+        for reference in ENV_REFERENCE.findall(raw_txt):
+            var = reference.strip('{}')
+            env[var] = os.getenv(var)
+        _save_config_cache(config_path, stat, env, config)
 
     return config
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Listing and searching across every configured notebook'''
+
+import sys
+import heapq
+import logging
+from . import lib
+from .snotebook import (Snotebook, SORT_KEYS)
+from .exceptions import (ConfigError, NotebookError, NoteNotFoundError)
+
+log = logging.getLogger(__name__)
+
+
+def collect_notes(notebook, search_term=None, content=False, limit=0):
+    '''
+    Worker listing (or searching, if search_term is given) one notebook
+
+    :returns: tuple of (notebook, rows, error) where rows is a list of
+    (sort key, notebook, date, title) ordered newest first by note date, see
+    SORT_KEYS, and error is a message if the notebook could not be read
+    '''
+    key = SORT_KEYS['date']
+    try:
+        sb = Snotebook.get_snotebook(notebook)
+        if search_term is None:
+            notes = sb._list_notes('date', reverse=True, limit=limit)
+        elif content:
+            notes = sb._search_content(search_term)
+        else:
+            notes = sb._search_notes(search_term)
+    except NoteNotFoundError:
+        return (notebook, [], None)
+    except (NotebookError, ConfigError) as e:
+        return (notebook, [], str(e))
+
+    rows = [(key(note), notebook) + sb.display_note_info(note)
+            for note in notes]
+    rows.sort(reverse=True)
+    if limit > 0:
+        del rows[limit:]
+    return (notebook, rows, None)
+
+
+def iter_all_notes(search_term=None, content=False, limit=0, workers=None):
+    '''
+    Scan every configured notebook concurrently in a process pool.
+
+    Without a limit, each notebook's rows are yielded as soon as that
+    notebook is done. With a limit, the newest limit rows across all
+    notebooks are kept on a bounded heap and yielded once at the end.
+
+    :returns: generator of lists of (sort key, notebook, date, title)
+    '''
+    from concurrent.futures import (ProcessPoolExecutor, as_completed)
+
+    notebooks = lib.get_config().sections()
+    heap = list()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(collect_notes, notebook, search_term, content,
+                               limit) for notebook in notebooks]
+        for future in as_completed(pending):
+            notebook, rows, error = future.result()
+            if error:
+                log.warning('Skipping notebook %s: %s', notebook, error)
+            elif limit <= 0:
+                yield rows
+            else:
+                for row in rows:
+                    if len(heap) < limit:
+                        heapq.heappush(heap, row)
+                    elif row > heap[0]:
+                        heapq.heapreplace(heap, row)
+
+    if limit > 0:
+        yield sorted(heap, reverse=True)
+
+
+def show_all_notes(search_term=None, content=False, limit=0, workers=None):
+    note_name = '{:<16}{:<12}{:<50}\n'
+    found = False
+    stream = sys.stdout
+    stream.write(note_name.format('Notebook', 'Date', 'Title'))
+    stream.write('{:=^78}\n'.format(''))
+    for rows in iter_all_notes(search_term, content, limit, workers):
+        for _, notebook, date, title in rows:
+            found = True
+            stream.write(note_name.format(notebook, date, title))
+        stream.flush()
+
+    if search_term is not None and not found:
+        log.info('No note matching \'%s\' found in any notebook', search_term)
+        sys.exit(1)
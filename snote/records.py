@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compact per-note records'''
+
+import os
+import sys
+import datetime
+from . import lib
+
+
+def creation_time(stat):
+    '''
+    :returns: birthtime where the platform provides it, otherwise ctime
+    '''
+    try:
+        return stat.st_birthtime
+    except AttributeError:
+        return stat.st_ctime
+
+
+def date_ordinal(name):
+    '''
+    :param name: note filename starting with a %Y-%m-%d date
+    :returns: proleptic Gregorian ordinal of the date as int, or 0 if name
+    does not start with one
+    '''
+    try:
+        year, month, day = name.split('-', 3)[:3]
+        return datetime.date(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        return 0
+
+
+def date_bound(value):
+    '''
+    Parse a --since/--until argument: a %Y-%m-%d date, 'today',
+    'yesterday', or a number of days or weeks ago such as '3d' or '2w'
+
+    :returns: date ordinal as int
+    :raises: ValueError if value is none of these
+    '''
+    today = datetime.date.today().toordinal()
+    value = value.strip().lower()
+    if value == 'today':
+        return today
+    if value == 'yesterday':
+        return today - 1
+    if value[:-1].isdigit() and value[-1:] in ('d', 'w'):
+        return today - int(value[:-1]) * (7 if value[-1] == 'w' else 1)
+    year, month, day = value.split('-')
+    return datetime.date(int(year), int(month), int(day)).toordinal()
+
+
+def date_prefix(ordinal):
+    '''
+    :returns: the %Y-%m-%d filename prefix of notes dated ordinal
+    '''
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+
+class NoteRecord(object):
+    """
+    One note, with its filename parsed once into a display date, an interned
+    title and a date ordinal for sorting. Exposes name and path like
+    os.DirEntry. Stat fields are None unless they were requested when the
+    record was made.
+    """
+
+    __slots__ = ('location', 'name', 'date', 'title', 'ordinal', 'size',
+                 'ctime', 'mtime_ns', 'digest')
+
+    def __init__(self, location, name, size=None, ctime=None, mtime_ns=None,
+                 digest=None, date=None, title=None, ordinal=None):
+        if date is None or title is None:
+            date, title = lib.parse_note_name(name)
+        self.location = location
+        self.name = name
+        self.date = date
+        self.title = sys.intern(title)
+        self.ordinal = date_ordinal(name) if ordinal is None else ordinal
+        self.size = size
+        self.ctime = ctime
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+
+    @staticmethod
+    def from_entry(location, entry, stat=False):
+        '''
+        :param entry: os.DirEntry of the note
+        :param stat: bool - True to fill in size and times
+        '''
+        if not stat:
+            return NoteRecord(location, entry.name)
+        result = entry.stat()
+        return NoteRecord(location, entry.name, result.st_size,
+                          creation_time(result), result.st_mtime_ns)
+
+    @property
+    def path(self):
+        return os.path.join(self.location, self.name)
+
+    def __repr__(self):
+        return '<NoteRecord {!r}>'.format(self.name)
@@ -4,46 +4,48 @@
 import os
 import sys
 import re
-import datetime
-import subprocess
-import tempfile
+import heapq
+import bisect
 import logging
-import argparse
-from . import lib
-from .exceptions import (UnknownNotebookError, InvalidNotebookPathError)
+import threading
+from . import lib, fuzzy, frontmatter, templates
+from .timing import Timings
+from .index import (NoteIndex, is_note, in_range, parse_query,
+                    stream_matches)
+from .records import (NoteRecord, date_ordinal, date_prefix)
+from .exceptions import (ConfigError, NotebookError, UnknownNotebookError,
+                         InvalidNotebookPathError, NoteNotFoundError)
 
 log = logging.getLogger(__name__)
 
-
-class EditSnoteParser(argparse.ArgumentParser):
-
-    def __init__(self):
-        super(EditSnoteParser, self).__init__(add_help=False)
-        self.add_argument(
-            '-t',
-            '--timestamp',
-            action='store_true',
-            help='add a timestamp to the note'
-        )
-        self.add_argument(
-            '-f',
-            '--filename',
-            type=str,
-            default=None,
-            help='name a new note, or search for a note to update'
-        )
+# sort keys for NoteRecords scanned from the notebook directory
+SORT_KEYS = {
+    'name': lambda r: r.name.lower(),
+    'last': lambda r: r.ctime,
+    'mtime': lambda r: (r.mtime_ns, r.name.lower()),
+    'size': lambda r: (r.size, r.name.lower()),
+    'date': lambda r: (r.ordinal, r.name.lower()),
+}
+# sort keys that need stat results
+STAT_SORTS = frozenset(['last', 'mtime', 'size'])
+# notes listed by a ranked search unless limited otherwise
+RANKED_LIMIT = 10
 
 
 class Snotebook(object):
     """container class to simplify access to configuration settings"""
 
     @staticmethod
-    def get_snotebook(notebook):
+    def get_snotebook(notebook, timings=None):
         """
         Given the name of a configured Snotebook, returns Snotebook object
+
+        :param timings: optional Timings to record phases in
         """
+        timings = timings or Timings(enabled=False)
 
-        config = lib.get_config()
+        with timings.span('get_config'):
+            config = lib.get_config()
 
         if config.has_section(notebook):
             log.debug('Notebook %s exists', notebook)
@@ -66,14 +68,22 @@ class Snotebook(object):
             'timestamp': config.get(notebook, 'timestamp'),
             'template': config.get(notebook, 'template'),
             'max_list': config.get(notebook, 'max_list', fallback=-1),
-            'default_title': config.get(notebook, 'default_title')
+            'default_title': config.get(notebook, 'default_title'),
+            'index': config.getboolean(notebook, 'index'),
+            'fsync': config.get(notebook, 'fsync'),
+            'edit': config.get(notebook, 'edit'),
+            'layout': config.get(notebook, 'layout'),
+            'compress': config.get(notebook, 'compress'),
+            'history': config.getboolean(notebook, 'history')
         }
 
-        return Snotebook(**snotebook_cfg)
+        return Snotebook(timings=timings, **snotebook_cfg)
 
     def __init__(self, name, location, editor='vim', ext='md',
                  datefmt='%Y-%m-%d', timefmt='%H:%M:%S',
-                 timestamp='\n{time}', template=None, max_list=-1, default_title=None):
+                 timestamp='\n{time}', template=None, max_list=-1, default_title=None,
+                 index=False, fsync='file', edit='copy', layout='flat',
+                 compress='none', history=False, timings=None):
         self._name = name
         self._location = location
         self._editor = editor
@@ -84,6 +94,23 @@ class Snotebook(object):
         self._template = template
         self._max_list = max_list
         self._default_title = default_title
+        self._use_index = index
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._fsync = fsync
+        self._edit = edit
+        if layout not in lib.LAYOUTS:
+            raise ConfigError('layout must be one of {}'.format(
+                ', '.join(lib.LAYOUTS)))
+        self._layout = layout
+        if compress not in lib.COMPRESSORS:
+            raise ConfigError('compress must be one of {}'.format(
+                ', '.join(lib.COMPRESSORS)))
+        self._compress = compress
+        self._use_history = history
+        self._history = None
+        self.timings = timings or Timings(enabled=False)
+        self.remote = None  # daemon.DaemonClient answering lookups, if any
 
     @property
     def name(self):
@@ -101,16 +128,108 @@ class Snotebook(object):
     def ext(self):
         return self._ext
 
+    @property
+    def index(self):
+        '''
+        :returns: NoteIndex for the notebook if enabled and usable, or None
+        '''
+        if self._index is None and self._use_index:
+            with self._index_lock:  # opened once when shared by threads
+                if self._index is None and self._use_index:
+                    with self.timings.span('index'):
+                        self._index = NoteIndex.open(self.location,
+                                                     self.sharded)
+                    if self._index is None:
+                        # fall back to scanning from now on
+                        self._use_index = False
+        return self._index
+
+    @property
+    def history(self):
+        '''
+        :returns: NoteHistory of the notebook if enabled, or None
+        '''
+        if self._history is None and self._use_history:
+            from .history import NoteHistory
+            self._history = NoteHistory(self.location)
+        return self._history
+
+    def use_memory_index(self):
+        '''
+        Keep an index of the notebook in memory rather than in the notebook
+        directory, for long-running processes serving notebooks configured
+        with index = no
+        '''
+        with self.timings.span('index'):
+            self._index = NoteIndex.open(self.location, self.sharded,
+                                         ':memory:')
+        self._use_index = self._index is not None
+
+    def _remote(self, action, **params):
+        '''
+        Have the snote daemon, if connected, run action for this notebook
+
+        :returns: list of NoteRecords, or None if the lookup has to be done
+        in this process, which is also the case when the daemon found no
+        notes, in case its view of the notebook is out of date
+        '''
+        if self.remote is None:
+            return None
+        with self.timings.span('daemon'):
+            rows = self.remote.request(self.name, self.location, action,
+                                       **params)
+        if rows is not None:
+            root = os.path.join(os.path.realpath(self.location), '')
+            for row in rows:
+                if not os.path.join(os.path.realpath(row[0]), '').startswith(
+                        root):
+                    log.warning('snote daemon answered with notes in %s, '
+                                'outside notebook %s', row[0], self.location)
+                    rows = None
+                    break
+        if rows is None:
+            self.remote = None  # don't retry a daemon that failed once
+            return None
+        if not rows:
+            log.debug('snote daemon found no notes, looking again locally')
+            return None
+        return [NoteRecord(*row) for row in rows]
+
+    @property
+    def sharded(self):
+        return self._layout == 'sharded'
+
     @property
     def template(self):
         '''
         :returns: str representation of content in template file if configured,
-        or an empty str
+        with includes expanded, or an empty str
         '''
-        if self._template:
-            return lib.get_file_content(self._template).decode('utf-8')
-        else:
-            return ''
+        return self.compiled_template.source
+
+    @property
+    def compiled_template(self):
+        '''
+        :returns: templates.Template of the configured template file, compiled
+        only when the file or one it includes changed
+        '''
+        return templates.get_template(self._template)
+
+    def render_template(self, title, day=None, template=None):
+        '''
+        :param day: datetime.date of the note, defaults to today
+        :param template: templates.Template to render, the compiled template
+        by default
+        :returns: initial content as str of a note called title
+        '''
+        import datetime
+        if template is None:
+            template = self.compiled_template
+        return template.render(
+            TITLE=title,
+            DATE=day.strftime(self._datefmt) if day else self.date(),
+            TIME=datetime.datetime.now().strftime(self._timefmt),
+            NOTEBOOK=self._name)
 
     @property
     def max_list(self):
@@ -131,12 +250,14 @@ class Snotebook(object):
         '''
         :returns: str representation of invocation date according to _datefmt
         '''
+        import datetime
         return datetime.datetime.today().strftime(self._datefmt)
 
     def time(self):
         '''
         :returns: str representation of invocation time according to _timefmt
         '''
+        import datetime
         current_time = datetime.datetime.now().strftime(self._timefmt)
         timestamp = self._timestamp.format(time=current_time)
         return timestamp.encode('utf-8')
@@ -150,60 +271,281 @@ class Snotebook(object):
         :param timestamp: bool - True to add timestamp
         :returns: str of everything in the editor at exit
         '''
+        import subprocess
+        import tempfile
         with tempfile.NamedTemporaryFile(suffix='.{ext}'.format(ext=self.ext),
                                          prefix='snote_') as tf:
             tf.write(load_content)
             if timestamp:
                 tf.write(self.time())
             tf.flush()
-            subprocess.call([self.editor, tf.name])
+            with self.timings.span('call_writer'):
+                subprocess.call([self.editor, tf.name])
             tf.seek(0)  # hang tight until subprocess is done
             new_content = tf.read()
 
         return new_content
 
-    def get_note_path(self, filename=None):
+    def edit_note(self, full_notepath, timestamp):
+        '''
+        Opens an existing note with the configured editor and saves any
+        changes. By default the editor gets a scratch copy of the note made
+        by the kernel (see lib.copy_file), so the note is never read into
+        memory; with edit = inplace the editor opens the note itself while a
+        backup copy is kept until it exits cleanly. Compressed notes are
+        always edited through a decompressed scratch copy.
+
+        :param full_notepath: valid filepath of the note as str
+        :param timestamp: bool - True to add timestamp
+        :returns: bool - True if the note was changed
+        '''
+        if self._edit not in ('copy', 'inplace'):
+            raise ConfigError('edit must be one of copy, inplace')
+        self._record_baseline(full_notepath)
+        if self._edit == 'inplace' and not lib.compression_of(full_notepath):
+            return self._edit_in_place(full_notepath, timestamp)
+
+        import subprocess
+        import tempfile
+        fd, scratch_path = tempfile.mkstemp(
+            suffix='.{ext}'.format(ext=self.ext), prefix='snote_',
+            dir=lib.get_scratch_dir())
+        try:
+            try:
+                copied = lib.copy_note(full_notepath, fd)
+                if timestamp:
+                    os.write(fd, self.time())
+            finally:
+                os.close(fd)
+            self.timings.count('bytes_copied', copied)
+            before = os.stat(scratch_path)
+
+            with self.timings.span('call_writer'):
+                subprocess.call([self.editor, scratch_path])
+
+            after = os.stat(scratch_path)
+            if not timestamp and (after.st_size, after.st_mtime_ns) == (
+                    before.st_size, before.st_mtime_ns):
+                return False
+
+            with self.timings.span('write_note'):
+                written = lib.install_edit(full_notepath, scratch_path,
+                                           self._fsync, copied)
+                self.timings.count('bytes_written', written)
+                if written:
+                    self._note_written(full_notepath)
+            return bool(written)
+        finally:
+            os.unlink(scratch_path)
+
+    def _edit_in_place(self, full_notepath, timestamp):
+        import subprocess
+
+        head, tail = os.path.split(full_notepath)
+        backup_path = os.path.join(head, '.{}.snote-bak'.format(tail))
+        fd = os.open(backup_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            self.timings.count('bytes_copied', lib.copy_file(full_notepath, fd))
+        finally:
+            os.close(fd)
+
+        if timestamp:
+            fd = os.open(full_notepath, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, self.time())
+            finally:
+                os.close(fd)
+        before = os.stat(full_notepath)
+
+        with self.timings.span('call_writer'):
+            status = subprocess.call([self.editor, full_notepath])
+
+        if status != 0:
+            log.warning('Editor exited with status %d, backup kept at %s',
+                        status, backup_path)
+        else:
+            os.unlink(backup_path)
+
+        after = os.stat(full_notepath)
+        changed = timestamp or (after.st_size, after.st_mtime_ns) != (
+            before.st_size, before.st_mtime_ns)
+        if changed:
+            self._note_written(full_notepath)
+        return changed
+
+    def get_note_path(self, filename=None, select=True):
         '''
         Return path to the most recently modified note in notebook, or the
         note with the specified filename
+
+        :param select: bool - False to never prompt or guess, for callers
+        writing without a person watching: only a note whose name contains
+        filename is taken, and only if it is the single such note or the one
+        titled exactly filename
+        :raises NoteNotFoundError: if no note matches filename
+        :raises NotebookError: if select is False and several notes match
         '''
+        if filename and not select:
+            return self._only_note(filename).path
         if filename:
-            notes = self._search_notes(filename)
-            return self._select_note(notes)
+            return self._select_note(self._find_notes(filename))
         else:
             return self._last_note()
 
-    def _list_notes(self, sort='name', reverse=False):
+    def _iter_notes(self, stat=False, since=None, until=None):
         '''
-        Return list of notes in notebook (as os.DirEntry) sorted accordingly
+        Lazily yield a NoteRecord for every note in notebook, in no particular
+        order
+
+        :param stat: bool - True to fill in size and times of scanned notes;
+        records from the index always have them
+        :param since: date ordinal, only yield notes dated on or after it
+        :param until: date ordinal, only yield notes dated on or before it
         '''
+        scanned = 0
+        if self.index:
+            for note in self.index.notes(None, since=since, until=until):
+                scanned += 1
+                yield note
+        else:
+            for directory in self._note_dirs(since, until):
+                for record in self._scan_dir(directory, stat, since, until):
+                    scanned += 1
+                    yield record
+        self.timings.count('files_scanned', scanned)
 
-        note_list = list()
+    def _read_note(self, full_notepath):
+        '''
+        :returns: content of the note as bytes, counted as bytes_read
+        '''
+        content = lib.get_file_content(full_notepath)
+        self.timings.count('bytes_read', len(content))
+        return content
 
-        for entry in os.scandir(self.location):
-            note_list.append(entry)
+    def _read_chunks(self, full_notepath):
+        '''
+        Yield the content of the note in chunks, counted as bytes_read, see
+        lib.iter_note
+        '''
+        for chunk in lib.iter_note(full_notepath):
+            self.timings.count('bytes_read', len(chunk))
+            yield chunk
 
-        if sort == 'name':
-            note_list.sort(key=lambda e: e.name.lower(), reverse=reverse)
-        elif sort == 'last':
-            try:
-                note_list.sort(key=lambda e: e.stat().st_birthtime,
-                               reverse=reverse)
-            except AttributeError:
-                note_list.sort(key=lambda e: e.stat().st_ctime,
-                               reverse=reverse)
+    def _note_dirs(self, since=None, until=None):
+        '''
+        Return the directories holding notes: the notebook directory, then
+        for sharded notebooks every YYYY/MM shard overlapping the since and
+        until dates, newest first
+        '''
+        directories = [self.location]
+        if self.sharded:
+            first = None if since is None else date_prefix(since)[:7]
+            last = None if until is None else date_prefix(until)[:7]
+            for year, month, shard in lib.list_shards(self.location):
+                key = '{:04d}-{:02d}'.format(year, month)
+                if (first is None or key >= first) and (last is None or
+                                                        key <= last):
+                    directories.append(os.path.join(self.location, shard))
+        return directories
 
-        return note_list
+    def _scan_dir(self, directory, stat=False, since=None, until=None):
+        '''
+        Yield a NoteRecord for every note in one directory, see _iter_notes
+        '''
+        if since is None and until is None:
+            for entry in os.scandir(directory):
+                if is_note(entry):
+                    yield NoteRecord.from_entry(directory, entry, stat)
+        else:
+            for entry in self._date_slice(since, until, directory):
+                record = NoteRecord.from_entry(directory, entry, stat)
+                if in_range(record.ordinal, since, until):
+                    yield record
+
+    def _date_slice(self, since=None, until=None, directory=None):
+        '''
+        Return the directory entries whose names fall between the filename
+        prefixes of the since and until dates, found by bisecting the
+        name-sorted directory listing. Names are all that is looked at, so
+        notes outside the slice are neither stat'ed nor read.
+        '''
+        entries = [entry for entry in os.scandir(directory or self.location)
+                   if is_note(entry)]
+        entries.sort(key=lambda e: e.name)
+        names = [entry.name for entry in entries]
+        start = 0 if since is None else bisect.bisect_left(names,
+                                                           date_prefix(since))
+        end = len(names) if until is None else bisect.bisect_left(
+            names, date_prefix(until + 1))
+        return entries[start:end]
+
+    def _list_notes(self, sort='name', reverse=False, limit=0, since=None,
+                    until=None, tags=None):
+        '''
+        Return list of NoteRecords in notebook sorted by one of SORT_KEYS.
+        With a limit, only the first limit notes are selected, using a bounded
+        heap instead of sorting the whole notebook. since and until restrict
+        the listing to a range of date ordinals, see _iter_notes.
+
+        Newest-first listings of sharded notebooks stop walking shards as
+        soon as limit notes were found in them, since older shards only hold
+        older notes. Notes in the notebook directory itself are always
+        included.
+
+        :param tags: list of tag query terms notes must satisfy, see
+        frontmatter.parse_tag_query; answered from the index without reading
+        notes, if there is one
+        '''
+        params = dict(sort=sort, reverse=reverse, limit=limit, since=since,
+                      until=until)
+        if tags:
+            params['tags'] = tags
+        remote = self._remote('list', **params)
+        if remote is not None:
+            return remote
+
+        clauses = frontmatter.parse_tag_query(tags or [])
+        key = SORT_KEYS[sort]
+        with self.timings.span('_list_notes'):
+            if self.index:
+                note_list = list(self.index.notes(sort, reverse, limit,
+                                                  since, until, clauses))
+                self.timings.count('files_scanned', len(note_list))
+                return note_list
+
+            if clauses:
+                notes = (note for note in self._iter_notes(
+                    sort in STAT_SORTS, since, until) if frontmatter.matches(
+                        frontmatter.parse_tags(self._read_note(note.path)),
+                        clauses))
+            elif (self.sharded and limit > 0 and reverse and
+                    sort in ('name', 'date')):
+                notes = list()
+                for directory in self._note_dirs(since, until)[1:]:
+                    if len(notes) >= limit:
+                        break
+                    notes.extend(self._scan_dir(directory, False, since,
+                                                until))
+                # notes left in the notebook directory, e.g. undated ones,
+                # may sort anywhere so they never end the walk
+                notes.extend(self._scan_dir(self.location, False, since,
+                                            until))
+                self.timings.count('files_scanned', len(notes))
+            else:
+                notes = self._iter_notes(sort in STAT_SORTS, since, until)
+
+            if limit > 0:
+                # selected while the notebook is scanned, keeping only limit
+                # notes in memory
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                return select(limit, notes, key=key)
+            notes = list(notes)
+
+        with self.timings.span('sort'):
+            return sorted(notes, key=key, reverse=reverse)
 
     def display_note_info(self, file):
-        note = file.name
-        date = '.'.join(note.split('-')[0:3])  # separate date
-        title = ' '.join(note.split('-')[3:])  # remove hyphens
-        title = title.split('.')
-        if len(title) > 1:
-            title = title[0:-1]  # remove extension if there is one
-        title = ''.join(title)
-        return (date, title)
+        return (file.date, file.title)
 
     def _show_note_list(self, note_list, max_list=None):
         note_name = '{:<12}{:<50}\n'
@@ -216,33 +558,34 @@ class Snotebook(object):
         else:
             end_idx = min(all_len, max_list)
 
-        with sys.stdout as stream:
-            stream.write(note_name.format('Date', 'Title'))
-            stream.write('{:=^62}\n'.format(''))
-            for file in note_list[0:end_idx]:
-                date, title = self.display_note_info(file)
-                stream.write(note_name.format(date, title))
+        stream = sys.stdout
+        stream.write(note_name.format('Date', 'Title'))
+        stream.write('{:=^62}\n'.format(''))
+        for file in note_list[0:end_idx]:
+            date, title = self.display_note_info(file)
+            stream.write(note_name.format(date, title))
+        stream.flush()
 
     def _select_note(self, note_list):  # FIXME refactor/make better thanks
         '''
-        Prompt user with list of DirEntry objects from which to select
+        Prompt user with list of NoteRecords from which to select
         '''
 
         selection = None
         if len(note_list) > 1:
-            with sys.stdout as prompt:
-                prompt.write('Multiple notes found\n')
-                list_item = '{:>5} {:<12}{:<50}\n'
-                prompt.write(list_item.format('', 'Date', 'Title'))
-                for idx, file in enumerate(note_list):
-                    selection_no = '[{}]'.format(idx + 1)
-                    date, title = self.display_note_info(file)
-                    note = list_item.format(selection_no, date, title)
-                    prompt.write(note)
-                prompt.write('Select: ')
-
-            with sys.stdin as stream:
-                selection = stream.readline()
+            prompt = sys.stdout
+            prompt.write('Multiple notes found\n')
+            list_item = '{:>5} {:<12}{:<50}\n'
+            prompt.write(list_item.format('', 'Date', 'Title'))
+            for idx, file in enumerate(note_list):
+                selection_no = '[{}]'.format(idx + 1)
+                date, title = self.display_note_info(file)
+                note = list_item.format(selection_no, date, title)
+                prompt.write(note)
+            prompt.write('Select: ')
+            prompt.flush()
+
+            selection = sys.stdin.readline()
 
         if selection:
             try:
@@ -250,38 +593,203 @@ class Snotebook(object):
                 note = note_list[select_idx]
                 log.debug('Selected note %s', note.name)
                 return note.path
-            except IndexError as e:
-                log.error('%s: Invalid selection entered', e)
-                sys.exit(1)
-        else:
-            return note_list.pop().path
+            except (IndexError, ValueError):
+                raise NotebookError('Invalid selection entered: {}'.format(
+                    selection.strip()))
+        else:  # the only or best ranked note
+            return note_list[0].path
 
     def _last_note(self):
         '''
         Return path to the most recently created (not modified) note in
         notebook
+
+        :raises NoteNotFoundError: if the notebook has no notes
         '''
-        last_modified = self._list_notes(sort='last').pop()
-        return last_modified.path
+        remote = self._remote('last')
+        if remote:
+            return remote[0].path
 
-    def _search_notes(self, search_term):
+        with self.timings.span('_last_note'):
+            if self.index:
+                last_created = self.index.last()
+                if last_created is None:
+                    raise NoteNotFoundError('No notes in notebook {}'.format(
+                        self.name))
+                return last_created.path
+            if not self.sharded:
+                notes = self._iter_notes(stat=True)
+            else:  # only the newest non-empty shard and unsharded notes
+                notes = list()
+                for directory in self._note_dirs()[1:]:
+                    notes.extend(self._scan_dir(directory, stat=True))
+                    if notes:
+                        break
+                notes.extend(self._scan_dir(self.location, stat=True))
+            last_created = max(notes, key=SORT_KEYS['last'], default=None)
+            if last_created is None:
+                raise NoteNotFoundError('No notes in notebook {}'.format(
+                    self.name))
+            return last_created.path
+
+    def _search_notes(self, search_term, since=None, until=None):
         '''
         Return list of filenames in notebook directory that contain the search
-        term
+        term, optionally restricted to a range of date ordinals
+        '''
+        matches = self._remote('search', search_term=search_term,
+                               since=since, until=until)
+        if matches is None:
+            matches = self._match_names(search_term, since, until)
+
+        if len(matches) > 0:
+            return matches
+        raise NoteNotFoundError('No file containing \'{}\' found'.format(
+            search_term))
+
+    def _only_note(self, filename):
+        '''
+        :returns: the note get_note_path takes for filename without prompting
+        '''
+        matches = self._search_notes(filename)
+        if len(matches) > 1:
+            wanted = '-'.join(filename.split()).lower()
+            matches = [note for note in matches if wanted in (
+                note.name.lower(), '-'.join(note.title.split()).lower())]
+        if len(matches) != 1:
+            raise NotebookError('\'{}\' matches more than one note'.format(
+                filename))
+        return matches[0]
+
+    def _find_notes(self, filename):
+        '''
+        Return notes for get_note_path to choose from, ranked by how similar
+        their titles are to filename: the notes whose names contain it, or
+        failing that, those with titles resembling it, to forgive typos
+        '''
+        matches = self._remote('search', search_term=filename)
+        if matches is None:
+            matches = self._match_names(filename)
+        if matches:
+            return fuzzy.rank(filename, matches, threshold=0)
+
+        matches = self._remote('fuzzy', search_term=filename)
+        if matches is None:
+            matches = self._similar_names(filename)
+        if matches:
+            return matches
+        raise NoteNotFoundError('No file containing or resembling \'{}\' '
+                                'found'.format(filename))
+
+    def _match_names(self, search_term, since=None, until=None):
+        '''
+        :returns: list of notes whose names match search_term, which may
+        be empty
         '''
         matches = list()
         hypenated_search = '-'.join(search_term.split())
         search_pattern = re.compile(search_term, re.I)
         hyphenated_search_pattern = re.compile(hypenated_search, re.I)
-        for note in self._list_notes():
-            if search_pattern.search(note.name) or hyphenated_search_pattern.search(note.name):
-                matches.append(note)
+        grams = fuzzy.substring_grams(search_term)
+        if self.index and grams and fuzzy.is_literal(search_term):
+            # only names holding every trigram of the term can contain it
+            notes = self.index.name_candidates(grams, since=since,
+                                               until=until)
+        else:
+            notes = self._list_notes(since=since, until=until)
+        with self.timings.span('_search_notes'):
+            for note in notes:
+                if search_pattern.search(note.name) or hyphenated_search_pattern.search(note.name):
+                    matches.append(note)
+        return matches
+
+    def _similar_names(self, search_term, since=None, until=None):
+        '''
+        :returns: list of notes whose titles are similar to search_term,
+        most similar first, see fuzzy.rank
+        '''
+        with self.timings.span('_similar_names'):
+            grams = fuzzy.trigrams(search_term)
+            if self.index and grams:
+                minimum = max(1, int(len(grams) * fuzzy.THRESHOLD))
+                notes = self.index.name_candidates(grams, minimum, since,
+                                                   until)
+            else:
+                notes = self._list_notes(since=since, until=until)
+            return fuzzy.rank(search_term, notes)
+
+    def _search_content(self, query, since=None, until=None):
+        '''
+        Return list of notes whose content contains every word or quoted
+        phrase in query, optionally restricted to a range of date ordinals
+
+        :raises NotebookError: if query has no words to search for
+        '''
+        phrases = parse_query(query)
+        if not phrases:
+            raise NotebookError('No words to search for in \'{}\''.format(
+                query))
+        matches = self._remote('content', query=query, since=since,
+                               until=until)
+        if matches is None and self.index:
+            matches = list(self.index.content_search(query, since, until))
+        elif matches is None:
+            notes = self._iter_notes(since=since, until=until)
+            matches = [note for note in notes if stream_matches(
+                self._read_chunks(note.path), phrases)]
+            matches.sort(key=SORT_KEYS['name'])
 
         if len(matches) > 0:
             return matches
-        else:
-            log.info('No file containing \'%s\' found', search_term)
-            sys.exit(1)
+        raise NoteNotFoundError('No note containing \'{}\' found'.format(
+            query))
+
+    def _rank_notes(self, query, limit=RANKED_LIMIT, since=None, until=None):
+        '''
+        Return notes most relevant to query first, scored with BM25 over
+        their titles and content, see NoteIndex.ranked_search. Notebooks
+        without an index are indexed in memory for the search.
+        '''
+        matches = self._remote('ranked', query=query, limit=limit,
+                               since=since, until=until)
+        if matches is None:
+            with self.timings.span('_rank_notes'):
+                index = self.index or NoteIndex.open(
+                    self.location, self.sharded, ':memory:')
+                if index is None:
+                    raise NotebookError('No note index for ranked search')
+                try:
+                    matches = [note for _, note in index.ranked_search(
+                        query, limit, since, until)]
+                finally:
+                    if index is not self.index:
+                        index.close()
+
+        if len(matches) > 0:
+            return matches
+        raise NoteNotFoundError('No note relevant to \'{}\' found'.format(
+            query))
+
+    def _grep_notes(self, pattern, workers=None, batch_size=256):
+        '''
+        Yield (note, line number, line) for every line of every note matching
+        pattern, case-insensitively. Notes are scanned in batches by a
+        process pool and matches are yielded as soon as a batch completes, so
+        the order is not deterministic.
+        '''
+        from concurrent.futures import (ProcessPoolExecutor, as_completed)
+        re.compile(pattern)  # fail early on a bad pattern
+        notes = dict((note.path, note) for note in self._iter_notes())
+        paths = list(notes)
+        batches = [paths[i:i + batch_size]
+                   for i in range(0, len(paths), batch_size)]
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = [pool.submit(lib.grep_files, batch, pattern)
+                       for batch in batches]
+            for future in as_completed(pending):
+                for path, lineno, line in future.result():
+                    yield (notes[path], lineno, line)
 
     def new_note(self, filename=None, timestamp=False):  # FIXME refactor more
         '''
@@ -293,18 +801,16 @@ class Snotebook(object):
         else:
             title = self.default_title
 
-        notepath = '{date}-{title}.{ext}'.format(date=self.date(),
-                                                 title='-'.join(title.split()),
-                                                 ext=self.ext)
-        full_notepath = os.path.join(self.location, notepath)
+        full_notepath = os.path.join(self._new_note_dir(),
+                                     self._note_name(title))
 
-        initial_content = lib.TEMPLATE_TITLE.sub(title, self.template)
+        initial_content = self.render_template(title).encode('utf-8')
 
-        new_content = self.call_writer(initial_content.encode('utf-8'), timestamp)
+        new_content = self.call_writer(initial_content, timestamp)
 
         if initial_content != new_content:
             log.debug('Saving note')
-            lib.write_note(full_notepath, new_content)
+            self._write_note(full_notepath, new_content)
         else:
             log.debug('No change detected, not saving')
 
@@ -315,20 +821,364 @@ class Snotebook(object):
         made
         '''
         full_notepath = self.get_note_path(filename)
-        initial_content = lib.get_file_content(full_notepath)
 
-        new_content = self.call_writer(initial_content, timestamp)
-
-        if initial_content != new_content:
-            log.debug('Saving note')
-            lib.write_note(full_notepath, new_content)
+        if self.edit_note(full_notepath, timestamp):
+            log.debug('Note saved')
         else:
             log.debug('No change detected, not saving')
 
-    def list_notes(self, max_notes=0):
-        note_list = self._list_notes(reverse=True)
+    def append_note(self, content, filename=None, timestamp=False):
+        '''
+        Append content to the note get_note_path finds, without an editor
+        and without prompting, see lib.append_note
+
+        :param content: bytes to append; a newline is added if missing
+        :param timestamp: bool - True to put the timestamp before content
+        :returns: path of the note appended to
+        '''
+        full_notepath = self.get_note_path(filename, select=False)
+        if not content.endswith(b'\n'):
+            content += b'\n'
+        if timestamp:
+            content = self.time() + b' ' + content
+
+        self._record_baseline(full_notepath)
+        index = self.index
+        relpath = os.path.relpath(full_notepath, self.location)
+
+        def appended(before, after):
+            index.append(relpath, content, before, after)
+
+        with self.timings.span('append_note'):
+            written = lib.append_note(full_notepath, content, self._fsync,
+                                      appended if index else None)
+            self.timings.count('bytes_written', written)
+        self._record_revision(full_notepath)
+        return full_notepath
+
+    def _write_note(self, full_notepath, content, previous=None):
+        self._record_baseline(full_notepath)
+        with self.timings.span('write_note'):
+            written = lib.write_note(full_notepath, content, previous,
+                                     self._fsync)
+            self.timings.count('bytes_written', written)
+            self._note_written(full_notepath)
+
+    def _note_written(self, full_notepath):
+        '''
+        Bring derived notebook state up to date after snote wrote a note
+        '''
+        if self.index:
+            self.index.update(os.path.relpath(full_notepath, self.location))
+        self._record_revision(full_notepath)
+
+    def _record_revision(self, full_notepath):
+        '''
+        Record the note as snote wrote it as its newest revision, if the
+        notebook keeps history
+        '''
+        if self.history:
+            from .history import note_key
+            with self.timings.span('history'):
+                stat = os.stat(full_notepath)
+                self.history.record(note_key(full_notepath),
+                                    lib.get_file_content(full_notepath), stat)
+
+    def _record_baseline(self, full_notepath):
+        '''
+        Record the note before snote changes it, unless its history already
+        ends with it: the first time snote writes it, or after it was changed
+        by other tools
+        '''
+        if self.history:
+            from .history import note_key
+            try:
+                stat = os.stat(full_notepath)
+            except FileNotFoundError:
+                return  # a new note
+            key = note_key(full_notepath)
+            with self.timings.span('history'):
+                if not self.history.is_recorded(key, stat):
+                    self.history.record(
+                        key, lib.get_file_content(full_notepath), stat)
+
+    def get_revisions(self, full_notepath):
+        '''
+        :returns: list of history.Revisions of the note, oldest first
+        :raises ConfigError: if the notebook does not keep history
+        '''
+        if not self.history:
+            raise ConfigError('history = yes is needed for note revisions')
+        from .history import note_key
+        return self.history.revisions(note_key(full_notepath))
+
+    def read_revision(self, full_notepath, number=None):
+        '''
+        :param number: revision number from get_revisions, negative to count
+        from the last one; the last one by default
+        :returns: content of the revision as bytes
+        :raises NoteNotFoundError: if the note has no such revision
+        '''
+        if not self.history:
+            raise ConfigError('history = yes is needed for note revisions')
+        from .history import note_key
+        with self.timings.span('read_revision'):
+            return self.history.read(note_key(full_notepath), number)
+
+    def _note_name(self, title, day=None):
+        '''
+        :param day: datetime.date of the note, defaults to today
+        :returns: filename for a note called title, {date}-{title}.{ext}
+        plus the suffix of the configured compression
+        '''
+        date = day.strftime(self._datefmt) if day else self.date()
+        name = '{date}-{title}.{ext}'.format(date=date,
+                                             title='-'.join(title.split()),
+                                             ext=self.ext)
+        if self._compress != 'none':
+            name += lib.COMPRESSED_SUFFIXES[self._compress]
+        return name
+
+    def _new_note_dir(self, day=None):
+        '''
+        :param day: datetime.date of the note, defaults to today
+        :returns: directory new notes are saved to, the YYYY/MM shard of day
+        for sharded notebooks
+        '''
+        if not self.sharded:
+            return self.location
+        if day is None:
+            import datetime
+            day = datetime.date.today()
+        directory = os.path.join(self.location,
+                                 lib.shard_path(day.year, day.month))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def export_notes(self, output=None, fmt=None, search_term=None,
+                     since=None, until=None, workers=None):
+        '''
+        Stream notes into an archive or JSON Lines, see
+        exporter.export_notes
+
+        :returns: number of notes exported
+        '''
+        from .exporter import export_notes
+        return export_notes(self, output, fmt, search_term, since, until,
+                            workers)
+
+    def import_notes(self, source, fmt='auto', workers=None):
+        '''
+        Create notes in bulk from source, see importer.import_notes
+
+        :returns: number of notes imported
+        '''
+        from .importer import import_notes
+        return import_notes(self, source, fmt, workers)
+
+    def compress_notes(self):
+        '''
+        Compress every uncompressed note in the notebook with the configured
+        compress method, adding its suffix to the filename
+
+        :returns: number of notes compressed
+        '''
+        if self._compress == 'none':
+            raise ConfigError('Set compress = gzip or zstd for notebook '
+                              '\'{}\' before compressing it'.format(self.name))
+        compressed = 0
+        for note in list(self._iter_notes()):
+            if lib.compression_of(note.name):
+                continue
+            try:
+                lib.compress_note(note.path, self._compress, self._fsync)
+            except FileExistsError as e:
+                log.warning('Not compressing %s, %s already exists',
+                            note.name, e)
+                continue
+            compressed += 1
+
+        if self.index:
+            self.index.refresh()
+        log.info('Compressed %d notes', compressed)
+        return compressed
+
+    def reshard(self):
+        '''
+        Move notes from the notebook directory into the YYYY/MM shards given
+        by the dates in their filenames. Undated notes stay where they are.
+
+        :returns: number of notes moved
+        '''
+        if not self.sharded:
+            raise ConfigError('Set layout = sharded for notebook \'{}\' '
+                              'before resharding it'.format(self.name))
+        import datetime
+
+        moved = 0
+        for entry in os.scandir(self.location):
+            if not is_note(entry):
+                continue
+            ordinal = date_ordinal(entry.name)
+            if not ordinal:
+                log.warning('Leaving undated note %s in place', entry.name)
+                continue
+            date = datetime.date.fromordinal(ordinal)
+            directory = os.path.join(self.location,
+                                     lib.shard_path(date.year, date.month))
+            target = os.path.join(directory, entry.name)
+            if os.path.exists(target):
+                log.warning('Not moving %s, %s already exists', entry.name,
+                            target)
+                continue
+            os.makedirs(directory, exist_ok=True)
+            os.rename(entry.path, target)
+            moved += 1
+
+        if self.index:
+            self.index.refresh()
+        log.info('Moved %d notes into shards', moved)
+        return moved
+
+    def get_notes(self, sort='name', reverse=False, limit=0, since=None,
+                  until=None, tags=None):
+        '''
+        :returns: list of NoteRecords in the notebook, see _list_notes
+        '''
+        return self._list_notes(sort, reverse, limit, since, until, tags)
+
+    def get_matching_notes(self, search_term, content=False, since=None,
+                           until=None):
+        '''
+        :param content: bool - True to search note contents rather than names
+        :returns: list of NoteRecords matching search_term
+        :raises NoteNotFoundError: if no note matches
+        '''
+        if content:
+            return self._search_content(search_term, since, until)
+        return self._search_notes(search_term, since, until)
+
+    def get_ranked_notes(self, query, limit=RANKED_LIMIT, since=None,
+                         until=None):
+        '''
+        :param limit: number of notes to return, all matches if not positive
+        :returns: list of NoteRecords most relevant to query first, see
+        _rank_notes
+        :raises NoteNotFoundError: if no note matches
+        '''
+        return self._rank_notes(query, limit, since, until)
+
+    def _own_note(self, full_notepath):
+        '''
+        :returns: full_notepath if it is a note in this notebook
+        :raises NoteNotFoundError: otherwise, e.g. for paths leading out of
+        the notebook directory
+        '''
+        location = os.path.realpath(self.location)
+        path = os.path.realpath(full_notepath)
+        if (os.path.commonpath([location, path]) != location or
+                os.path.basename(path).startswith('.') or
+                not os.path.isfile(path)):
+            raise NoteNotFoundError('No note at \'{}\' in {}'.format(
+                full_notepath, self.name))
+        return full_notepath
+
+    def read_note(self, full_notepath):
+        '''
+        :returns: content of the note at full_notepath as bytes
+        :raises NoteNotFoundError: if there is no such note in the notebook
+        '''
+        with self.timings.span('read_note'):
+            return self._read_note(self._own_note(full_notepath))
+
+    def write_note(self, full_notepath, content, previous=None):
+        '''
+        Replace the content of an existing note, see lib.write_note
+
+        :param content: bytes
+        :param previous: bytes the note had when read, or None
+        :raises NoteNotFoundError: if there is no such note in the notebook
+        '''
+        self._write_note(self._own_note(full_notepath), content, previous)
+
+    def create_note(self, content, title=None, day=None):
+        '''
+        Save content as a new note named the way new_note names it, without
+        an editor or the template
+
+        :param content: bytes
+        :param day: datetime.date of the note, defaults to today
+        :returns: path of the new note
+        :raises NotebookError: if a note by that name exists
+        '''
+        full_notepath = os.path.join(self._new_note_dir(day),
+                                     self._note_name(title or
+                                                     self.default_title, day))
+        if os.path.exists(full_notepath):
+            raise NotebookError('Note \'{}\' already exists'.format(
+                os.path.basename(full_notepath)))
+        self._write_note(full_notepath, content)
+        return full_notepath
+
+    def show_history(self, filename=None):
+        import time
+        full_notepath = self.get_note_path(filename)
+        revisions = self.get_revisions(full_notepath)
+        if not revisions:
+            raise NoteNotFoundError('No revisions of {} recorded'.format(
+                os.path.basename(full_notepath)))
+        line = '{:>5}  {:<21}{:>10}\n'
+        stream = sys.stdout
+        stream.write(line.format('Rev', 'Recorded', 'Bytes'))
+        stream.write('{:=^36}\n'.format(''))
+        for revision in revisions:
+            recorded = time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.localtime(revision.time))
+            stream.write(line.format(revision.number, recorded, revision.size))
+        stream.flush()
+
+    def show_note(self, filename=None, rev=None):
+        full_notepath = self.get_note_path(filename)
+        if rev is None:
+            content = self.read_note(full_notepath)
+        else:
+            content = self.read_revision(full_notepath, rev)
+        sys.stdout.buffer.write(content)
+        sys.stdout.buffer.flush()
+
+    def list_notes(self, max_notes=0, sort='name', since=None, until=None,
+                   tags=None):
+        limit = max_notes or max(self.max_list, 0)
+        note_list = self._list_notes(sort, True, limit, since, until, tags)
+        self._show_note_list(note_list, max_notes)
+
+    def grep_notes(self, pattern, workers=None):
+        found = False
+        for note, lineno, line in self._grep_notes(pattern, workers):
+            found = True
+            sys.stdout.write('{}:{}:{}\n'.format(
+                note.name, lineno, line.decode('utf-8', 'replace')))
+            sys.stdout.flush()
+        if not found:
+            raise NoteNotFoundError('No line matching \'{}\' found'.format(
+                pattern))
+
+    def search_notes(self, search_term, content=False, since=None,
+                     until=None, rank=False, max_notes=0):
+        if rank:
+            limit = max_notes or max(self.max_list, 0) or RANKED_LIMIT
+            note_list = self._rank_notes(search_term, limit, since, until)
+        elif content:
+            note_list = self._search_content(search_term, since, until)
+        else:
+            note_list = self._search_notes(search_term, since, until)
         self._show_note_list(note_list, max_notes)
 
-    def search_notes(self, search_term):
-        note_list = self._search_notes(search_term)
-        self._show_note_list(note_list)
+
+def __getattr__(name):
+    # EditSnoteParser moved to snote.cli so argparse is only loaded by the CLI
+    if name == 'EditSnoteParser':
+        from .cli import EditSnoteParser
+        return EditSnoteParser
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__,
+                                                                     name))
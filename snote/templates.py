@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Note templates, compiled once and cached.
+
+A template is the text new notes start with. These placeholders are
+replaced when a note is created:
+
+    %TITLE%             title of the note
+    %DATE%              date of the note, formatted with datefmt
+    %TIME%              time the note is created, formatted with timefmt
+    %NOTEBOOK%          name of the notebook
+    %INCLUDE path%      content of another template, relative to this one
+
+Any other text between percent signs is left as it is. Includes are
+expanded when the template is compiled, and the compiled template is kept
+in memory and in get_cache_dir(), keyed on the path, mtime and size of the
+template and of every file it includes, so creating many notes reads and
+parses the template once.
+'''
+
+import os
+import re
+import marshal
+import hashlib
+import logging
+import threading
+from . import lib
+from .exceptions import ConfigError
+
+log = logging.getLogger(__name__)
+
+VARIABLES = ('TITLE', 'DATE', 'TIME', 'NOTEBOOK')
+PLACEHOLDER = re.compile(r'%({})%|%INCLUDE[ \t]+([^%\n]+?)[ \t]*%'.format(
+    '|'.join(VARIABLES)))
+
+# most templates an include can be nested in
+MAX_DEPTH = 8
+
+TEMPLATE_CACHE_VERSION = 1
+
+_compiled = dict()  # absolute path to Template
+_compiled_lock = threading.Lock()
+
+
+class Template(object):
+    """
+    A compiled template: literal text alternating with variable names, and
+    the (path, mtime_ns, size) of each file it was compiled from
+    """
+
+    __slots__ = ('parts', 'depends')
+
+    def __init__(self, parts, depends=()):
+        self.parts = tuple(parts)
+        self.depends = tuple(depends)
+
+    @property
+    def source(self):
+        '''
+        :returns: text of the template with includes expanded and variables
+        left in place
+        '''
+        parts = list(self.parts)
+        parts[1::2] = ['%{}%'.format(name) for name in self.parts[1::2]]
+        return ''.join(parts)
+
+    @property
+    def variables(self):
+        return frozenset(self.parts[1::2])
+
+    def render(self, **values):
+        '''
+        :param values: str for each of VARIABLES; missing ones render as ''
+        :returns: the template with its variables replaced, as str
+        '''
+        parts = list(self.parts)
+        parts[1::2] = [values.get(name, '') for name in self.parts[1::2]]
+        return ''.join(parts)
+
+    def is_current(self):
+        '''
+        :returns: True if none of the files it was compiled from changed
+        '''
+        for path, mtime_ns, size in self.depends:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+                return False
+        return True
+
+    def __repr__(self):
+        return '<Template of {:d} parts>'.format(len(self.parts))
+
+
+EMPTY = Template([''])
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+def _compile_file(path, parts, depends, including):
+    if path in including:
+        raise ConfigError('Template {} includes itself'.format(path))
+    if len(including) >= MAX_DEPTH:
+        raise ConfigError('Templates included deeper than {:d} in {}'.format(
+            MAX_DEPTH, including[0]))
+    try:
+        depends.append(_stamp(path))
+        text = lib.get_file_content(path).decode('utf-8')
+    except OSError as e:
+        if not including:
+            raise
+        raise ConfigError('Template {} included by {} not readable: {}'.format(
+            path, including[-1], e))
+    including = including + (path,)
+    directory = os.path.dirname(path)
+    pos = 0
+    for match in PLACEHOLDER.finditer(text):
+        parts[-1] += text[pos:match.start()]
+        pos = match.end()
+        name, included = match.groups()
+        if name:
+            parts.extend((name, ''))
+        else:
+            included = os.path.join(directory,
+                                    os.path.expanduser(included))
+            _compile_file(os.path.abspath(included), parts, depends,
+                          including)
+    parts[-1] += text[pos:]
+
+
+def compile_template(path):
+    '''
+    Read and compile the template at path, and the templates it includes
+
+    :returns: Template
+    :raises ConfigError: if an include is missing or includes itself
+    '''
+    parts = ['']
+    depends = list()
+    _compile_file(os.path.abspath(path), parts, depends, ())
+    return Template(parts, depends)
+
+
+def _template_cache_path(path):
+    key = hashlib.sha1(path.encode('utf-8'))
+    return os.path.join(lib.get_cache_dir(),
+                        'template-{}.marshal'.format(key.hexdigest()[:16]))
+
+
+def _load_template_cache(path):
+    '''
+    :returns: Template from the cache if it is still valid, or None
+    '''
+    try:
+        with open(_template_cache_path(path), 'rb') as cache:
+            cached = marshal.load(cache)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if (cached.get('version') != TEMPLATE_CACHE_VERSION or
+            cached.get('path') != path):
+        return None
+    template = Template(cached['parts'], cached['depends'])
+    return template if template.is_current() else None
+
+
+def _save_template_cache(path, template):
+    cache_path = _template_cache_path(path)
+    cached = {
+        'version': TEMPLATE_CACHE_VERSION,
+        'path': path,
+        'parts': template.parts,
+        'depends': template.depends
+    }
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = '{}.{}'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as cache:
+            marshal.dump(cached, cache)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.debug('Could not write template cache: %s', e)
+
+
+def get_template(path, cache=True):
+    '''
+    The compiled template at path, from memory or the template cache when
+    none of its files changed since it was compiled
+
+    :param path: template file, or None for a template with no content
+    :param cache: bool - False to skip the cache in get_cache_dir()
+    :returns: Template
+    '''
+    if not path:
+        return EMPTY
+    path = os.path.abspath(path)
+    with _compiled_lock:
+        template = _compiled.get(path)
+    if template is not None and template.is_current():
+        return template
+    template = _load_template_cache(path) if cache else None
+    if template is None:
+        log.debug('Compiling template %s', path)
+        template = compile_template(path)
+        if cache:
+            _save_template_cache(path, template)
+    with _compiled_lock:
+        _compiled[path] = template
+    return template
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Phase timing instrumentation'''
+
+import json
+import time
+from contextlib import contextmanager
+
+
+class Timings(object):
+    """
+    Records per-phase spans and counters. Spans of the same name accumulate,
+    so a phase entered several times reports its total time and call count.
+    A disabled instance makes span() and count() no-ops.
+    """
+
+    def __init__(self, enabled=True):
+        self._enabled = enabled
+        self._spans = dict()
+        self._counters = dict()
+        self._order = list()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @contextmanager
+    def span(self, name):
+        if not self._enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if name not in self._spans:
+                self._spans[name] = [0.0, 0]
+                self._order.append(name)
+            self._spans[name][0] += elapsed
+            self._spans[name][1] += 1
+
+    def count(self, name, n=1):
+        if self._enabled:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def report(self):
+        '''
+        :returns: dict of spans (seconds and calls per phase, in the order
+        the phases were first entered) and counters
+        '''
+        return {
+            'spans': [{'name': name,
+                       'seconds': self._spans[name][0],
+                       'calls': self._spans[name][1]} for name in self._order],
+            'counters': dict(self._counters)
+        }
+
+    def write(self, stream):
+        '''
+        Write a human readable report to stream
+        '''
+        report = self.report()
+        line = '{:<20}{:>12}{:>8}\n'
+        stream.write(line.format('phase', 'ms', 'calls'))
+        for span in report['spans']:
+            stream.write(line.format(span['name'],
+                                     '{:.3f}'.format(span['seconds'] * 1000),
+                                     span['calls']))
+        for name, value in sorted(report['counters'].items()):
+            stream.write('{:<20}{:>12}\n'.format(name, value))
+
+    def dump(self, filepath):
+        '''
+        Write the report as JSON to filepath
+        '''
+        with open(filepath, 'w') as output:
+            json.dump(self.report(), output, indent=2)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Watch notebook directories and keep their indexes current as notes are
+created, edited, renamed or deleted outside snote
+'''
+
+import os
+import time
+import select
+import struct
+import logging
+from . import lib
+from .exceptions import (ConfigError, NotebookError)
+
+log = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR)
+EVENT = struct.Struct('iIII')
+
+# in a batch of changes, stands for "refresh the notebook's directories"
+RESCAN = None
+
+
+def merge(batch, changes):
+    '''
+    Merge changes into batch, both dicts of notebook location to a set of
+    changed note paths relative to it (see Watcher.changes)
+    '''
+    for location, relpaths in changes.items():
+        batch.setdefault(location, set()).update(relpaths)
+    return batch
+
+
+def apply_changes(index, relpaths):
+    '''
+    Apply one notebook's batch of changes to its NoteIndex
+    '''
+    try:
+        if RESCAN in relpaths:  # directories came or went
+            relpaths = relpaths - set([RESCAN])
+            index.refresh()
+        if relpaths:
+            index.apply(relpaths)
+    except OSError as e:
+        log.warning('Could not update the index of %s: %s', index.location, e)
+
+
+class InotifyWatcher(object):
+    '''
+    Watches notebook directories, and the YYYY/MM shards of sharded ones,
+    with Linux inotify
+
+    :raises: OSError if inotify is unavailable
+    '''
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or
+                                 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._watches = dict()  # watch descriptor to (location, dirname)
+        self._sharded = dict()
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        os.close(self._fd)
+
+    def _add_watch(self, location, dirname):
+        import ctypes
+
+        path = os.path.join(location, dirname)
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                          WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self._watches[wd] = (location, dirname)
+
+    def add(self, location, sharded=False):
+        '''
+        Start watching the notebook at location
+        '''
+        self._sharded[location] = sharded
+        self._add_watch(location, '')
+        if sharded:
+            years = set()
+            for year, _, shard in lib.list_shards(location):
+                if year not in years:
+                    self._add_watch(location, os.path.dirname(shard))
+                    years.add(year)
+                self._add_watch(location, shard)
+
+    def _add_shard(self, location, shard):
+        self._add_watch(location, shard)
+        if os.path.dirname(shard) == '':  # months made before the year's watch
+            for entry in os.scandir(os.path.join(location, shard)):
+                if lib.SHARD_MONTH.match(entry.name) and entry.is_dir():
+                    self._add_watch(location, os.path.join(shard, entry.name))
+
+    def _is_shard(self, location, dirname, name):
+        if not self._sharded.get(location):
+            return False
+        if dirname == '':
+            return bool(lib.SHARD_YEAR.match(name))
+        return (lib.SHARD_YEAR.match(dirname) is not None and
+                lib.SHARD_MONTH.match(name) is not None)
+
+    def _read(self):
+        try:
+            return os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return b''
+
+    def changes(self, timeout=None):
+        '''
+        Wait up to timeout seconds (forever if None) for events
+
+        :returns: dict of notebook location to a set of paths of changed
+        notes relative to it; RESCAN in a set means directories were
+        created or removed and the notebook should be refreshed
+        '''
+        changes = dict()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changes
+
+        data = self._read()
+        while data:
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                self._event(changes, wd, mask, name)
+            data = self._read()
+        return changes
+
+    def _event(self, changes, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.warning('inotify queue overflowed, refreshing all notebooks')
+            for location in self._sharded:
+                changes.setdefault(location, set()).add(RESCAN)
+            return
+        if wd not in self._watches:
+            return
+        location, dirname = self._watches[wd]
+        if mask & IN_IGNORED:
+            del self._watches[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            changes.setdefault(location, set()).add(RESCAN)
+            return
+        if mask & IN_ISDIR:
+            if not self._is_shard(location, dirname, name):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._add_shard(location, os.path.join(dirname, name))
+                except OSError as e:  # already gone again
+                    log.debug('Not watching new shard: %s', e)
+            changes.setdefault(location, set()).add(RESCAN)
+            return
+        if not name.startswith('.'):
+            changes.setdefault(location, set()).add(os.path.join(dirname, name))
+
+
+class PollingWatcher(object):
+    '''
+    Fallback for platforms without inotify: compares the size and mtime of
+    every note each interval seconds
+    '''
+
+    def __init__(self, interval=2.0):
+        self._interval = interval
+        self._snapshots = dict()
+        self._sharded = dict()
+
+    def fileno(self):
+        return None
+
+    def close(self):
+        pass
+
+    def _snapshot(self, location):
+        from .index import is_note
+
+        directories = ['']
+        if self._sharded[location]:
+            directories.extend(shard for _, _, shard in
+                               lib.list_shards(location))
+        snapshot = dict()
+        for dirname in directories:
+            try:
+                entries = os.scandir(os.path.join(location, dirname))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if is_note(entry):
+                    stat = entry.stat()
+                    snapshot[os.path.join(dirname, entry.name)] = (
+                        stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def add(self, location, sharded=False):
+        self._sharded[location] = sharded
+        self._snapshots[location] = self._snapshot(location)
+
+    def changes(self, timeout=None):
+        '''
+        See InotifyWatcher.changes
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changes = dict()
+            for location, before in self._snapshots.items():
+                after = self._snapshot(location)
+                changed = set(relpath for relpath in set(before) | set(after)
+                              if before.get(relpath) != after.get(relpath))
+                if changed:
+                    changes[location] = changed
+                self._snapshots[location] = after
+            if changes or (deadline is not None and
+                           time.monotonic() >= deadline):
+                return changes
+            wait = self._interval
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.monotonic(), 0))
+            time.sleep(wait)
+
+
+def get_watcher(poll=False, interval=2.0):
+    '''
+    :param poll: bool - True to poll even where inotify is available
+    :returns: InotifyWatcher, or PollingWatcher if inotify is unavailable
+    '''
+    if not poll:
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            log.info('Polling for changes, inotify unavailable: %s', e)
+    return PollingWatcher(interval)
+
+
+def watch_notebooks(notebooks=None, poll=False, interval=2.0, delay=0.2,
+                    rounds=None):
+    '''
+    Keep the indexes of notebooks up to date until interrupted. Events
+    arriving within delay seconds of each other are applied as one batch.
+
+    :param notebooks: names of notebooks, defaults to all configured ones
+    :param rounds: stop after this many batches; forever if None
+    '''
+    from .snotebook import Snotebook
+
+    indexes = dict()
+    for name in notebooks or lib.get_config().sections():
+        try:
+            sb = Snotebook.get_snotebook(name)
+        except (NotebookError, ConfigError) as e:
+            log.warning('Not watching notebook %s: %s', name, e)
+            continue
+        if sb.index is None:
+            log.warning('Not watching notebook %s: its index is disabled',
+                        name)
+            continue
+        indexes[sb.location] = (sb.index, sb.sharded)
+
+    watcher = get_watcher(poll, interval)
+    try:
+        for location, (index, sharded) in indexes.items():
+            watcher.add(location, sharded)
+            index.refresh()  # catch up on anything before the watch began
+        log.info('Watching %d notebooks', len(indexes))
+
+        while rounds is None or rounds > 0:
+            batch = watcher.changes()
+            if watcher.fileno() is not None:  # let the burst settle
+                time.sleep(delay)
+                merge(batch, watcher.changes(0))
+            for location, relpaths in batch.items():
+                apply_changes(indexes[location][0], relpaths)
+            if rounds is not None:
+                rounds -= 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
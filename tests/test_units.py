@@ -3,11 +3,29 @@
 '''Unit tests for library and class function'''
 
 import os
+import re
+import sys
+import json
+import time
+import datetime
 import pytest
+import subprocess
 import snote
+import snote.multi
+import snote.daemon
+import snote.watch
+import snote.fuzzy
+import snote.importer
+import snote.exporter
+import snote.aio
+import snote.history
+import snote.frontmatter
+import snote.templates
+import snote.records
 from snote.snotebook import Snotebook
-from snote.exceptions import (ConfigError, UnknownNotebookError,
-                              InvalidNotebookPathError)
+from snote.exceptions import (ConfigError, NotebookError,
+                              UnknownNotebookError, InvalidNotebookPathError,
+                              NoteNotFoundError)
 
 
 @pytest.fixture(params=['nb1', 'nb2', 'nb3'])
@@ -15,6 +33,19 @@ def snotebook(request):
     return Snotebook.get_snotebook(request.param)
 
 
+def make_editor(directory, script):
+    editor = directory / 'editor'
+    editor.write_text('#!/bin/sh\n' + script + '\n')
+    editor.chmod(0o755)
+    return str(editor)
+
+
+@pytest.fixture
+def editor(tmp_path):
+    """stand-in for the configured editor that appends a line"""
+    return make_editor(tmp_path, 'printf " edited" >> "$1"')
+
+
 class TestTrueExceptions:
 
     def test_bad_notebook(self):
@@ -25,6 +56,10 @@ class TestTrueExceptions:
         with pytest.raises(InvalidNotebookPathError):
             Snotebook.get_snotebook('badpath')
 
+    def test_caught_as_exception(self):
+        for error in [ConfigError, NotebookError, NoteNotFoundError]:
+            assert issubclass(error, Exception)
+
 
 class TestSnotebookConfig:
 
@@ -140,3 +175,1451 @@ class TestNoteRetrieval:
         assert with_hyphen == without_hyphen
         assert mixed_case == mixed_case_hyphen
         assert with_hyphen == mixed_case
+
+
+class TestNoteIndex:
+
+    @pytest.fixture
+    def notebook_dir(self, tmp_path):
+        for name in ['2016-04-22-first-post', '2016-04-23-third-entry']:
+            (tmp_path / name).write_bytes(name.encode('utf-8'))
+        return tmp_path
+
+    def test_index_matches_scan(self, snotebook):
+        unindexed = Snotebook(snotebook.name, snotebook.location)
+        for sort in ['name', 'last']:
+            for reverse in [False, True]:
+                indexed = [e.name for e in snotebook._list_notes(sort, reverse)]
+                scanned = [e.name for e in unindexed._list_notes(sort, reverse)]
+                assert indexed == scanned
+        assert snotebook._last_note() == unindexed._last_note()
+
+    def test_index_file_not_listed(self, snotebook):
+        assert snotebook.index is not None
+        names = [e.name for e in snotebook._list_notes()]
+        assert snote.index.INDEX_NAME not in names
+
+    def test_refresh_incremental(self, notebook_dir):
+        index = snote.index.NoteIndex(str(notebook_dir))
+        assert index.refresh()
+        assert not index.refresh()
+        assert len(index) == 2
+
+        (notebook_dir / '2016-05-02-another-note').write_bytes(b'new')
+        (notebook_dir / '2016-04-22-first-post').unlink()
+        assert index.refresh()
+        assert [n.name for n in index.notes()] == ['2016-04-23-third-entry',
+                                                   '2016-05-02-another-note']
+        note = index.get('2016-05-02-another-note')
+        assert (note.date, note.title, note.size) == ('2016.05.02', 'another note', 3)
+
+    def test_update_after_write(self, notebook_dir):
+        sb = Snotebook('tmp', str(notebook_dir), index=True)
+        before = sb.index.get('2016-04-23-third-entry').digest
+        path = os.path.join(str(notebook_dir), '2016-04-23-third-entry')
+        snote.lib.write_note(path, b'changed')
+        sb._note_written(path)
+        assert sb.index.get('2016-04-23-third-entry').digest != before
+        assert not sb.index.refresh()
+
+
+class TestContentSearch:
+
+    @pytest.fixture(params=[True, False], ids=['indexed', 'scanned'])
+    def content_notebook(self, request, tmp_path):
+        notes = {
+            '2016-04-22-first-post': b'I have to return some video tapes',
+            '2016-04-23-third-entry': b'Tapes? Video? Return them tomorrow.',
+            '2016-05-02-another-note': b'Nothing to see here',
+        }
+        for name, content in notes.items():
+            (tmp_path / name).write_bytes(content)
+        return Snotebook('tmp', str(tmp_path), index=request.param)
+
+    def test_all_words(self, content_notebook):
+        actual = [n.name for n in content_notebook._search_content('VIDEO return')]
+        assert actual == ['2016-04-22-first-post', '2016-04-23-third-entry']
+
+    def test_phrase(self, content_notebook):
+        actual = [n.name for n in content_notebook._search_content('"video tapes"')]
+        assert actual == ['2016-04-22-first-post']
+
+    def test_no_match(self, content_notebook):
+        with pytest.raises(NoteNotFoundError):
+            content_notebook._search_content('blockbuster')
+
+    def test_no_words(self, content_notebook):
+        with pytest.raises(NotebookError) as raised:
+            content_notebook._search_content('!!! "?"')
+        assert not isinstance(raised.value, NoteNotFoundError)
+        if content_notebook.index:
+            assert list(content_notebook.index.content_search('!!!')) == []
+
+    def test_index_follows_writes(self, tmp_path):
+        (tmp_path / '2016-04-22-first-post').write_bytes(b'old words')
+        sb = Snotebook('tmp', str(tmp_path), index=True)
+        assert [n.name for n in sb._search_content('old')]
+        path = str(tmp_path / '2016-04-22-first-post')
+        snote.lib.write_note(path, b'new words')
+        sb._note_written(path)
+        assert [n.name for n in sb._search_content('new')] == ['2016-04-22-first-post']
+        with pytest.raises(NoteNotFoundError):
+            sb._search_content('old')
+
+    def test_scan_in_chunks(self):
+        content = ('---\ntags: [work]\n---\n' + '#start caf\u00e9 '
+                   'video-tapes return #later\n' * 50).encode('utf-8')
+        whole = snote.index.scan_content([content])
+        for size in [1, 7, 64]:
+            chunks = [content[i:i + size] for i in range(0, len(content), size)]
+            assert snote.index.scan_content(chunks) == whole
+        digest, length, positions, tags = whole
+        assert length == 2 + 6 * 50
+        assert list(positions['video']) == list(range(4, length, 6))
+        assert tags == set(['work', 'start', 'later'])
+        assert snote.index.scan_content([content], limit=100)[2] is None
+
+    def test_long_notes_not_posted(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(snote.index, 'MAX_POSTINGS_SIZE', 64)
+        (tmp_path / '2016-04-22-long').write_bytes(b'filler ' * 20 +
+                                                   b'video tapes')
+        (tmp_path / '2016-04-23-short').write_bytes(b'video')
+        sb = Snotebook('tmp', str(tmp_path), index=True)
+        db = sb.index._db
+        assert db.execute('SELECT count(*) FROM postings WHERE term = ?',
+                          ('filler',)).fetchone() == (0,)
+        assert [n.name for n in sb._search_content('video')] == [
+            '2016-04-22-long', '2016-04-23-short']
+        assert [n.name for n in sb._search_content('"video tapes"')] == [
+            '2016-04-22-long']
+
+
+class TestGrep:
+
+    def test_grep_file(self, tmp_path):
+        note = tmp_path / 'note'
+        note.write_bytes(b'first line\nVideo tapes here\nnothing\nmore video, video\n')
+        pattern = re.compile(b'video', re.I)
+        assert snote.lib.grep_file(str(note), pattern) == [
+            (2, b'Video tapes here'), (4, b'more video, video')]
+
+    def test_grep_empty_file(self, tmp_path):
+        note = tmp_path / 'note'
+        note.write_bytes(b'')
+        assert snote.lib.grep_file(str(note), re.compile(b'x')) == []
+
+    def test_grep_notes(self, tmp_path):
+        (tmp_path / '2016-04-22-first-post').write_bytes(b'a\nReturn tapes\n')
+        (tmp_path / '2016-04-23-third-entry').write_bytes(b'no match')
+        (tmp_path / '2016-05-02-another-note').write_bytes(b'return')
+        sb = Snotebook('tmp', str(tmp_path))
+        actual = sorted((n.name, lineno, line) for n, lineno, line in
+                        sb._grep_notes('return', workers=2, batch_size=1))
+        assert actual == [('2016-04-22-first-post', 2, b'Return tapes'),
+                          ('2016-05-02-another-note', 1, b'return')]
+
+
+class TestNoteSelection:
+
+    @pytest.mark.parametrize('sort', ['name', 'last', 'mtime', 'size', 'date'])
+    @pytest.mark.parametrize('reverse', [False, True])
+    def test_limit_matches_sort(self, snotebook, sort, reverse):
+        unindexed = Snotebook(snotebook.name, snotebook.location)
+        for sb in [snotebook, unindexed]:
+            full = [e.name for e in sb._list_notes(sort, reverse)]
+            top = [e.name for e in sb._list_notes(sort, reverse, limit=3)]
+            assert top == full[:3]
+
+    def test_sort_keys_agree(self, snotebook):
+        unindexed = Snotebook(snotebook.name, snotebook.location)
+        for sort in ['date', 'size']:
+            indexed = [e.name for e in snotebook._list_notes(sort)]
+            scanned = [e.name for e in unindexed._list_notes(sort)]
+            assert indexed == scanned
+
+    def test_iter_notes_lazy(self, snotebook):
+        notes = snotebook._iter_notes()
+        assert not isinstance(notes, list)
+        assert len(list(notes)) == 7
+
+    @pytest.mark.parametrize('layout', ['flat', 'sharded'])
+    @pytest.mark.parametrize('index', [False, True])
+    def test_last_note_empty(self, tmp_path, layout, index):
+        sb = Snotebook('tmp', str(tmp_path), index=index, layout=layout)
+        with pytest.raises(NoteNotFoundError):
+            sb._last_note()
+
+
+class TestStartup:
+
+    PROBE = '''
+import sys, json
+import snote
+sb = snote.Snotebook.get_snotebook('nb1')
+lazy = ['argparse', 'configparser', 'subprocess', 'tempfile',
+        'concurrent.futures']
+print(json.dumps([m for m in lazy if m in sys.modules]))
+'''
+
+    def probe(self, cache_home):
+        env = dict(os.environ, XDG_CACHE_HOME=str(cache_home))
+        output = subprocess.check_output([sys.executable, '-c', self.PROBE],
+                                         env=env)
+        return json.loads(output.decode('utf-8'))
+
+    def test_lazy_imports(self, tmp_path):
+        cache_dir = tmp_path / 'snote'
+        assert self.probe(tmp_path) == ['configparser']  # parsed and cached
+        assert [p.name for p in cache_dir.iterdir()
+                if p.name.startswith('config-')]
+        # with the config cache warm, the INI is not parsed again
+        assert self.probe(tmp_path) == []
+
+
+class TestConfigCache:
+
+    @pytest.fixture
+    def config_file(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+        monkeypatch.setenv('SNOTE_TEST_DIR', str(tmp_path))
+        config_file = tmp_path / 'snoterc'
+        config_file.write_text('[global]\next=md\n\n'
+                               '[nb]\npath=$SNOTE_TEST_DIR/nb\n')
+        monkeypatch.setenv('SNOTE_TEST_RC', str(config_file))
+        return config_file
+
+    def test_cache_matches_parse(self, config_file):
+        parsed = snote.lib.get_config('SNOTE_TEST_RC', cache=False)
+        snote.lib.get_config('SNOTE_TEST_RC')
+        cached = snote.lib.get_config('SNOTE_TEST_RC')
+        assert cached.sections() == parsed.sections() == ['nb']
+        assert cached._dump() == parsed._dump()
+
+    def test_cache_tracks_environment(self, config_file, tmp_path, monkeypatch):
+        snote.lib.get_config('SNOTE_TEST_RC')
+        monkeypatch.setenv('SNOTE_TEST_DIR', '/elsewhere')
+        config = snote.lib.get_config('SNOTE_TEST_RC')
+        assert config.get('nb', 'path') == '/elsewhere/nb'
+
+    def test_cache_tracks_file(self, config_file):
+        snote.lib.get_config('SNOTE_TEST_RC')
+        config_file.write_text('[other]\npath=/tmp\n')
+        os.utime(str(config_file), ns=(0, 0))
+        assert snote.lib.get_config('SNOTE_TEST_RC').sections() == ['other']
+
+    def test_getboolean(self, config_file):
+        config = snote.lib.get_config('SNOTE_TEST_RC')
+        assert config.getboolean('nb', 'index') is True
+        assert config.get('nb', 'missing', fallback=None) is None
+
+
+class TestTimings:
+
+    def test_disabled_records_nothing(self):
+        timings = snote.timing.Timings(enabled=False)
+        with timings.span('phase'):
+            timings.count('files_scanned', 3)
+        assert timings.report() == {'spans': [], 'counters': {}}
+
+    def test_snotebook_phases(self, tmp_path, editor):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        (notebook / '2016-04-22-first-post').write_bytes(b'content')
+        timings = snote.timing.Timings()
+        sb = Snotebook('tmp', str(notebook), editor=editor, timings=timings)
+        sb.update_note()
+        report = timings.report()
+        phases = [span['name'] for span in report['spans']]
+        assert phases == ['_last_note', 'call_writer', 'write_note']
+        assert report['counters'] == {'files_scanned': 1, 'bytes_copied': 7,
+                                      'bytes_written': 7}
+
+    def test_limited_listing_and_search(self, tmp_path):
+        for day in range(1, 6):
+            (tmp_path / '2016-04-0{}-post'.format(day)).write_bytes(b'tapes')
+        timings = snote.timing.Timings()
+        sb = Snotebook('tmp', str(tmp_path), timings=timings)
+        assert [n.name for n in sb._list_notes(reverse=True, limit=2)] == [
+            '2016-04-05-post', '2016-04-04-post']
+        report = timings.report()
+        # selected while scanning, so there is no separate sort phase
+        assert [span['name'] for span in report['spans']] == ['_list_notes']
+        assert report['counters'] == {'files_scanned': 5}
+        assert len(sb._search_content('tapes')) == 5
+        assert timings.report()['counters'] == {'files_scanned': 10,
+                                                'bytes_read': 25}
+
+
+class TestWriteNote:
+
+    @pytest.fixture
+    def note(self, tmp_path):
+        note = tmp_path / 'note'
+        note.write_bytes(b'running log\n')
+        os.chmod(str(note), 0o640)
+        return note
+
+    def test_append_delta(self, note):
+        inode = note.stat().st_ino
+        written = snote.lib.write_note(str(note), b'running log\nmore\n',
+                                       previous=b'running log\n')
+        assert written == 5
+        assert note.read_bytes() == b'running log\nmore\n'
+        assert note.stat().st_ino == inode
+
+    def test_rewrite_is_atomic_replace(self, note):
+        inode = note.stat().st_ino
+        written = snote.lib.write_note(str(note), b'rewritten',
+                                       previous=b'running log\n', fsync='full')
+        assert written == 9
+        assert note.read_bytes() == b'rewritten'
+        assert note.stat().st_ino != inode
+        assert note.stat().st_mode & 0o777 == 0o640
+        assert os.listdir(str(note.parent)) == ['note']
+
+    def test_changed_on_disk_rewrites(self, note):
+        note.write_bytes(b'edited elsewhere\n')
+        snote.lib.write_note(str(note), b'running log\nmore\n',
+                             previous=b'running log\n', fsync='none')
+        assert note.read_bytes() == b'running log\nmore\n'
+
+    def test_same_length_rewrite_not_appended_to(self, note):
+        note.write_bytes(b'foreign log\n')
+        inode = note.stat().st_ino
+        snote.lib.write_note(str(note), b'running log\nmore\n',
+                             previous=b'running log\n', fsync='none')
+        assert note.read_bytes() == b'running log\nmore\n'
+        assert note.stat().st_ino != inode
+
+    def test_bad_fsync_policy(self, note):
+        with pytest.raises(ConfigError):
+            snote.lib.write_note(str(note), b'x', fsync='sometimes')
+
+
+class TestEditNote:
+
+    @pytest.fixture
+    def notebook(self, tmp_path):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        (notebook / '2016-04-22-first-post').write_bytes(b'content')
+        return notebook
+
+    def edit(self, notebook, editor, **kwargs):
+        sb = Snotebook('tmp', str(notebook), editor=editor, **kwargs)
+        note = notebook / '2016-04-22-first-post'
+        inode = note.stat().st_ino
+        changed = sb.edit_note(str(note), timestamp=False)
+        return changed, note.read_bytes(), note.stat().st_ino == inode
+
+    def test_append_in_place(self, notebook, editor):
+        assert self.edit(notebook, editor) == (True, b'content edited', True)
+
+    def test_rewrite_replaces(self, notebook, tmp_path):
+        editor = make_editor(tmp_path, 'printf "new" > "$1"')
+        assert self.edit(notebook, editor) == (True, b'new', False)
+
+    def test_unchanged(self, notebook, tmp_path):
+        editor = make_editor(tmp_path, 'true')
+        assert self.edit(notebook, editor) == (False, b'content', True)
+
+    def test_touched_but_unchanged(self, notebook, tmp_path):
+        editor = make_editor(tmp_path, 'printf "content" > "$1"')
+        assert self.edit(notebook, editor) == (False, b'content', True)
+
+    def test_timestamp(self, notebook, tmp_path):
+        sb = Snotebook('tmp', str(notebook), editor=make_editor(tmp_path, 'true'),
+                       timestamp=' [{time}]')
+        note = notebook / '2016-04-22-first-post'
+        assert sb.edit_note(str(note), timestamp=True)
+        assert note.read_bytes().startswith(b'content [')
+
+    def test_append_during_edit_kept(self, notebook, tmp_path):
+        note = notebook / '2016-04-22-first-post'
+        editor = make_editor(tmp_path, '{} -c "import snote.lib; '
+                             'snote.lib.append_note(\'{}\', b\' appended\')"; '
+                             'printf " edited" >> "$1"'.format(sys.executable,
+                                                              note))
+        assert self.edit(notebook, editor) == (
+            True, b'content appended edited', True)
+
+    def test_edit_inplace(self, notebook, editor):
+        assert self.edit(notebook, editor, edit='inplace') == (
+            True, b'content edited', True)
+        assert os.listdir(str(notebook)) == ['2016-04-22-first-post']
+
+    def test_edit_inplace_failed_editor_keeps_backup(self, notebook, tmp_path):
+        editor = make_editor(tmp_path, 'exit 1')
+        self.edit(notebook, editor, edit='inplace')
+        assert (notebook / '.2016-04-22-first-post.snote-bak').read_bytes() == b'content'
+
+    def test_copy_file_offset(self, tmp_path):
+        src = tmp_path / 'src'
+        src.write_bytes(b'0123456789' * 1000)
+        dst = tmp_path / 'dst'
+        with open(str(dst), 'wb') as output:
+            output.write(b'head')
+            output.flush()
+            assert snote.lib.copy_file(str(src), output.fileno(), 9990) == 10
+        assert dst.read_bytes() == b'head0123456789'
+
+
+class TestAllNotebooks:
+
+    def test_collect_notes(self):
+        notebook, rows, error = snote.multi.collect_notes('nb1', limit=2)
+        assert (notebook, error) == ('nb1', None)
+        assert [title for _, _, _, title in rows] == [
+            'So how can you return video tapes',
+            'I have to return some video tapes']
+
+    def test_collect_bad_notebook(self):
+        notebook, rows, error = snote.multi.collect_notes('badpath')
+        assert rows == [] and 'unknown' in error
+
+    def test_collect_no_match(self):
+        assert snote.multi.collect_notes('nb2', 'blockbusters') == ('nb2', [], None)
+
+    def test_collect_by_date(self, tmp_path, monkeypatch):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        for name in ['2016-04-22-first-post', '2016-05-02-Video-tapes',
+                     'undated-note']:
+            (notebook / name).write_bytes(b'')
+        config = tmp_path / 'snoterc'
+        config.write_text('[nb]\npath={}\n[broken]\npath={}\nlayout=piles\n'
+                          .format(notebook, notebook))
+        monkeypatch.setenv('SNOTE', str(config))
+        notebook, rows, error = snote.multi.collect_notes('nb', limit=2)
+        assert [title for _, _, _, title in rows] == [
+            'Video tapes', 'first post']
+        notebook, rows, error = snote.multi.collect_notes('broken')
+        assert rows == [] and 'layout' in error
+
+    def test_limit_merges_newest(self):
+        batches = list(snote.multi.iter_all_notes(limit=4, workers=2))
+        assert len(batches) == 1
+        dates = [date for _, _, date, _ in batches[0]]
+        assert dates == ['2016.08.01'] * 3 + ['2016.07.15']
+
+    def test_search_streams_per_notebook(self):
+        batches = list(snote.multi.iter_all_notes('video', workers=2))
+        assert sorted(rows[0][1] for rows in batches) == ['nb1', 'nb2', 'nb3']
+        assert all(len(rows) == 2 for rows in batches)
+
+
+class TestNoteRecord:
+
+    def test_parsed_once(self):
+        record = snote.records.NoteRecord('/nb', '2016-07-15-I-have-to-return.md')
+        assert (record.date, record.title) == ('2016.07.15', 'I have to return')
+        assert record.ordinal == datetime.date(2016, 7, 15).toordinal()
+        assert record.path == os.path.join('/nb', '2016-07-15-I-have-to-return.md')
+        assert not hasattr(record, '__dict__')
+
+    def test_titles_interned(self):
+        first = snote.records.NoteRecord('/nb', '2016-04-22-' + 'first-post')
+        second = snote.records.NoteRecord('/other', '2017-01-01-first-' + 'post')
+        assert first.title is second.title
+
+    def test_undated_name(self):
+        record = snote.records.NoteRecord('/nb', 'readme.txt')
+        assert record.ordinal == 0
+
+    def test_records_everywhere(self, snotebook):
+        unindexed = Snotebook(snotebook.name, snotebook.location)
+        for sb in [snotebook, unindexed]:
+            notes = sb._list_notes('last') + sb._search_notes('video')
+            assert all(isinstance(n, snote.records.NoteRecord) for n in notes)
+
+
+class TestDateRange:
+
+    def ordinal(self, value):
+        return snote.records.date_bound(value)
+
+    @pytest.mark.parametrize('indexed', [True, False])
+    def test_list_range(self, snotebook, indexed):
+        sb = Snotebook(snotebook.name, snotebook.location, index=indexed)
+        notes = sb._list_notes(since=self.ordinal('2016-04-23'),
+                               until=self.ordinal('2016-07-15'))
+        assert [n.name for n in notes] == [
+            '2016-04-23-third-entry',
+            '2016-05-02-another-note',
+            '2016-07-15-Blockbuster-doesnt-exist-anymore-though',
+            '2016-07-15-I-have-to-return-some-video-tapes']
+
+    @pytest.mark.parametrize('indexed', [True, False])
+    def test_search_range(self, snotebook, indexed):
+        sb = Snotebook(snotebook.name, snotebook.location, index=indexed)
+        notes = sb._search_notes('video', since=self.ordinal('2016-08-01'))
+        assert [n.name for n in notes] == [
+            '2016-08-01-So-how-can-you-return-video-tapes']
+
+    def test_date_slice(self, snotebook):
+        sb = Snotebook(snotebook.name, snotebook.location)
+        assert [e.name for e in sb._date_slice(until=self.ordinal('2016-04-22'))] == [
+            '2016-04-22-first-post', '2016-04-22-second-note']
+
+    def test_date_bound(self):
+        today = datetime.date.today().toordinal()
+        assert self.ordinal('today') == today
+        assert self.ordinal('2w') == today - 14
+        with pytest.raises(ValueError):
+            self.ordinal('last tuesday')
+
+
+class TestShardedLayout:
+
+    NAMES = ['2016-04-22-first-post', '2016-04-23-third-entry',
+             '2016-05-02-another-note', '2017-01-09-new-year']
+
+    @pytest.fixture
+    def flat_dir(self, tmp_path):
+        location = tmp_path / 'notes'
+        location.mkdir()
+        for name in self.NAMES:
+            (location / name).write_bytes(name.encode('utf-8'))
+        return location
+
+    @pytest.fixture(params=[True, False], ids=['indexed', 'scanned'])
+    def sharded(self, request, flat_dir):
+        sb = Snotebook('tmp', str(flat_dir), index=request.param,
+                       layout='sharded')
+        assert sb.reshard() == len(self.NAMES)
+        return sb
+
+    def test_reshard(self, sharded, flat_dir):
+        assert (flat_dir / '2016' / '05' / '2016-05-02-another-note').exists()
+        assert not (flat_dir / '2016-05-02-another-note').exists()
+        assert sharded.reshard() == 0
+
+    def test_reshard_needs_layout(self, flat_dir):
+        with pytest.raises(ConfigError):
+            Snotebook('tmp', str(flat_dir)).reshard()
+
+    def test_bad_layout(self, flat_dir):
+        with pytest.raises(ConfigError):
+            Snotebook('tmp', str(flat_dir), layout='nested')
+
+    def test_list_matches_flat(self, sharded):
+        for sort in ['name', 'date']:
+            for reverse in [False, True]:
+                names = [n.name for n in sharded._list_notes(sort, reverse)]
+                assert names == sorted(self.NAMES, reverse=reverse)
+        newest = sharded._list_notes(reverse=True, limit=2)
+        assert [n.name for n in newest] == self.NAMES[:-3:-1]
+
+    def test_search_and_last(self, sharded):
+        notes = sharded._search_notes('post')
+        assert [n.path for n in notes] == [os.path.join(
+            sharded.location, '2016', '04', '2016-04-22-first-post')]
+        since = snote.records.date_bound('2016-05-01')
+        assert [n.name for n in sharded._list_notes(since=since)] == \
+            self.NAMES[2:]
+        assert sharded._last_note().endswith(
+            os.path.join('2017', '01', '2017-01-09-new-year'))
+
+    @pytest.mark.parametrize('index', [False, True])
+    def test_undated_root_note(self, tmp_path, index):
+        (tmp_path / 'README').write_bytes(b'left by reshard')
+        time.sleep(0.05)  # file times are only as fine as the kernel tick
+        for shard, name in [('2016/04', '2016-04-22-old'),
+                            ('2024/05', '2024-05-01-newest')]:
+            (tmp_path / shard).mkdir(parents=True)
+            (tmp_path / shard / name).write_bytes(b'dated')
+        sb = Snotebook('tmp', str(tmp_path), index=index, layout='sharded')
+        assert sb._last_note().endswith('2024-05-01-newest')
+        assert [n.name for n in sb._list_notes('date', True, 1)] == \
+            ['2024-05-01-newest']
+        assert [n.name for n in sb._list_notes('name', True, 1)] == \
+            ['README']
+        assert [n.name for n in sb._list_notes('date', False, 1)] == \
+            [n.name for n in sb._list_notes('date')][:1]
+
+    def test_new_note_in_shard(self, sharded, editor):
+        sharded = Snotebook('tmp', sharded.location, editor=editor,
+                            index=sharded.index is not None, layout='sharded')
+        sharded.new_note(filename='sharded')
+        today = datetime.date.today()
+        shard = os.path.join(sharded.location, snote.lib.shard_path(
+            today.year, today.month))
+        created = [n.path for n in sharded._search_notes('sharded')]
+        assert len(created) == 1
+        assert os.path.dirname(created[0]) == shard
+
+
+class TestDaemon:
+
+    def names(self, notes):
+        return [n.name for n in notes]
+
+    def test_handle_matches_local(self, snotebook):
+        server = snote.daemon.NotebookServer()
+        response = server.handle({'notebook': snotebook.name,
+                                  'location': snotebook.location,
+                                  'action': 'list',
+                                  'params': {'reverse': True}})
+        assert [row[1] for row in response['rows']] == \
+            self.names(snotebook._list_notes(reverse=True))
+        response = server.handle({'notebook': snotebook.name,
+                                  'location': snotebook.location,
+                                  'action': 'search',
+                                  'params': {'search_term': 'no such note'}})
+        assert response == {'rows': []}
+        assert 'error' in server.handle({'notebook': 'nb0', 'action': 'last'})
+        server.close()
+
+    def test_other_location(self, snotebook, tmp_path):
+        server = snote.daemon.NotebookServer()
+        assert 'error' in server.handle({'notebook': snotebook.name,
+                                         'location': str(tmp_path),
+                                         'action': 'last'})
+        assert 'error' in server.handle({'notebook': snotebook.name,
+                                         'action': 'last'})
+        server.close()
+
+    def test_rows_outside_notebook(self, snotebook, tmp_path):
+        class Client(object):
+            def request(self, notebook, location, action, **params):
+                return [[str(tmp_path), 'from-elsewhere.md', 0, 0, 0, None]]
+
+        (tmp_path / 'nb').mkdir()
+        sb = Snotebook(snotebook.name, str(tmp_path / 'nb'))
+        sb.remote = Client()
+        assert sb._list_notes() == []
+        assert sb.remote is None
+
+    def test_socket_roundtrip(self, snotebook, tmp_path):
+        path = str(tmp_path / 'daemon.sock')
+        daemon = subprocess.Popen([sys.executable, '-c',
+                                   'import snote.daemon, sys; '
+                                   'snote.daemon.serve(sys.argv[1])', path])
+        try:
+            client = None
+            for _ in range(100):  # wait for the daemon to listen
+                client = snote.daemon.DaemonClient.connect(path)
+                if client or daemon.poll() is not None:
+                    break
+                time.sleep(0.05)
+            assert client is not None
+
+            remote = Snotebook(snotebook.name, snotebook.location)
+            remote.remote = client
+            assert self.names(remote._list_notes('name', True, 3)) == \
+                self.names(snotebook._list_notes('name', True, 3))
+            assert self.names(remote._search_notes('video')) == \
+                self.names(snotebook._search_notes('video'))
+            assert remote._last_note() == snotebook._last_note()
+            assert remote.remote is client
+            client.close()
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+    def test_fallback(self, snotebook, tmp_path):
+        assert snote.daemon.DaemonClient.connect(
+            str(tmp_path / 'missing.sock')) is None
+
+        class Gone:
+            def request(self, *args, **kwargs):
+                return None
+
+        sb = Snotebook(snotebook.name, snotebook.location)
+        sb.remote = Gone()
+        assert self.names(sb._list_notes()) == \
+            self.names(snotebook._list_notes())
+        assert sb.remote is None
+
+    def test_no_rows_looked_up_locally(self, snotebook):
+        class Stale:
+            def request(self, *args, **kwargs):
+                return []
+
+        sb = Snotebook(snotebook.name, snotebook.location)
+        sb.remote = Stale()
+        assert self.names(sb._search_notes('video')) == \
+            self.names(snotebook._search_notes('video'))
+        assert isinstance(sb.remote, Stale)
+
+    def test_memory_index_sees_writes(self, tmp_path, monkeypatch):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        note = notebook / '2016-04-22-first-post.md'
+        note.write_bytes(b'# first\n')
+        config = tmp_path / 'snoterc'
+        config.write_text('[nb]\npath={}\nindex=no\n'.format(notebook))
+        monkeypatch.setenv('SNOTE', str(config))
+        server = snote.daemon.NotebookServer()
+        request = {'notebook': 'nb', 'location': str(notebook),
+                   'action': 'content', 'params': {'query': 'zebra'}}
+        assert server.handle(request) == {'rows': []}
+        sb = Snotebook.get_snotebook('nb')
+        sb.write_note(str(note), b'# first\nzebra\n', previous=b'# first\n')
+        sb.append_note(b'crossing')
+        request['params']['query'] = 'zebra crossing'
+        assert [row[1] for row in server.handle(request)['rows']] == [
+            note.name]
+        server.close()
+
+
+class TestWatcher:
+
+    @pytest.fixture(params=['inotify', 'poll'])
+    def watcher(self, request):
+        watcher = snote.watch.get_watcher(request.param == 'poll', 0.05)
+        if request.param == 'inotify' and watcher.fileno() is None:
+            pytest.skip('inotify unavailable')
+        yield watcher
+        watcher.close()
+
+    @pytest.fixture
+    def index(self, tmp_path):
+        for name in ['2016-04-22-first-post', '2016-04-23-third-entry']:
+            (tmp_path / name).write_bytes(name.encode('utf-8'))
+        index = snote.index.NoteIndex.open(str(tmp_path))
+        yield index
+        index.close()
+
+    def collect(self, watcher):
+        batch = watcher.changes(2)
+        time.sleep(0.1)
+        return snote.watch.merge(batch, watcher.changes(0))
+
+    def test_in_place_edit(self, watcher, index, tmp_path):
+        watcher.add(str(tmp_path))
+        with open(str(tmp_path / '2016-04-22-first-post'), 'ab') as note:
+            note.write(b' appended by another editor')
+        batch = self.collect(watcher)
+        assert batch == {str(tmp_path): set(['2016-04-22-first-post'])}
+        snote.watch.apply_changes(index, batch[str(tmp_path)])
+        assert index.get('2016-04-22-first-post').size == 48
+        assert index.content_search('editor')
+
+    def test_create_rename_delete(self, watcher, index, tmp_path):
+        watcher.add(str(tmp_path))
+        (tmp_path / '2016-05-02-another-note').write_bytes(b'synced')
+        (tmp_path / '2016-04-23-third-entry').rename(
+            tmp_path / '2016-04-23-renamed')
+        (tmp_path / '2016-04-22-first-post').unlink()
+        (tmp_path / '.sync-tmp').write_bytes(b'ignored')
+        batch = self.collect(watcher)
+        snote.watch.apply_changes(index, batch[str(tmp_path)])
+        assert [n.name for n in index.notes()] == ['2016-04-23-renamed',
+                                                   '2016-05-02-another-note']
+        assert not index.refresh()  # nothing left for a rescan to find
+
+    def test_new_shard(self, watcher, tmp_path):
+        sb = Snotebook('tmp', str(tmp_path), index=True, layout='sharded')
+        watcher.add(sb.location, sharded=True)
+        shard = tmp_path / '2016' / '06'
+        shard.mkdir(parents=True)
+        (shard / '2016-06-01-june').write_bytes(b'june')
+        batch = self.collect(watcher)
+        snote.watch.apply_changes(sb.index, batch[sb.location])
+        assert sb.index.get('2016-06-01-june').location == str(shard)
+
+    def test_skips_bad_notebooks(self, caplog):
+        snote.watch.watch_notebooks(poll=True, rounds=0)
+        assert 'Not watching notebook badpath' in caplog.text
+
+
+class TestFuzzyTitles:
+
+    @pytest.mark.parametrize('indexed', [True, False])
+    def test_typo(self, snotebook, indexed):
+        sb = Snotebook(snotebook.name, snotebook.location, index=indexed)
+        notes = sb._find_notes('blokbuster')
+        assert notes[0].title.lower() == 'blockbuster doesnt exist anymore though'
+        assert sb.get_note_path('blokbustr') == notes[0].path
+
+    def test_substring_candidates(self, snotebook):
+        unindexed = Snotebook(snotebook.name, snotebook.location)
+        for term in ['note', 'ideo tap', 'Video-tapes', '2016-04', 'os?t']:
+            assert [n.name for n in snotebook._match_names(term)] == \
+                [n.name for n in unindexed._match_names(term)]
+
+    def test_ranked_before_similar(self, snotebook):
+        notes = snotebook._find_notes('return some')
+        assert notes[0].title.lower() == 'i have to return some video tapes'
+        assert set(n.name for n in notes) == \
+            set(n.name for n in snotebook._search_notes('return some'))
+
+    def test_no_resemblance(self, snotebook):
+        with pytest.raises(NoteNotFoundError):
+            snotebook._find_notes('zzyzx')
+
+    def test_similarity(self):
+        contains, coverage, _ = snote.fuzzy.similarity('blokbuster',
+                                                       'Blockbuster')
+        assert not contains and coverage >= snote.fuzzy.THRESHOLD
+        assert snote.fuzzy.similarity('video', 'return video tapes')[0]
+
+
+class TestCompressedNotes:
+
+    MAGIC = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+    @pytest.fixture(params=['gzip', 'zstd'])
+    def method(self, request):
+        if request.param == 'zstd':
+            pytest.importorskip('zstandard')
+        return request.param
+
+    @pytest.fixture
+    def notebook(self, tmp_path, method):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        (notebook / '2016-04-22-first-post.md').write_bytes(
+            b'I have to return some video tapes\n' * 1000)
+        (notebook / '2016-05-02-another-note.md').write_bytes(b'plain')
+        sb = Snotebook('tmp', str(notebook), index=True, compress=method)
+        assert sb.compress_notes() == 2
+        return notebook
+
+    def note_path(self, notebook, method, name='2016-04-22-first-post'):
+        return str(notebook / (name + '.md' +
+                               snote.lib.COMPRESSED_SUFFIXES[method]))
+
+    def test_compressed_on_disk(self, notebook, method):
+        path = self.note_path(notebook, method)
+        with open(path, 'rb') as note:
+            assert note.read(4).startswith(self.MAGIC[method])
+        assert os.path.getsize(path) < 34000
+        assert snote.lib.get_file_content(path).startswith(b'I have to')
+
+    def test_titles(self, notebook, method):
+        sb = Snotebook('tmp', str(notebook), compress=method)
+        assert [sb.display_note_info(n) for n in sb._list_notes()] == [
+            ('2016.04.22', 'first post'), ('2016.05.02', 'another note')]
+
+    @pytest.mark.parametrize('indexed', [True, False])
+    def test_search(self, notebook, method, indexed):
+        sb = Snotebook('tmp', str(notebook), index=indexed, compress=method)
+        notes = sb._search_content('"return some" tapes')
+        assert [n.name for n in notes] == [os.path.basename(
+            self.note_path(notebook, method))]
+        lines = list(sb._grep_notes('video', workers=1))
+        assert len(lines) == 1000 and lines[-1][1:] == (
+            1000, b'I have to return some video tapes')
+
+    def test_edit(self, notebook, method, editor):
+        sb = Snotebook('tmp', str(notebook), editor=editor, compress=method,
+                       edit='inplace')
+        path = self.note_path(notebook, method, '2016-05-02-another-note')
+        assert sb.edit_note(path, timestamp=False)
+        assert snote.lib.get_file_content(path) == b'plain edited'
+        unchanged = Snotebook('tmp', str(notebook), compress=method,
+                              editor=make_editor(notebook.parent, 'true'))
+        assert not unchanged.edit_note(path, timestamp=False)
+
+    def test_write_note(self, notebook, method):
+        path = self.note_path(notebook, method, '2016-05-02-another-note')
+        snote.lib.write_note(path, b'plain more', previous=b'plain')
+        assert snote.lib.get_file_content(path) == b'plain more'
+
+    def test_stream_matches(self):
+        content = b'return some video\ntapes ' * 3
+        for size in [1, 2, 5, 100]:
+            chunks = [content[i:i + size] for i in range(0, len(content), size)]
+            assert snote.index.stream_matches(chunks, snote.index.parse_query(
+                '"video tapes" return'))
+            assert not snote.index.stream_matches(
+                chunks, snote.index.parse_query('tape'))
+
+
+class TestImport:
+
+    @pytest.fixture
+    def target(self, tmp_path):
+        target = tmp_path / 'nb'
+        target.mkdir()
+        (target / '2016-04-22-first-post.md').write_bytes(b'existing')
+        template = tmp_path / 'template'
+        template.write_text('# %TITLE%\n')
+        return Snotebook('tmp', str(target), index=True,
+                         template=str(template))
+
+    def names(self, sb):
+        return [n.name for n in sb._list_notes()]
+
+    def test_directory(self, target, tmp_path):
+        source = tmp_path / 'src'
+        (source / 'sub').mkdir(parents=True)
+        (source / '2016-04-22-first-post.txt').write_bytes(b'one')
+        (source / 'sub' / 'loose note.txt').write_bytes(b'two')
+        (source / '.hidden').write_bytes(b'skipped')
+        os.utime(str(source / 'sub' / 'loose note.txt'), (0, 1462147200))
+        assert target.import_notes(str(source), workers=2) == 2
+        assert self.names(target) == ['2016-04-22-first-post-2.md',
+                                      '2016-04-22-first-post.md',
+                                      '2016-05-02-loose-note.md']
+        note = os.path.join(target.location, '2016-04-22-first-post-2.md')
+        assert snote.lib.get_file_content(note) == b'# first-post\none'
+        assert target.index.get('2016-05-02-loose-note.md') is not None
+        assert not target.index.refresh()
+
+    def test_tar(self, target, tmp_path):
+        import tarfile
+        note = tmp_path / '2016-07-15-tapes.md'
+        note.write_bytes(b'video')
+        archive = str(tmp_path / 'notes.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.add(str(note), arcname='export/2016-07-15-tapes.md')
+        assert target.import_notes(archive) == 1
+        assert '2016-07-15-tapes.md' in self.names(target)
+
+    def test_jsonl(self, target, tmp_path):
+        source = tmp_path / 'notes.jsonl'
+        source.write_text('{"title": "return video tapes", "date": '
+                          '"2016-08-01", "content": "now"}\n'
+                          'not json\n\n'
+                          '{"content": "no title or date"}\n')
+        assert snote.importer.import_notes(target, str(source), 'jsonl',
+                                           batch_size=1) == 2
+        names = self.names(target)
+        assert '2016-08-01-return-video-tapes.md' in names
+        assert target.date() + '-.md' in names
+
+
+class TestExport:
+
+    def export(self, sb, tmp_path, filename, **kwargs):
+        output = str(tmp_path / filename)
+        count = sb.export_notes(output, **kwargs)
+        return count, output
+
+    def test_jsonl_round_trip(self, snotebook, tmp_path):
+        count, output = self.export(snotebook, tmp_path, 'notes.jsonl')
+        assert count == 7
+        with open(output) as stream:
+            records = [json.loads(line) for line in stream]
+        assert [r['name'] for r in records] == \
+            [n.name for n in snotebook._list_notes()]
+        assert records[0]['date'] == '2016-04-22'
+        assert records[0]['display_date'] == '2016.04.22'
+
+        target = tmp_path / 'copy'
+        target.mkdir()
+        copy = Snotebook('copy', str(target))
+        assert copy.import_notes(output) == 7
+        assert [(n.date, n.title) for n in copy._list_notes()] == \
+            [(n.date, n.title) for n in snotebook._list_notes()]
+
+    def test_tar_filtered(self, snotebook, tmp_path):
+        import tarfile
+        since = snote.records.date_bound('2016-07-01')
+        count, output = self.export(snotebook, tmp_path, 'notes.tar.gz',
+                                    search_term='video', since=since)
+        with tarfile.open(output) as archive:
+            members = archive.getmembers()
+            assert [m.name for m in members] == [
+                '2016-07-15-I-have-to-return-some-video-tapes',
+                '2016-08-01-So-how-can-you-return-video-tapes']
+            assert members[1].pax_headers['SNOTE.title'] == \
+                'So how can you return video tapes'
+            content = archive.extractfile(members[1]).read()
+        path = os.path.join(snotebook.location, members[1].name)
+        assert content == snote.lib.get_file_content(path)
+        assert count == 2
+
+    def test_zip(self, snotebook, tmp_path):
+        import zipfile
+        count, output = self.export(snotebook, tmp_path, 'notes.zip')
+        with zipfile.ZipFile(output) as archive:
+            assert len(archive.namelist()) == count == 7
+
+    def test_read_ahead_order(self, snotebook):
+        notes = snotebook._list_notes()
+        read = [note for note, _, _ in snote.exporter.iter_contents(
+            notes, workers=4, read_ahead=2)]
+        assert read == notes
+
+
+class TestAppend:
+
+    @pytest.fixture
+    def notebook(self, tmp_path):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        (notebook / '2016-04-22-first-post.md').write_bytes(b'# first\n')
+        (notebook / '2016-05-02-video-tapes.md').write_bytes(b'# tapes\n')
+        return notebook
+
+    def test_append_last_and_named(self, notebook):
+        sb = Snotebook('tmp', str(notebook))
+        path = sb.append_note(b'one')
+        assert path.endswith('2016-05-02-video-tapes.md')
+        sb.append_note(b'two\n', filename='first')
+        assert (notebook / '2016-05-02-video-tapes.md').read_bytes() == \
+            b'# tapes\none\n'
+        assert (notebook / '2016-04-22-first-post.md').read_bytes() == \
+            b'# first\ntwo\n'
+
+    def test_no_guessing(self, notebook):
+        (notebook / '2016-06-01-video-tapes-2.md').write_bytes(b'# more\n')
+        (notebook / '2016-01-01-deployment-notes.md').write_bytes(b'')
+        sb = Snotebook('tmp', str(notebook))
+        with pytest.raises(NoteNotFoundError):
+            sb.append_note(b'deployed', filename='deploy-log')
+        with pytest.raises(NotebookError):
+            sb.append_note(b'which one', filename='tapes')
+        assert sb.append_note(b'this one', filename='video tapes').endswith(
+            '2016-05-02-video-tapes.md')
+        assert (notebook / '2016-01-01-deployment-notes.md').read_bytes() == b''
+
+    def test_timestamp(self, notebook):
+        sb = Snotebook('tmp', str(notebook))
+        sb.append_note(b'stamped', timestamp=True)
+        last = (notebook / '2016-05-02-video-tapes.md').read_bytes()
+        assert last.startswith(b'# tapes\n' + sb.time()[:4])
+        assert last.endswith(b' stamped\n')
+
+    def test_concurrent(self, notebook):
+        from concurrent.futures import ThreadPoolExecutor
+        path = str(notebook / '2016-04-22-first-post.md')
+        lines = [('line %d ' % i).encode() * 50 + b'\n' for i in range(200)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda line: snote.lib.append_note(path, line),
+                          lines))
+        written = snote.lib.get_file_content(path).splitlines(True)
+        assert written[0] == b'# first\n'
+        assert sorted(written[1:]) == sorted(lines)
+
+    def test_replaced_while_waiting(self, notebook):
+        import threading
+        path = str(notebook / '2016-04-22-first-post.md')
+        with open(path, 'rb') as old:
+            with snote.lib.locked(old.fileno()):
+                appender = threading.Thread(
+                    target=snote.lib.append_note, args=(path, b'kept\n'))
+                appender.start()
+                time.sleep(0.2)  # let it open the old note and wait
+                replacement = str(notebook / 'replacement')
+                with open(replacement, 'wb') as new:
+                    new.write(b'# rewritten\n')
+                os.replace(replacement, path)
+            appender.join()
+        assert snote.lib.get_file_content(path) == b'# rewritten\nkept\n'
+
+    @pytest.mark.parametrize('method', ['gzip', 'zstd'])
+    def test_compressed(self, notebook, method):
+        if method == 'zstd':
+            pytest.importorskip('zstandard')
+        sb = Snotebook('tmp', str(notebook), compress=method)
+        sb.compress_notes()
+        path = sb.append_note(b'more', filename='first')
+        assert path.endswith(snote.lib.COMPRESSED_SUFFIXES[method])
+        sb.append_note(b'again', filename='first')
+        assert snote.lib.get_file_content(path) == b'# first\nmore\nagain\n'
+
+    def test_index(self, notebook):
+        sb = Snotebook('tmp', str(notebook), index=True)
+        assert sb._search_content('tapes')
+        sb.append_note(b'cassette', filename='first')
+        sb.append_note(b'recorder', filename='first')
+        sb = Snotebook('tmp', str(notebook), index=True)
+        assert [n.name for n in sb._search_content('cassette recorder')] == [
+            '2016-04-22-first-post.md']
+
+    def test_index_without_rereading(self, notebook, monkeypatch):
+        from snote.index import NoteIndex
+        sb = Snotebook('tmp', str(notebook), index=True)
+        assert sb.index
+        stored = []
+        store = NoteIndex._store
+        monkeypatch.setattr(NoteIndex, '_store', lambda self, relpath, stat: (
+            stored.append(relpath), store(self, relpath, stat)))
+        sb.append_note(b'cassette #archive', filename='first')
+        sb.append_note(b'recorder', filename='first')
+        sb = Snotebook('tmp', str(notebook), index=True)
+        assert [n.name for n in sb._search_content('cassette recorder')] == [
+            '2016-04-22-first-post.md']
+        assert [n.name for n in sb.get_notes(tags=['archive'])] == [
+            '2016-04-22-first-post.md']
+        assert stored == []
+
+        # text appended to a note ending without a newline runs on from its
+        # last word, so the note is read again
+        path = notebook / '2016-04-22-first-post.md'
+        path.write_bytes(path.read_bytes() + b'tape')
+        sb.index.update(path.name)
+        stored.clear()
+        sb.append_note(b'deck', filename='first')
+        assert stored == []
+        sb = Snotebook('tmp', str(notebook), index=True)
+        assert [n.name for n in sb._search_content('tapedeck')] == [
+            '2016-04-22-first-post.md']
+        assert stored == ['2016-04-22-first-post.md']
+
+
+class TestAsyncApi:
+
+    @pytest.fixture(params=[True, False], ids=['indexed', 'scanned'])
+    def sb(self, request, tmp_path):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        for day in range(1, 29):
+            (notebook / '2016-02-{:02d}-video-tapes-{}'.format(day, day)) \
+                .write_bytes(b'return some video tapes, day %d' % day)
+        (notebook / '2016-03-01-another-note').write_bytes(b'nothing here')
+        return Snotebook('tmp', str(notebook), index=request.param)
+
+    def test_structured_results(self, sb, capsys):
+        notes = sb.get_matching_notes('tapes', content=True)
+        assert len(notes) == 28
+        assert [n.name for n in sb.get_notes(reverse=True, limit=1)] == [
+            '2016-03-01-another-note']
+        with pytest.raises(NoteNotFoundError):
+            sb.get_matching_notes('blockbuster')
+        assert capsys.readouterr().out == ''
+
+    def test_stdout_left_open(self, sb, capsys):
+        sb.list_notes(max_notes=2)
+        sb.search_notes('another')
+        assert not sys.stdout.closed
+        assert capsys.readouterr().out.count('another note') == 2
+
+    def test_read_write(self, sb, tmp_path):
+        path = sb.create_note(b'fresh content', title='fresh')
+        assert sb.read_note(path) == b'fresh content'
+        sb.write_note(path, b'fresh content, more', previous=b'fresh content')
+        assert [n.path for n in sb.get_matching_notes('more', content=True)] \
+            == [path]
+        with pytest.raises(NotebookError):
+            sb.create_note(b'again', title='fresh')
+        outside = tmp_path / 'outside'
+        outside.write_bytes(b'secret')
+        for path in [str(outside), os.path.join(sb.location, '..', 'outside'),
+                     os.path.join(sb.location, 'missing')]:
+            with pytest.raises(NoteNotFoundError):
+                sb.read_note(path)
+
+    def test_concurrent(self, sb):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        async def main(notebook):
+            searches = [notebook.search_notes('day {}'.format(day),
+                                              content=True)
+                        for day in range(1, 29)]
+            found = await asyncio.gather(*searches)
+            contents = await asyncio.gather(*[notebook.read_note(
+                notes[0].path) for notes in found])
+            listed = await notebook.list_notes()
+            missing = notebook.search_notes('blockbuster')
+            with pytest.raises(NoteNotFoundError):
+                await missing
+            return found, contents, listed
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            found, contents, listed = asyncio.run(
+                main(snote.aio.AsyncSnotebook(sb, pool)))
+        assert [len(notes) for notes in found] == [1] * 28
+        assert contents[4] == b'return some video tapes, day 5'
+        assert len(listed) == 29
+
+    def test_concurrent_writes(self, sb):
+        import asyncio
+
+        async def main(notebook):
+            paths = await asyncio.gather(*[notebook.create_note(
+                b'written %d' % i, title='note {}'.format(i))
+                for i in range(20)])
+            await asyncio.gather(*[notebook.append_note(b'appended', name)
+                                   for name in ['note 3', 'note 7']])
+            return paths
+
+        paths = asyncio.run(main(snote.aio.AsyncSnotebook(sb)))
+        assert len(set(paths)) == 20
+        assert len(sb.get_matching_notes('written', content=True)) == 20
+        assert sb.read_note(paths[3]) == b'written 3appended\n'
+
+
+class TestHistory:
+
+    FIRST = b'# first\n' + b'I have to return some video tapes\n' * 10
+
+    @pytest.fixture
+    def notebook(self, tmp_path):
+        notebook = tmp_path / 'nb'
+        notebook.mkdir()
+        (notebook / '2016-04-22-first-post.md').write_bytes(self.FIRST)
+        return notebook
+
+    def test_delta_roundtrip(self):
+        old = b''.join(b'line %d\n' % i for i in range(100))
+        for new in [old + b'appended\n', old.replace(b'line 50\n', b'x\n'),
+                    b'head\n' + old[:300], b'', b'no newline']:
+            delta = snote.history.make_delta(old, new)
+            assert snote.history.apply_delta(old, delta) == new
+        assert len(snote.history.make_delta(old, old + b'x')) < 40
+
+    def test_revisions(self, notebook, editor):
+        sb = Snotebook('tmp', str(notebook), editor=editor, history=True)
+        path = str(notebook / '2016-04-22-first-post.md')
+        sb.edit_note(path, timestamp=False)
+        sb.append_note(b'appended', filename='first')
+        sb.write_note(path, b'# rewritten\n')
+        revisions = sb.get_revisions(path)
+        assert [r.number for r in revisions] == [1, 2, 3, 4]
+        assert [r.kind for r in revisions] == [snote.history.SNAPSHOT] + \
+            [snote.history.DELTA] * 2 + [snote.history.SNAPSHOT]
+        assert [sb.read_revision(path, n) for n in range(1, 5)] == [
+            self.FIRST, self.FIRST + b' edited',
+            self.FIRST + b' editedappended\n', b'# rewritten\n']
+        assert sb.read_revision(path) == sb.read_revision(path, -1) == \
+            b'# rewritten\n'
+        with pytest.raises(NoteNotFoundError):
+            sb.read_revision(path, 5)
+        assert not any(n.name.startswith('.') for n in sb._list_notes())
+
+    def test_outside_changes(self, notebook):
+        sb = Snotebook('tmp', str(notebook), history=True)
+        path = str(notebook / '2016-04-22-first-post.md')
+        sb.write_note(path, b'# first\nsnote\n')
+        with open(path, 'ab') as note:
+            note.write(b'other editor\n')
+        sb.write_note(path, b'# first\nsnote again\n')
+        assert [sb.read_revision(path, n) for n in range(1, 5)] == [
+            self.FIRST, b'# first\nsnote\n', b'# first\nsnote\nother editor\n',
+            b'# first\nsnote again\n']
+
+    def test_bounded_chain(self, notebook):
+        sb = Snotebook('tmp', str(notebook), history=True, compress='gzip')
+        sb.compress_notes()
+        path = sb.get_note_path('first')
+        content = self.FIRST
+        for i in range(80):
+            content += b'entry %d\n' % i
+            sb.write_note(path, content)
+        revisions = sb.get_revisions(path)
+        assert len(revisions) == 81
+        kinds = [r.kind for r in revisions]
+        assert kinds.count(snote.history.SNAPSHOT) == 3
+        assert max(len(run) for run in ''.join(map(str, kinds)).split('0')) \
+            <= snote.history.SNAPSHOT_INTERVAL
+        assert sb.read_revision(path, 50) == self.FIRST + b''.join(
+            b'entry %d\n' % i for i in range(49))
+        # survives resharding, and other processes see the same history
+        sb = Snotebook('tmp', str(notebook), history=True, layout='sharded',
+                       compress='gzip')
+        sb.reshard()
+        path = sb.get_note_path('first')
+        assert sb.read_revision(path) == content
+
+    def test_torn_record(self, notebook):
+        sb = Snotebook('tmp', str(notebook), history=True)
+        path = str(notebook / '2016-04-22-first-post.md')
+        sb.write_note(path, b'# first\none\n')
+        pack = str(notebook / snote.history.HISTORY_NAME)
+        with open(pack, 'ab') as output:
+            output.write(snote.history.MAGIC + b'\x01torn')
+        sb = Snotebook('tmp', str(notebook), history=True)
+        assert len(sb.get_revisions(path)) == 2
+        sb.write_note(path, b'# first\ntwo\n')
+        assert sb.read_revision(path) == b'# first\ntwo\n'
+        assert len(Snotebook('tmp', str(notebook), history=True)
+                   .get_revisions(path)) == 3
+
+    def test_disabled(self, notebook):
+        sb = Snotebook('tmp', str(notebook))
+        path = str(notebook / '2016-04-22-first-post.md')
+        sb.write_note(path, b'changed')
+        assert not (notebook / snote.history.HISTORY_NAME).exists()
+        with pytest.raises(ConfigError):
+            sb.get_revisions(path)
+
+
+class TestTags:
+
+    NOTES = {
+        '2016-04-22-first-post.md': b'---\ntitle: First\ntags: [Work, '
+                                    b'project-x]\n---\n# First\n#draft body\n',
+        '2016-04-23-errands.md': b'---\ntags:\n  - home\n  - "errands"\n'
+                                 b'---\nmilk, see #1 and http://x/#anchor\n',
+        '2016-05-02-standup.md': b'# Standup\nnotes for #work #project-x/\n',
+        '2016-05-03-plain.md': b'no tags --- here\n',
+    }
+
+    @pytest.fixture(params=[True, False], ids=['indexed', 'scanned'])
+    def sb(self, request, tmp_path):
+        for name, content in self.NOTES.items():
+            (tmp_path / name).write_bytes(content)
+        return Snotebook('tmp', str(tmp_path), index=request.param)
+
+    def names(self, sb, *tags):
+        return [n.name[:10] for n in sb._list_notes(tags=list(tags))]
+
+    def test_parse(self):
+        parse = snote.frontmatter.parse_tags
+        assert [sorted(parse(c)) for c in self.NOTES.values()] == [
+            ['draft', 'project-x', 'work'], ['errands', 'home'],
+            ['project-x', 'work'], []]
+        assert parse(b'---\ntags: a, b c\n---\n') == {'a', 'b', 'c'}
+        assert parse(b'text\n---\ntags: late\n---\n') == set()
+        fields, body = snote.frontmatter.parse_frontmatter(
+            self.NOTES['2016-04-22-first-post.md'].decode())
+        assert fields == {'title': 'First', 'tags': ['Work', 'project-x']}
+        assert body == len('---\ntitle: First\ntags: [Work, project-x]\n---')
+
+    def test_queries(self, sb):
+        assert self.names(sb, 'work') == ['2016-04-22', '2016-05-02']
+        assert self.names(sb, 'WORK', '#project-x') == ['2016-04-22',
+                                                         '2016-05-02']
+        assert self.names(sb, 'work', '-draft') == ['2016-05-02']
+        assert self.names(sb, 'draft,home') == ['2016-04-22', '2016-04-23']
+        assert self.names(sb, '-work,home') == ['2016-05-03']
+        assert self.names(sb, 'nope') == []
+        notes = sb._list_notes('name', True, 1, tags=['work'])
+        assert [n.name[:10] for n in notes] == ['2016-05-02']
+        since = snote.records.date_bound('2016-05-01')
+        assert [n.name[:10] for n in sb._list_notes(since=since,
+                                                      tags=['work'])] == \
+            ['2016-05-02']
+
+    def test_no_bodies_read(self, tmp_path, monkeypatch):
+        for name, content in self.NOTES.items():
+            (tmp_path / name).write_bytes(content)
+        sb = Snotebook('tmp', str(tmp_path), index=True)
+        assert sb.index is not None
+
+        def unexpected(path):
+            raise AssertionError('read ' + path)
+        monkeypatch.setattr(snote.lib, 'get_file_content', unexpected)
+        assert self.names(sb, 'home') == ['2016-04-23']
+
+    def test_follows_writes(self, sb):
+        path = os.path.join(sb.location, '2016-05-03-plain.md')
+        sb.write_note(path, b'now #tagged\n')
+        assert self.names(sb, 'tagged') == ['2016-05-03']
+        sb.write_note(path, b'untagged again\n')
+        assert self.names(sb, 'tagged') == []
+
+
+class TestRankedSearch:
+
+    NOTES = {
+        '2016-04-01-video-tapes.md': b'a note about nothing much',
+        '2016-04-02-errands.md': b'return the video tapes, video tapes! '
+                                 b'and buy milk',
+        '2016-04-03-long-diary.md': b'video ' + b'filler words here ' * 200,
+        '2016-04-04-short.md': b'video tapes',
+        '2016-05-01-videography.md': b'cameras and lenses',
+        '2016-05-02-unrelated.md': b'nothing to see here',
+    }
+
+    @pytest.fixture
+    def notebook(self, tmp_path):
+        for name, content in self.NOTES.items():
+            (tmp_path / name).write_bytes(content)
+        return tmp_path
+
+    @pytest.fixture(params=[True, False], ids=['indexed', 'memory'])
+    def sb(self, request, notebook):
+        return Snotebook('tmp', str(notebook), index=request.param)
+
+    def ranked(self, sb, query, limit=0, **kwargs):
+        return [n.name[:10] for n in sb.get_ranked_notes(query, limit,
+                                                           **kwargs)]
+
+    def test_ranking(self, sb):
+        # title matches first, then more occurrences, then shorter notes
+        assert self.ranked(sb, 'tapes') == ['2016-04-01', '2016-04-02',
+                                            '2016-04-04']
+        assert self.ranked(sb, 'video')[-2:] == ['2016-04-04', '2016-04-03']
+        assert self.ranked(sb, 'video', 2) == self.ranked(sb, 'video')[:2]
+        assert self.ranked(sb, 'milk video')[0] == '2016-04-02'
+
+    def test_phrase_and_prefix(self, sb):
+        assert self.ranked(sb, '"tapes video"') == ['2016-04-02']
+        assert self.ranked(sb, '"video tapes"')[0] == '2016-04-01'
+        assert self.ranked(sb, 'camera*') == ['2016-05-01']
+        assert '2016-05-01' in self.ranked(sb, 'video*')
+        for query in ['camera', 'blockbuster']:
+            with pytest.raises(NoteNotFoundError):
+                sb.get_ranked_notes(query)
+
+    def test_date_range(self, sb):
+        since = snote.records.date_bound('2016-04-03')
+        until = snote.records.date_bound('2016-04-30')
+        assert self.ranked(sb, 'video', since=since, until=until) == [
+            '2016-04-04', '2016-04-03']
+
+    def test_ties_newest_first(self, tmp_path):
+        (tmp_path / '2016-06-02-later.md').write_bytes(b'zebra crossing')
+        sb = Snotebook('tmp', str(tmp_path), index=True)
+        assert sb.index
+        # indexed after the later note, so it gets the higher id
+        (tmp_path / '2016-06-01-early.md').write_bytes(b'zebra crossing')
+        sb.index.refresh(force=True)
+        assert self.ranked(sb, 'zebra') == ['2016-06-02', '2016-06-01']
+
+    def test_corpus_statistics(self, notebook):
+        sb = Snotebook('tmp', str(notebook), index=True)
+        path = str(notebook / '2016-04-04-short.md')
+        sb.write_note(path, b'video tapes and more words')
+        (notebook / '2016-05-02-unrelated.md').unlink()
+        sb.index.refresh()
+        db = sb.index._db
+        assert db.execute('SELECT notes, length, title_length FROM corpus'
+                          ).fetchone() == db.execute(
+            'SELECT count(*), sum(length), sum(title_length) FROM notes'
+        ).fetchone() == (5, 3 + 11 + 601 + 5 + 3, 2 + 1 + 2 + 1 + 1)
+
+    def test_parse(self):
+        assert snote.index.parse_ranked_query('Video* "return some" tap-es') \
+            == [('prefix', ['video']), ('phrase', ['return', 'some']),
+                ('phrase', ['tap', 'es'])]
+
+
+class TestTemplates:
+
+    @pytest.fixture
+    def template(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+        (tmp_path / 'parts').mkdir()
+        (tmp_path / 'parts' / 'footer').write_text('-- %NOTEBOOK%\n')
+        template = tmp_path / 'template'
+        template.write_text('# %TITLE%\n%DATE% 100%\n'
+                            '%INCLUDE parts/footer%%UNKNOWN%\n')
+        return template
+
+    def test_render(self, template, tmp_path):
+        sb = Snotebook('nb1', str(tmp_path), template=str(template),
+                       datefmt='%d.%m.%Y')
+        day = datetime.date(2016, 7, 15)
+        assert sb.render_template('tapes', day) == \
+            '# tapes\n15.07.2016 100%\n-- nb1\n%UNKNOWN%\n'
+        assert sb.template == \
+            '# %TITLE%\n%DATE% 100%\n-- %NOTEBOOK%\n%UNKNOWN%\n'
+        assert sb.compiled_template.variables == {'TITLE', 'DATE', 'NOTEBOOK'}
+        assert Snotebook('nb1', str(tmp_path)).render_template('x') == ''
+
+    def test_cached(self, template, tmp_path, monkeypatch):
+        compiled = snote.templates.get_template(str(template))
+        assert snote.templates.get_template(str(template)) is compiled
+
+        snote.templates._compiled.clear()
+        monkeypatch.setattr(snote.templates, 'compile_template', None)
+        from_disk = snote.templates.get_template(str(template))
+        assert from_disk.parts == compiled.parts
+        assert from_disk.depends == compiled.depends
+
+    def test_tracks_includes(self, template, tmp_path):
+        snote.templates.get_template(str(template))
+        footer = tmp_path / 'parts' / 'footer'
+        footer.write_text('bye\n')
+        os.utime(str(footer), ns=(0, 0))
+        assert snote.templates.get_template(str(template)).render() == \
+            '# \n 100%\nbye\n%UNKNOWN%\n'
+
+    def test_include_errors(self, tmp_path):
+        looped = tmp_path / 'looped'
+        looped.write_text('a %INCLUDE looped% b')
+        with pytest.raises(ConfigError):
+            snote.templates.get_template(str(looped), cache=False)
+        missing = tmp_path / 'missing'
+        missing.write_text('%INCLUDE nowhere%')
+        with pytest.raises(ConfigError):
+            snote.templates.get_template(str(missing), cache=False)